@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+# Runs server-snpshtr.py under gunicorn against a throwaway state directory
+# and plays snapshot workers, analyzers and dashboard pollers at it, with the
+# same call sequences the clients and the dashboard use. Reports throughput,
+# p50/p99 latency per route and the bytes the server wrote, so storage and
+# scheduling changes can be compared run to run.
+#
+# A run can be recorded with --record and played back with --trace: every
+# line of the trace is one step of an actor, {"sec", "actor", "kind", "step"},
+# named after the route it calls, and each actor repeats its own steps at the
+# recorded offsets, filling in job ids and uploads from the replaying
+# server's answers.
+
+import abc
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Callable
+
+import requests
+
+APIKEY = 'bench'
+PLATFORM = 'bench'
+
+
+def wait_for_server(baseapi: str, timeout: float):
+    deadline = time.time()+timeout
+    while time.time() < deadline:
+        try:
+            requests.get(f'{baseapi}/', timeout=1).raise_for_status()
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(.2)
+    raise TimeoutError('server did not come up')
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.
+    return sorted_values[min(len(sorted_values)-1, int(p*len(sorted_values)))]
+
+
+def dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+
+
+def process_tree(pid: int) -> list[int]:
+    pids = [pid]
+    for task in Path(f'/proc/{pid}/task').glob('*'):
+        try:
+            children = task.joinpath('children').read_text().split()
+        except OSError:
+            continue
+        for child in children:
+            pids += process_tree(int(child))
+    return pids
+
+
+def written_bytes(pid: int) -> int | None:
+    # what the server processes asked the kernel to write, including the
+    # sqlite journal and files deleted since; None where /proc is missing
+    total = None
+    for p in process_tree(pid):
+        try:
+            for line in Path(f'/proc/{p}/io').read_text().splitlines():
+                if line.startswith('write_bytes:'):
+                    total = (total or 0) + int(line.split()[1])
+        except OSError:
+            continue
+    return total
+
+
+class Recorder:
+    def __init__(self, started: float, trace: Path | None):
+        self.started = started
+        self.lock = threading.Lock()
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.sent = 0
+        self.received = 0
+        self.trace = trace.open('w', encoding='utf-8') if trace else None
+
+    def record(self, route: str, tm: float, resp: requests.Response | None, sent: int):
+        with self.lock:
+            self.latencies[route].append(time.time()-tm)
+            if resp is None or resp.status_code >= 500:
+                self.errors[route] += 1
+            self.sent += sent
+            self.received += len(resp.content) if resp is not None else 0
+
+    def record_step(self, actor: 'Actor', step: str):
+        if self.trace:
+            with self.lock:
+                self.trace.write(json.dumps(dict(
+                    sec=round(time.time()-self.started, 3), actor=actor.name,
+                    kind=actor.kind, step=step)) + '\n')
+
+    def close(self):
+        if self.trace:
+            self.trace.close()
+
+    def report(self, elapsed: float) -> dict[str, Any]:
+        routes = dict()
+        for route, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            routes[route] = dict(
+                requests=len(latencies),
+                errors=self.errors[route],
+                rps=len(latencies)/elapsed,
+                p50Ms=1000*percentile(latencies, .5),
+                p99Ms=1000*percentile(latencies, .99),
+            )
+        return dict(
+            elapsedSec=elapsed,
+            requests=sum(r['requests'] for r in routes.values()),
+            errors=sum(r['errors'] for r in routes.values()),
+            rps=sum(r['requests'] for r in routes.values())/elapsed,
+            sentBytes=self.sent,
+            receivedBytes=self.received,
+            routes=routes,
+        )
+
+
+class Actor(abc.ABC):
+    kind = ''
+
+    def __init__(self, name: str, baseapi: str, recorder: Recorder, args: argparse.Namespace):
+        self.name = name
+        self.baseapi = baseapi
+        self.recorder = recorder
+        self.args = args
+        self.steps: dict[str, Callable[[], Any]] = dict()
+
+    def call(self, route: str, method: str, path: str, data: bytes | None = None,
+             **kwargs) -> requests.Response | None:
+        tm = time.time()
+        resp = None
+        try:
+            resp = requests.request(method, f'{self.baseapi}{path}', data=data, **kwargs)
+        except requests.exceptions.RequestException:
+            pass
+        self.recorder.record(route, tm, resp, len(data or b''))
+        return resp
+
+    def step(self, step: str):
+        self.recorder.record_step(self, step)
+        self.steps[step]()
+
+    @abc.abstractmethod
+    def loop(self):
+        # one round of the client's call sequence, repeated until the deadline
+        pass
+
+    def run(self, deadline: float):
+        while time.time() < deadline:
+            self.loop()
+
+    def replay(self, started: float, steps: list[tuple[float, str]]):
+        for sec, step in steps:
+            time.sleep(max(0., started+sec-time.time()))
+            if step in self.steps:
+                self.step(step)
+
+
+class SnapshotWorker(Actor):
+    kind = 'worker'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.job: dict[str, Any] | None = None
+        self.files: dict[str, bytes] = dict()
+        self.steps = {
+            'GET /job/next': self.next_job,
+            'POST /job': self.post_job,
+            'POST /job/manifest': self.post_manifest,
+            'PUT /blob/<sha256>': self.put_blobs,
+            'POST /job/commit': self.post_commit,
+        }
+        self.missing: list[str] = list()
+
+    def query(self) -> str:
+        return f'key={APIKEY}&worker={self.name}&version=bench&jobId={self.job["jobId"]}'
+
+    def screenshots(self) -> dict[str, bytes]:
+        # one screenshot per resolution; with --reuse some of them come out
+        # the same as in the previous job, as unchanged pages would
+        files = dict()
+        per_file = max(1, self.args.zip_kib*1024//self.args.files)
+        for i in range(self.args.files):
+            if i < self.args.files*self.args.reuse:
+                seed = f'{self.name}.{i}'.encode('utf-8')
+                b = (hashlib.sha256(seed).digest()*(per_file//32+1))[:per_file]
+            else:
+                b = os.urandom(per_file)
+            files[f'{PLATFORM}.{self.name}.chromium.r{i}.full.png'] = b
+        return files
+
+    def next_job(self):
+        resp = self.call('GET /job/next', 'GET',
+                         f'/job/next?key={APIKEY}&worker={self.name}&version=bench'
+                         f'&longpoll={self.args.longpoll}',
+                         timeout=self.args.longpoll+30)
+        self.job = resp.json() if resp is not None and resp.status_code == 200 else None
+        self.files = self.screenshots() if self.job else dict()
+
+    def post_job(self):
+        if self.job is None:
+            return
+        bio = BytesIO()
+        with zipfile.ZipFile(bio, mode='w', compression=zipfile.ZIP_STORED) as zf:
+            for name, b in self.files.items():
+                zf.writestr(name, b)
+        b = bio.getvalue()
+        self.call('POST /job', 'POST',
+                  f'/job?{self.query()}&sha256={hashlib.sha256(b).hexdigest()}&captureSec=1',
+                  data=b, headers={'content-type': 'application/zip'})
+        self.job = None
+
+    def manifest(self) -> dict[str, str]:
+        return {name: hashlib.sha256(b).hexdigest() for name, b in self.files.items()}
+
+    def post_manifest(self):
+        if self.job is None:
+            return
+        resp = self.call('POST /job/manifest', 'POST', f'/job/manifest?{self.query()}',
+                         json=self.manifest())
+        self.missing = resp.json()['missing'] if resp is not None and resp.ok else list()
+
+    def put_blobs(self):
+        if self.job is None:
+            return
+        by_hash = {h: self.files[name] for name, h in self.manifest().items()}
+        for h in self.missing:
+            self.call('PUT /blob/<sha256>', 'PUT', f'/blob/{h}?key={APIKEY}', data=by_hash[h],
+                      headers={'content-type': 'application/octet-stream'})
+
+    def post_commit(self):
+        if self.job is None:
+            return
+        self.call('POST /job/commit', 'POST', f'/job/commit?{self.query()}&captureSec=1',
+                  json=self.manifest())
+        self.job = None
+
+    def loop(self):
+        self.step('GET /job/next')
+        if self.job is None:
+            return
+        time.sleep(self.args.capture_sec)
+        if self.args.delta:
+            self.step('POST /job/manifest')
+            self.step('PUT /blob/<sha256>')
+            self.step('POST /job/commit')
+        else:
+            self.step('POST /job')
+
+
+class Analyzer(Actor):
+    kind = 'analyzer'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.anal: dict[str, Any] | None = None
+        self.steps = {
+            'GET /analysis/next': self.next_analysis,
+            'GET /jobs/<path>': self.download,
+            'POST /analysis': self.post_analysis,
+        }
+
+    def next_analysis(self):
+        resp = self.call('GET /analysis/next', 'GET',
+                         f'/analysis/next?key={APIKEY}&worker={self.name}&version=bench'
+                         f'&longpoll={self.args.longpoll}',
+                         timeout=self.args.longpoll+30)
+        self.anal = resp.json() if resp is not None and resp.status_code == 200 else None
+
+    def download(self):
+        if self.anal is None:
+            return
+        for path in self.anal['workers'].values():
+            if path is not None:
+                self.call('GET /jobs/<path>', 'GET', f'/{path}')
+
+    def post_analysis(self):
+        if self.anal is None:
+            return
+        bio = BytesIO()
+        with zipfile.ZipFile(bio, mode='w', compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('analysis.json', json.dumps(dict(indicators=dict(rmse=0.))))
+            zf.writestr('diff.png', os.urandom(self.args.zip_kib*1024//self.args.files))
+        b = bio.getvalue()
+        self.call('POST /analysis', 'POST',
+                  f'/analysis?key={APIKEY}&worker={self.name}&version=bench'
+                  f'&jobId={self.anal["jobId"]}&completeness={self.anal["completeness"]}'
+                  f'&sha256={hashlib.sha256(b).hexdigest()}',
+                  data=b, headers={'content-type': 'application/zip'})
+        self.anal = None
+
+    def loop(self):
+        self.step('GET /analysis/next')
+        if self.anal is None:
+            return
+        self.step('GET /jobs/<path>')
+        time.sleep(self.args.analysis_sec)
+        self.step('POST /analysis')
+
+
+class Poller(Actor):
+    kind = 'poller'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        # revalidated the way the browser does, with the last ETag
+        self.etags: dict[str, str] = dict()
+        self.submissions: list[dict[str, Any]] = list()
+        self.steps = {
+            route: (lambda route=route: self.poll(route))
+            for route in ('GET /analysis', 'GET /job', 'GET /job/submission',
+                          'GET /uptime', 'GET /uptime2')
+        }
+        self.steps['GET /unzip/jobs/<path>'] = self.browse
+
+    def poll(self, route: str):
+        path = route.split(' ', 1)[1]
+        headers = {'If-None-Match': self.etags[route]} if route in self.etags else dict()
+        resp = self.call(route, 'GET', path, headers=headers)
+        if resp is None or resp.status_code != 200:
+            return
+        if 'ETag' in resp.headers:
+            self.etags[route] = resp.headers['ETag']
+        if route == 'GET /job/submission':
+            self.submissions = resp.json()
+
+    def browse(self):
+        # the compare page: a submission's listing and one of its screenshots
+        for job in self.submissions[::-1]:
+            for path in job['workers'].values():
+                if path is None:
+                    continue
+                resp = self.call('GET /unzip/jobs/<path>', 'GET', f'/unzip/{path}')
+                if resp is not None and resp.status_code == 200 and resp.json():
+                    self.call('GET /unzip/jobs/<path>', 'GET', f'/unzip/{path}/{resp.json()[0]}')
+                return
+
+    def loop(self):
+        for step in self.steps:
+            self.step(step)
+        time.sleep(self.args.poll_sec)
+
+
+KINDS: dict[str, type[Actor]] = {
+    cls.kind: cls for cls in (SnapshotWorker, Analyzer, Poller)}
+
+
+def add_crons(baseapi: str, count: int, hours: float):
+    for i in range(count):
+        requests.post(f'{baseapi}/cron/form', allow_redirects=False, data=dict(
+            apikey=APIKEY, action='add', url=f'http://bench.invalid/{i}',
+            hours=str(hours), historySize='0', preRunJs='', wait='0', scrolltoJs='',
+            scrolltox='0', scrolltoy='0', checkReadyJs='', waitJs='0',
+        )).raise_for_status()
+
+
+def load_trace(path: Path) -> dict[tuple[str, str], list[tuple[float, str]]]:
+    actors: dict[tuple[str, str], list[tuple[float, str]]] = defaultdict(list)
+    with path.open('r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                step = json.loads(line)
+                actors[(step['kind'], step['actor'])].append((step['sec'], step['step']))
+    return actors
+
+
+def print_report(report: dict[str, Any]):
+    print(f'{"route":<28} {"requests":>9} {"errors":>7} {"rps":>8} {"p50 ms":>8} {"p99 ms":>8}')
+    for route, r in report['routes'].items():
+        print(f'{route:<28} {r["requests"]:>9} {r["errors"]:>7} {r["rps"]:>8.1f} '
+              f'{r["p50Ms"]:>8.1f} {r["p99Ms"]:>8.1f}')
+    print(f'[INFO] {report["requests"]} requests in {report["elapsedSec"]:.1f}s, '
+          f'{report["rps"]:.1f}/s, {report["errors"]} errors')
+    print(f'[INFO] {report["sentBytes"]/2**20:.1f} MiB sent, '
+          f'{report["receivedBytes"]/2**20:.1f} MiB received')
+    print(f'[INFO] {report["stateBytes"]/2**20:.1f} MiB left in the state directory'
+          + (f', {report["writtenBytes"]/2**20:.1f} MiB written to disk'
+             if report['writtenBytes'] is not None else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4,
+                        help='gunicorn processes')
+    parser.add_argument('--threads', type=int, default=32,
+                        help='gunicorn threads per process')
+    parser.add_argument('--snapshot-workers', type=int, default=4)
+    parser.add_argument('--analyzers', type=int, default=2)
+    parser.add_argument('--pollers', type=int, default=4)
+    parser.add_argument('--crons', type=int, default=10)
+    parser.add_argument('--cron-hours', type=float, default=.005,
+                        help='how often each cron is scheduled again')
+    parser.add_argument('--zip-kib', type=int, default=1024,
+                        help='size of each synthetic submission')
+    parser.add_argument('--files', type=int, default=8,
+                        help='screenshots per submission')
+    parser.add_argument('--reuse', type=float, default=0.,
+                        help='share of screenshots identical from one job to the next')
+    parser.add_argument('--delta', action='store_true',
+                        help='upload through /job/manifest, /blob and /job/commit, '
+                        'implies --blob-store')
+    parser.add_argument('--blob-store', action='store_true',
+                        help='run the server with BLOB_STORE=1')
+    parser.add_argument('--capture-sec', type=float, default=.5)
+    parser.add_argument('--analysis-sec', type=float, default=.5)
+    parser.add_argument('--poll-sec', type=float, default=5.)
+    parser.add_argument('--longpoll', type=float, default=5.)
+    parser.add_argument('--duration', type=float, default=60.)
+    parser.add_argument('--trace', type=Path,
+                        help='replay this recorded trace instead of the synthetic load')
+    parser.add_argument('--record', type=Path,
+                        help='write every request made to this trace')
+    parser.add_argument('--report', type=Path,
+                        help='also write the report as json')
+    parser.add_argument('--port', type=int, default=35797)
+    args = parser.parse_args()
+
+    server = Path(__file__).resolve().parent.joinpath('server-snpshtr.py')
+    baseapi = f'http://127.0.0.1:{args.port}'
+    with tempfile.TemporaryDirectory() as state:
+        Path(state).joinpath('apikey.txt').write_text(APIKEY, encoding='utf-8')
+        proc = subprocess.Popen([
+            sys.executable, '-m', 'gunicorn',
+            '--bind', f'127.0.0.1:{args.port}',
+            '--pythonpath', str(server.parent), '--chdir', state,
+            '--preload', '--workers', str(args.workers), '--threads', str(args.threads),
+            f'{server.stem}:app',
+        ], env={**os.environ, 'SCHEDULER_INTERVAL_SEC': '1',
+                **(dict(BLOB_STORE='1') if args.blob_store or args.delta else dict())},
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_server(baseapi, 30)
+            add_crons(baseapi, args.crons, args.cron_hours)
+            writtenBefore = written_bytes(proc.pid)
+            started = time.time()
+            recorder = Recorder(started, args.record)
+            if args.trace:
+                trace = load_trace(args.trace)
+                actors = [(KINDS[kind](name, baseapi, recorder, args), steps)
+                          for (kind, name), steps in trace.items()]
+                print(f'[INFO] Replaying {sum(map(len, trace.values()))} steps '
+                      f'from {len(actors)} actors')
+                with ThreadPoolExecutor(len(actors)) as pool:
+                    for f in [pool.submit(actor.replay, started, steps)
+                              for actor, steps in actors]:
+                        f.result()
+            else:
+                deadline = started+args.duration
+                actors = [
+                    *[SnapshotWorker(f'bench-w{i}', baseapi, recorder, args)
+                      for i in range(args.snapshot_workers)],
+                    *[Analyzer(f'bench-a{i}', baseapi, recorder, args)
+                      for i in range(args.analyzers)],
+                    *[Poller(f'bench-p{i}', baseapi, recorder, args)
+                      for i in range(args.pollers)],
+                ]
+                print(f'[INFO] Running {len(actors)} actors for {args.duration:.0f}s')
+                with ThreadPoolExecutor(len(actors)) as pool:
+                    for f in [pool.submit(actor.run, deadline) for actor in actors]:
+                        f.result()
+            elapsed = time.time()-started
+            recorder.close()
+            writtenAfter = written_bytes(proc.pid)
+            report = dict(
+                **recorder.report(elapsed),
+                stateBytes=dir_size(Path(state)),
+                writtenBytes=(writtenAfter-writtenBefore
+                              if writtenAfter is not None and writtenBefore is not None
+                              else None),
+            )
+        finally:
+            proc.terminate()
+            proc.wait()
+    print_report(report)
+    if args.report:
+        args.report.write_text(json.dumps(report, indent=4), encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+# Runs server-snpshtr.py under gunicorn against a throwaway state directory
+# seeded with the legacy JSON databases, then checks the edge cases of the
+# HTTP API one by one: what a client sends wrong must come back as a 4xx,
+# and what the server migrated or stored must read back the way it went in.
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import zipfile
+import zlib
+from io import BytesIO
+from pathlib import Path
+
+import requests
+
+APIKEY = 'check'
+WORKER = 'check-w'
+DAY_SEC = 86400
+
+
+def make_zip(files: dict[str, bytes]) -> bytes:
+    bio = BytesIO()
+    with zipfile.ZipFile(bio, mode='w') as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
+    return bio.getvalue()
+
+
+def make_png(width: int, height: int, decodable: bool = True) -> bytes:
+    # 8-bit greyscale; one that is not decodable has a header and no pixels
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (struct.pack('>I', len(data))+kind+data+
+                struct.pack('>I', zlib.crc32(kind+data)))
+    png = b'\x89PNG\r\n\x1a\n'+chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+    if decodable:
+        png += chunk(b'IDAT', zlib.compress((b'\x00'+b'\x80'*width)*height))
+    return png+chunk(b'IEND', b'')
+
+
+def wait_for_server(baseapi: str, timeout: float):
+    deadline = time.time()+timeout
+    while time.time() < deadline:
+        try:
+            requests.get(f'{baseapi}/', timeout=1).raise_for_status()
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(.2)
+    raise TimeoutError('server did not come up')
+
+
+def seed_legacy_state(state: Path, now: float, days: int):
+    # what a server from before SQLite left behind: one cron, a job per day
+    # with a submission on disk and a finished analysis for each
+    cron = dict(cronId=1, url='http://check.invalid/', hours=24., historySize=0.,
+                lastScheduledSec=now, preRunJs='', wait=0., scrolltoJs='',
+                scrolltox=0., scrolltoy=0., checkReadyJs='', waitJs=0.,
+                hideScrollbar=0)
+    jobs, anals = list(), list()
+    for jobId in range(1, days+1):
+        job = dict(cron, jobId=jobId, lastScheduledSec=now-(days-jobId+1)*DAY_SEC)
+        jobs.append(job)
+        workerzip = f'jobs/{jobId:020d}/{WORKER}.zip'
+        state.joinpath(workerzip).parent.mkdir(parents=True)
+        state.joinpath(workerzip).write_bytes(make_zip({
+            'job.json': json.dumps(job).encode(),
+            'shot.png': make_png(300, 700),
+            # past any pixel limit, only its header may ever be read
+            'huge.png': make_png(20000, 20000, decodable=False),
+        }))
+        anals.append(dict(
+            cronId=1, jobId=jobId, finished=True, assignee='check-a',
+            assigneeTime=now, completeness=1, workers={WORKER: workerzip},
+            analysisFile=None,
+            analysis=dict(indicators=dict(platform=dict(linux=float(jobId))))))
+    state.joinpath('ids.json').write_text(json.dumps(dict(cron=1, job=days)))
+    state.joinpath('crons.json').write_text(json.dumps([cron]))
+    state.joinpath('jobs.json').write_text(json.dumps(jobs))
+    state.joinpath('analysis.json').write_text(json.dumps(anals))
+    state.joinpath('uptime.json').write_text(json.dumps({WORKER: now}))
+
+
+def check_analysis_paging(baseapi: str) -> list[str]:
+    failures: list[str] = list()
+    for limit, expected in (('0', 200), ('-1', 200), ('abc', 400)):
+        resp = requests.get(f'{baseapi}/analysis?limit={limit}')
+        if resp.status_code != expected:
+            failures.append(f'/analysis?limit={limit}: {resp.status_code}, expected {expected}')
+        elif expected == 200 and len(resp.json()) != 1:
+            failures.append(f'/analysis?limit={limit}: {len(resp.json())} rows, expected 1')
+    return failures
+
+
+def check_revision_feeds(baseapi: str) -> list[str]:
+    failures: list[str] = list()
+    for path in ('/job', '/job/submission', '/analysis', '/uptime'):
+        resp = requests.get(f'{baseapi}{path}?since=abc')
+        if resp.status_code != 400:
+            failures.append(f'{path}?since=abc: {resp.status_code}, expected 400')
+        resp = requests.get(f'{baseapi}{path}?since=0')
+        if resp.status_code != 200 or 'revision' not in resp.json():
+            failures.append(f'{path}?since=0: {resp.status_code}, expected a delta')
+    return failures
+
+
+def check_long_poll_args(baseapi: str) -> list[str]:
+    failures: list[str] = list()
+    for path in ('/job/next', '/analysis/next'):
+        resp = requests.get(f'{baseapi}{path}?key={APIKEY}&worker=check-lp&longpoll=abc')
+        if resp.status_code != 400:
+            failures.append(f'{path}?longpoll=abc: {resp.status_code}, expected 400')
+    # every legacy analysis is finished, so there is nothing to wait for
+    started = time.time()
+    resp = requests.get(f'{baseapi}/analysis/next?key={APIKEY}&worker=check-lp&longpoll=-5')
+    if resp.status_code != 404 or time.time()-started > 5:
+        failures.append(f'/analysis/next?longpoll=-5: {resp.status_code} after '
+                        f'{time.time()-started:.1f}s, expected an immediate 404')
+    return failures
+
+
+def check_image_endpoints(baseapi: str) -> list[str]:
+    failures: list[str] = list()
+    zippath = f'jobs/{1:020d}/{WORKER}.zip'
+    for query, expected in (
+            (f'/thumb/{zippath}/shot.png?w=100', 200),
+            (f'/thumb/{zippath}/shot.png?w=abc', 400),
+            (f'/thumb/{zippath}/shot.png?h=abc', 400),
+            (f'/thumb/{zippath}/job.json', 415),
+            (f'/thumb/{zippath}/huge.png', 422),
+            (f'/tiles/{zippath}/shot.png', 200),
+            (f'/tiles/{zippath}/shot.png?z=2&x=1&y=2', 200),
+            (f'/tiles/{zippath}/shot.png?z=2&x=2&y=0', 404),
+            (f'/tiles/{zippath}/shot.png?z=abc&x=0&y=0', 400),
+            (f'/tiles/{zippath}/job.json', 415),
+            (f'/tiles/{zippath}/job.json?z=0&x=0&y=0', 415),
+            (f'/tiles/{zippath}/huge.png', 422),
+            (f'/tiles/{zippath}/huge.png?z=0&x=0&y=0', 422),
+    ):
+        resp = requests.get(f'{baseapi}{query}')
+        if resp.status_code != expected:
+            failures.append(f'{query}: {resp.status_code}, expected {expected}')
+    return failures
+
+
+def check_heartbeats_shared(baseapi: str) -> list[str]:
+    # a poll answered by one gunicorn worker is seen by all of them at once,
+    # and one ETag always stands for one body
+    failures: list[str] = list()
+    for _ in range(8):
+        requests.get(f'{baseapi}/analysis/next?key={APIKEY}&worker=check-hb')
+    time.sleep(.1)
+    # the first polls registered the analyzer, this one only says it is alive
+    started = time.time()
+    requests.get(f'{baseapi}/analysis/next?key={APIKEY}&worker=check-hb')
+    bodies: dict[str, str] = dict()
+    for _ in range(16):
+        resp = requests.get(f'{baseapi}/uptime2')
+        if resp.json().get('check-hb', 0) < started:
+            failures.append('/uptime2: check-hb is older than its last poll')
+        if bodies.setdefault(resp.headers['ETag'], resp.text) != resp.text:
+            failures.append(f'/uptime2: two bodies under ETag {resp.headers["ETag"]}')
+    return failures
+
+
+def add_cron(baseapi: str):
+    requests.post(f'{baseapi}/cron/form', allow_redirects=False, data=dict(
+        apikey=APIKEY, action='add', url='http://check.invalid/new',
+        hours='24', historySize='0', preRunJs='', wait='0', scrolltoJs='',
+        scrolltox='0', scrolltoy='0', checkReadyJs='', waitJs='0',
+    )).raise_for_status()
+
+
+def claim_job(baseapi: str, worker: str) -> int:
+    resp = requests.get(f'{baseapi}/job/next?key={APIKEY}&worker={worker}&longpoll=30')
+    resp.raise_for_status()
+    return resp.json()['jobId']
+
+
+def check_downloadable(baseapi: str, state: Path, jobId: int, worker: str,
+                       files: dict[str, bytes]) -> list[str]:
+    # nginx.conf sends /jobs to the app, so what the app answers there is
+    # what the analyzer gets; the zip itself must not be needed on disk
+    path = f'jobs/{jobId:020d}/{worker}.zip'
+    failures: list[str] = list()
+    if state.joinpath(path).exists():
+        failures.append(f'{path}: still on disk, expected only blobs')
+    resp = requests.get(f'{baseapi}/{path}')
+    if resp.status_code != 200:
+        return failures+[f'/{path}: {resp.status_code}, expected 200']
+    with zipfile.ZipFile(BytesIO(resp.content)) as zf:
+        if {zi.filename: zf.read(zi) for zi in zf.infolist()} != files:
+            failures.append(f'/{path}: members differ from the upload')
+    return failures
+
+
+def check_submission_downloads(baseapi: str, state: Path) -> list[str]:
+    failures: list[str] = list()
+    workers = ['check-zip', 'check-delta']
+    for worker in workers:
+        requests.get(f'{baseapi}/job/next?key={APIKEY}&worker={worker}')
+    time.sleep(2)
+    add_cron(baseapi)
+    files = {'a.png': os.urandom(1024), 'b.png': os.urandom(2048)}
+    jobId = claim_job(baseapi, 'check-zip')
+    bio = BytesIO()
+    with zipfile.ZipFile(bio, mode='w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, b in files.items():
+            zf.writestr(name, b)
+    b = bio.getvalue()
+    # timings that are not durations are dropped, the upload still counts
+    requests.post(
+        f'{baseapi}/job?key={APIKEY}&worker=check-zip&jobId={jobId}'
+        f'&sha256={hashlib.sha256(b).hexdigest()}&captureSec=abc&waitSec=%7B',
+        headers={'content-type': 'application/zip'}, data=b).raise_for_status()
+    failures.extend(check_downloadable(baseapi, state, jobId, 'check-zip', files))
+
+    # the way the screenshotters submit: manifest, missing blobs, commit
+    jobId = claim_job(baseapi, 'check-delta')
+    query = f'key={APIKEY}&worker=check-delta&jobId={jobId}'
+    manifest = {name: hashlib.sha256(b).hexdigest() for name, b in files.items()}
+    files['c.png'] = os.urandom(512)
+    manifest['c.png'] = hashlib.sha256(files['c.png']).hexdigest()
+    resp = requests.post(f'{baseapi}/job/manifest?{query}', json=manifest)
+    resp.raise_for_status()
+    if resp.json()['missing'] != [manifest['c.png']]:
+        failures.append(f'/job/manifest: missing {resp.json()["missing"]}, expected only c.png')
+    by_hash = {manifest[name]: b for name, b in files.items()}
+    for h in resp.json()['missing']:
+        requests.put(f'{baseapi}/blob/{h}?key={APIKEY}', data=by_hash[h]).raise_for_status()
+    waits = urllib.parse.quote(json.dumps(dict(ready='abc', settle=-1, stable=.5)))
+    requests.post(f'{baseapi}/job/commit?{query}&captureSec=nan&waitSec={waits}',
+                  json=manifest).raise_for_status()
+    failures.extend(check_downloadable(baseapi, state, jobId, 'check-delta', files))
+
+    details = requests.get(f'{baseapi}/uptime/details').json()
+    for worker, expected in (('check-zip', {}), ('check-delta', dict(waitSec=dict(stable=.5)))):
+        timings = {k: v for k, v in details[worker].items() if k in ('captureSec', 'waitSec')}
+        if timings != expected:
+            failures.append(f'/uptime/details: {worker} timings {timings}, expected {expected}')
+    return failures
+
+
+def check_nginx_layout(srvconfig: Path) -> list[str]:
+    # state directories may only be reached through the app, or through
+    # internal locations the app redirects to
+    failures: list[str] = list()
+    for conf in sorted(srvconfig.glob('nginx*.conf')):
+        for location, body in re.findall(r'location\s+(\S+)\s*\{(.*?)\n\s*\}', conf.read_text(), re.S):
+            if (re.search(r'alias\s+\{path\}/(jobs|blobs|derivatives)\b', body) and
+                    not re.search(r'^\s*internal;', body, re.M)):
+                failures.append(f'{conf.name}: location {location} serves state from disk')
+    # and the shipped unit must turn the redirects on, or every download is
+    # streamed by a gunicorn thread
+    accel = re.search(r'^Environment=ACCEL_REDIRECT=(\S+)$',
+                      srvconfig.joinpath('systemd.service').read_text(), re.M)
+    if accel is None:
+        return failures+['systemd.service: ACCEL_REDIRECT is not set']
+    locations = dict(re.findall(r'location\s+(\S+)\s*\{(.*?)\n\s*\}',
+                                srvconfig.joinpath('nginx.conf').read_text(), re.S))
+    for folder in ('jobs', 'blobs', 'derivatives'):
+        location = f'{accel.group(1).rstrip("/")}/{folder}/'
+        if not re.search(r'^\s*internal;', locations.get(location, ''), re.M):
+            failures.append(f'nginx.conf: no internal location {location}')
+    return failures
+
+
+def check_gc_keeps_inflight_temp(server: Path, state: Path) -> list[str]:
+    # make gc runs next to a live server, whose uploads are still streaming
+    inflight = state.joinpath('inflight.temp')
+    inflight.write_bytes(b'still arriving')
+    subprocess.run([sys.executable, str(server), 'gc'], cwd=state, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return [] if inflight.exists() else ['server-snpshtr.py gc: removed a fresh upload temp file']
+
+
+def check_legacy_import(baseapi: str, now: float, days: int) -> list[str]:
+    failures: list[str] = list()
+    anals = requests.get(f'{baseapi}/analysis?from=0&limit={days}').json()
+    if len(anals) != days:
+        failures.append(f'/analysis?from=0: {len(anals)} legacy analyses, expected {days}')
+    expected = [float(jobId) for jobId in range(1, days+1)]
+    # the whole history from the raw points, then a range long enough to be
+    # read from the day rollups
+    for query in ('', f'?from={now-60*DAY_SEC}&to={now}'):
+        trend = requests.get(f'{baseapi}/cron/1/trend{query}').json()
+        values = [value for _, value, _ in trend['series'].get('platform', {}).get('linux', [])]
+        if values != expected:
+            failures.append(f'/cron/1/trend{query}: {values}, expected {expected}')
+    return failures
+
+
+def check_trend_args(baseapi: str) -> list[str]:
+    failures: list[str] = list()
+    for query in ('from=abc', 'to=abc', 'points=abc', 'from=inf', 'to=nan'):
+        resp = requests.get(f'{baseapi}/cron/1/trend?{query}')
+        if resp.status_code != 400:
+            failures.append(f'/cron/1/trend?{query}: {resp.status_code}, expected 400')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=2,
+                        help='gunicorn processes')
+    parser.add_argument('--days', type=int, default=5,
+                        help='legacy jobs to migrate, one per day')
+    parser.add_argument('--port', type=int, default=35797)
+    args = parser.parse_args()
+
+    server = Path(__file__).resolve().parent.joinpath('server-snpshtr.py')
+    baseapi = f'http://127.0.0.1:{args.port}'
+    failures: list[str] = list()
+    now = time.time()
+    with tempfile.TemporaryDirectory() as state:
+        Path(state).joinpath('apikey.txt').write_text(APIKEY, encoding='utf-8')
+        seed_legacy_state(Path(state), now, args.days)
+        proc = subprocess.Popen([
+            sys.executable, '-m', 'gunicorn',
+            '--bind', f'127.0.0.1:{args.port}',
+            '--pythonpath', str(server.parent), '--chdir', state,
+            '--preload', '--workers', str(args.workers), '--threads', '4',
+            f'{server.stem}:app',
+        ], env={**os.environ, 'SCHEDULER_INTERVAL_SEC': '.5', 'METRICS_FLUSH_SEC': '1',
+                'BLOB_STORE': '1'},
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_server(baseapi, 30)
+            for name, found in (
+                    ('legacy import', check_legacy_import(baseapi, now, args.days)),
+                    ('analysis paging', check_analysis_paging(baseapi)),
+                    ('trend arguments', check_trend_args(baseapi)),
+                    ('revision feeds', check_revision_feeds(baseapi)),
+                    ('long-poll arguments', check_long_poll_args(baseapi)),
+                    ('image endpoints', check_image_endpoints(baseapi)),
+                    ('heartbeats across processes', check_heartbeats_shared(baseapi)),
+                    ('submission downloads', check_submission_downloads(baseapi, Path(state))),
+                    ('nginx layout', check_nginx_layout(server.parent.joinpath('srvconfig'))),
+                    ('gc next to a live server', check_gc_keeps_inflight_temp(server, Path(state))),
+            ):
+                print(f'[INFO] {name}: {len(found)} failures')
+                failures.extend(found)
+        finally:
+            proc.terminate()
+            proc.wait()
+    for failure in failures:
+        print(f'[FAIL] {failure}')
+    if failures:
+        sys.exit(1)
+    print('[INFO] All checks passed')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,31 @@
 #!/usr/bin/env python3
 # -*- encoding: utf-8 -*-
 
+import atexit
+import functools
 import hashlib
 import importlib
-from io import BytesIO
 import json
+import os
 from pathlib import Path
+import queue
 import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import traceback
-import PIL.Image
+import uuid
+import urllib.parse
+from concurrent.futures import Future
+from typing import Any, BinaryIO, Callable
 import requests
 import time
 import zipfile
-from playwright.sync_api import sync_playwright, Browser, Page
+from playwright.sync_api import sync_playwright, Browser, Page, Playwright
+from playwright.sync_api import Error as PlaywrightError
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
 
 
 TEST_W, TEST_H = 800, 600
@@ -23,6 +34,64 @@ BASEAPI = Path('baseapi.txt').read_text(encoding='utf-8').strip()
 APIKEY = Path('apikey.txt').read_text(encoding='utf-8').strip()
 UPDURL = Path('updurl.txt').read_text(encoding='utf-8').strip()
 
+LONG_POLL_SEC = 50
+# large bodies go up in chunks of this size and survive dropped connections
+UPLOAD_CHUNK_BYTES = 8*2**20
+UPLOAD_RETRIES = 5
+# jobs run in browsers kept open between jobs, each job in fresh contexts;
+# browsers are relaunched after this many jobs or once disconnected.
+# BROWSER_POOL=0 launches them per job in a subprocess instead, as does a
+# pooled job whose browser crashed
+BROWSER_POOL = os.environ.get('BROWSER_POOL', '1') != '0'
+BROWSER_RECYCLE_JOBS = int(os.environ.get('BROWSER_RECYCLE_JOBS', '50'))
+# browsers capture a job at the same time, as many as there are cores and
+# BROWSER_CAPTURE_BYTES of available memory for; CAPTURE_CONCURRENCY overrides
+CAPTURE_CONCURRENCY = int(os.environ.get('CAPTURE_CONCURRENCY', '0'))
+BROWSER_CAPTURE_BYTES = 2**30
+# with more than one, each browser loads the page this many times at once,
+# in contexts already sized to their resolution, instead of resizing one page
+VIEWPORT_PAGES = int(os.environ.get('VIEWPORT_PAGES', '1'))
+# waitJs and wait are upper bounds: pages are captured as soon as they are
+# ready and their pixels stop changing; FIXED_WAITS=1 sleeps them in full
+FIXED_WAITS = os.environ.get('FIXED_WAITS', '') == '1'
+# no new resource for this long counts as network idle
+NETWORK_QUIET_SEC = .5
+# consecutive screenshots this far apart must match to count as stable
+STABLE_FRAME_SEC = .1
+# screenshots waiting to be spooled and sent before the browsers block, and
+# how much of the spooled zip stays in memory before it moves to disk
+PIPELINE_DEPTH = 8
+SPOOL_MEMORY_BYTES = 64*2**20
+
+# resolves true once fonts are loaded, images decoded, no resource was
+# fetched for quietMs and two animation frames went by, or false on timeout
+PAGE_READY_JS = '''
+async (timeoutMs, quietMs) => {
+    const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+    const frame = () => new Promise((resolve) => requestAnimationFrame(() => resolve()));
+    const settle = async () => {
+        performance.setResourceTimingBufferSize(100000);
+        if (document.fonts) {
+            await document.fonts.ready;
+        }
+        await Promise.all(Array.from(document.images)
+            .filter((im) => im.complete || im.loading !== 'lazy')
+            .map((im) => im.decode().catch(() => null)));
+        let seen = -1;
+        while (seen !== performance.getEntriesByType('resource').length) {
+            seen = performance.getEntriesByType('resource').length;
+            await sleep(quietMs);
+        }
+        await frame();
+        await frame();
+        return true;
+    };
+    return Promise.race([settle(), sleep(timeoutMs).then(() => false)]);
+}
+'''.strip()
+# clients update themselves file by file, so the file hash is the version
+VERSION = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:12]
+
 HOSTNAME = socket.gethostname()
 HOSTNAME = {'linux-docker': 'snpshtr-docker'}.get(HOSTNAME, HOSTNAME)
 if Path('hostname_override.txt').is_file():
@@ -59,76 +128,532 @@ def run_hide_scrollbar(browser: Page):
     )
 
 
-def run_job(browsers: list[tuple[str, Page]],
-            resolutions_spec: list[tuple[str, tuple[int, int]]],
-            jobId: int,
-            hideScrollbar: bool,
-            wait: float,
-            scrolltoJs: str,
-            scrolltox: int,
-            scrolltoy: int,
-            preRunJs: str,
-            waitJs: float,
-            checkReadyJs: str,
-            url: str):
-    bio = BytesIO()
-    zf = zipfile.ZipFile(
-        bio, mode='w', compression=zipfile.ZIP_DEFLATED, compresslevel=9)
-    for browser_name, browser in browsers:
-        browser.goto('about:blank')
-        browser.set_viewport_size(dict(width=TEST_W, height=TEST_H))
-        actual_w, actual_h = PIL.Image.open(
-            BytesIO(browser.screenshot())).size
+def resumable_upload(fp: BinaryIO, size: int) -> str | None:
+    # sends fp to /upload in chunks and, when the connection drops, resumes
+    # from what reached the server; None when the server has no /upload
+    uploadId = uuid.uuid4().hex
+    url = f'{BASEAPI}/upload/{uploadId}?key={APIKEY}'
+    for attempt in range(UPLOAD_RETRIES):
+        try:
+            offset = 0
+            if attempt:
+                resp = requests.get(url)
+                resp.raise_for_status()
+                offset = resp.json()['offset']
+            while True:
+                fp.seek(offset)
+                resp = requests.put(
+                    f'{url}&offset={offset}', data=fp.read(UPLOAD_CHUNK_BYTES),
+                    headers={'content-type': 'application/octet-stream'})
+                if resp.status_code == 404:
+                    return None
+                if resp.status_code == 409:
+                    # a previous attempt is still being written, or the
+                    # server has a different idea of where it stopped
+                    time.sleep(1)
+                else:
+                    resp.raise_for_status()
+                offset = resp.json()['offset']
+                if offset >= size:
+                    return uploadId
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            print(f'[WARN] Upload {uploadId} interrupted: {e}')
+            time.sleep(2**attempt)
+    raise requests.exceptions.ConnectionError(
+        f'Upload {uploadId} did not get through after {UPLOAD_RETRIES} attempts')
+
+
+def png_size(b: bytes) -> tuple[int, int]:
+    # width and height from the IHDR chunk, without decoding the pixels
+    if b[:8] != b'\x89PNG\r\n\x1a\n' or b[12:16] != b'IHDR':
+        return (0, 0)
+    return struct.unpack('>II', b[16:24])
+
+
+class ResultSink:
+    # screenshots and failures of the browsers capturing one job at once;
+    # screenshots are checked, hashed and spooled by a thread of their own
+    # while the browsers go on capturing; once the last of them finishes,
+    # one manifest tells which of them the server lacks, only those are
+    # sent and the manifest is committed
+    def __init__(self, jobId: int) -> None:
+        self.jobId = jobId
+        self.errors: dict[str, BaseException] = dict()
+        # seconds spent waiting, per phase, summed over browsers
+        self.waits: dict[str, float] = dict()
+        self.lock = threading.Lock()
+        self.query = f'key={APIKEY}&worker={HOSTNAME}&version={VERSION}&jobId={jobId}'
+        self.manifest: dict[str, str] = dict()
+        self.uploaded = 0
+        self.failure: BaseException | None = None
+        # PNGs do not deflate any further, entries are stored as they are
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+        self.zf = zipfile.ZipFile(
+            self.spool, mode='w', compression=zipfile.ZIP_STORED)
+        self.queue: queue.Queue[tuple[str, bytes, int, int] | None] = queue.Queue(
+            maxsize=PIPELINE_DEPTH)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def add(self, name: str, scrsht: bytes, width: int, height: int = 0):
+        # blocks while the stage is PIPELINE_DEPTH screenshots behind
+        self.queue.put((name, scrsht, width, height))
+
+    def fail(self, browser_name: str, e: BaseException):
+        with self.lock:
+            self.errors[browser_name] = e
+
+    def waited(self, phase: str, sec: float):
+        with self.lock:
+            self.waits[phase] = self.waits.get(phase, 0.)+sec
+
+    def serve(self):
+        while (item := self.queue.get()) is not None:
+            if self.failure is not None:
+                # keep draining, the browsers must not block on a dead stage
+                continue
+            try:
+                self.store(*item)
+            except Exception as e:
+                self.failure = e
+
+    def store(self, name: str, scrsht: bytes, width: int, height: int):
+        actual_w, actual_h = png_size(scrsht)
+        if actual_w != width or (height and actual_h != height):
+            return
+        self.zf.writestr(name, scrsht)
+        self.manifest[name] = hashlib.sha256(scrsht).hexdigest()
+
+    def put_blobs(self, hashes: list[str]):
+        names = {h: name for name, h in self.manifest.items()}
+        with zipfile.ZipFile(self.spool) as zf:
+            for h in hashes:
+                requests.put(f'{BASEAPI}/blob/{h}?key={APIKEY}', data=zf.read(names[h]),
+                             headers={'content-type': 'application/octet-stream'}
+                             ).raise_for_status()
+                self.uploaded += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.zf.close()
+
+    def discard(self):
+        self.spool.close()
+
+    @property
+    def count(self) -> int:
+        return len(self.manifest)
+
+    def upload(self, captureSec: float):
+        timing = (f'captureSec={captureSec:.3f}&waitSec='
+                  + urllib.parse.quote(json.dumps({k: round(v, 3) for k, v in self.waits.items()})))
+        if self.failure is not None:
+            raise self.failure
+        resp = requests.post(f'{BASEAPI}/job/manifest?{self.query}', json=self.manifest)
+        if resp.status_code == 404:
+            # a server without a blob store takes the whole zip
+            self.upload_zip(timing)
+            return
+        resp.raise_for_status()
+        missing = resp.json()['missing']
+        for _ in range(3):
+            self.put_blobs(missing)
+            resp = requests.post(
+                f'{BASEAPI}/job/commit?{self.query}&{timing}', json=self.manifest)
+            if resp.status_code != 409:
+                break
+            # collected on the server in the meantime, send them again
+            missing = resp.json()['missing']
+        resp.raise_for_status()
+        print(f'[INFO] Uploaded {self.uploaded} of {self.count} screenshots '
+              f'for job {self.jobId}')
+
+    def upload_zip(self, timing: str):
+        # streamed from the spool
+        m = hashlib.sha256()
+        self.spool.seek(0)
+        while chunk := self.spool.read(2**20):
+            m.update(chunk)
+        size = self.spool.tell()
+        self.spool.seek(0)
+        h = m.hexdigest()
+        if (uploadId := resumable_upload(self.spool, size)) is not None:
+            requests.post(
+                f'{BASEAPI}/job?{self.query}&sha256={h}&{timing}&uploadId={uploadId}'
+            ).raise_for_status()
+        else:
+            self.spool.seek(0)
+            requests.post(
+                f'{BASEAPI}/job?{self.query}&sha256={h}&{timing}',
+                headers={'content-type': 'application/zip',
+                         'content-length': str(size)},
+                data=self.spool).raise_for_status()
+        print(f'[INFO] Uploaded results for job {self.jobId} successfully')
+
+
+def wait_until_ready(pages: list[Page], sink: ResultSink, phase: str, timeout: float):
+    # the readiness script is started in every page before any of them is
+    # awaited, so pages loading side by side share one wait of timeout
+    started = time.time()
+    if FIXED_WAITS:
+        time.sleep(timeout)
+    elif timeout > 0:
+        if phase == 'ready':
+            # a page that keeps polling never goes idle: networkidle gets half
+            # of the budget, the readiness script the rest of it
+            idle_deadline = started+timeout/2
+            for page in pages:
+                try:
+                    page.wait_for_load_state('networkidle', timeout=max(
+                        1, (idle_deadline-time.time())*1000))
+                except PlaywrightTimeoutError:
+                    pass
+        for page in pages:
+            try:
+                page.evaluate(
+                    f'([timeoutMs, quietMs]) => {{ window.__snpshtrReady = '
+                    f'({PAGE_READY_JS})(timeoutMs, quietMs); }}',
+                    [max(0, int((started+timeout-time.time())*1000)),
+                     int(NETWORK_QUIET_SEC*1000)])
+            except PlaywrightError as e:
+                print(f'[WARN] Could not wait for the page to be ready: {e}')
+        for page in pages:
+            try:
+                page.evaluate('() => window.__snpshtrReady')
+            except PlaywrightError as e:
+                print(f'[WARN] Could not wait for the page to be ready: {e}')
+    sink.waited(phase, time.time()-started)
+
+
+def stable_screenshot(page: Page, sink: ResultSink, timeout: float,
+                      settled: bool = False) -> bytes:
+    # the page settles within timeout, then the last of two identical
+    # consecutive screenshots is the capture
+    deadline = time.time()+timeout
+    if not settled:
+        wait_until_ready([page], sink, 'settle', timeout)
+    started = time.time()
+    scrsht = page.screenshot()
+    while not FIXED_WAITS and time.time()+STABLE_FRAME_SEC < deadline:
+        time.sleep(STABLE_FRAME_SEC)
+        previous, scrsht = scrsht, page.screenshot()
+        if scrsht == previous:
+            break
+    sink.waited('stable', time.time()-started)
+    return scrsht
+
+
+def available_memory() -> int | None:
+    try:
+        for line in Path('/proc/meminfo').read_text().splitlines():
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1])*1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def capture_concurrency(count: int) -> int:
+    if CAPTURE_CONCURRENCY > 0:
+        return max(1, min(count, CAPTURE_CONCURRENCY))
+    limit = os.cpu_count() or 1
+    memory = available_memory()
+    if memory is not None:
+        limit = min(limit, memory//BROWSER_CAPTURE_BYTES)
+    return max(1, min(count, limit))
+
+
+class BrowserThread:
+    # the sync API binds a browser to the thread that launched it, so every
+    # browser gets a thread of its own and is only driven through submit
+    def __init__(self, browser_name: str, launch: Callable[[Playwright], Browser]) -> None:
+        self.browser_name = browser_name
+        self.launch = launch
+        self.tasks: queue.Queue[tuple[Callable[[Browser], Any], Future] | None] = queue.Queue()
+        launched: Future = Future()
+        self.thread = threading.Thread(target=self.serve, args=(launched,), daemon=True)
+        self.thread.start()
+        launched.result()
+
+    def serve(self, launched: Future):
+        try:
+            with sync_playwright() as p:
+                browser = self.launch(p)
+                launched.set_result(None)
+                while (task := self.tasks.get()) is not None:
+                    fn, future = task
+                    try:
+                        future.set_result(fn(browser))
+                    except BaseException as e:
+                        future.set_exception(e)
+                browser.close()
+        except BaseException as e:
+            if not launched.done():
+                launched.set_exception(e)
+            else:
+                print(traceback.format_exc())
+
+    def submit(self, fn: Callable[[Browser], Any]) -> Future:
+        future: Future = Future()
+        if not self.thread.is_alive():
+            future.set_exception(PlaywrightError(f'{self.browser_name} is gone'))
+        else:
+            self.tasks.put((fn, future))
+        return future
+
+    def close(self):
+        if self.thread.is_alive():
+            self.tasks.put(None)
+            self.thread.join(30)
+
+
+def capture_browser(browser_name: str,
+                    browser: Browser,
+                    sink: ResultSink,
+                    resolutions_spec: list[tuple[str, tuple[int, int]]],
+                    hideScrollbar: bool,
+                    wait: float,
+                    scrolltoJs: str,
+                    scrolltox: int,
+                    scrolltoy: int,
+                    preRunJs: str,
+                    waitJs: float,
+                    checkReadyJs: str,
+                    url: str):
+    if VIEWPORT_PAGES > 1:
+        for i in range(0, len(resolutions_spec), VIEWPORT_PAGES):
+            capture_viewports(
+                browser_name, browser, sink, resolutions_spec[i:i+VIEWPORT_PAGES],
+                hideScrollbar, wait, scrolltoJs, scrolltox, scrolltoy, preRunJs, waitJs,
+                checkReadyJs, url)
+        return
+    # a fresh context is a fresh profile: no cookies, storage or cache
+    context = browser.new_context()
+    try:
+        page = context.new_page()
+        page.goto('about:blank')
+        page.set_viewport_size(dict(width=TEST_W, height=TEST_H))
+        actual_w, actual_h = png_size(page.screenshot())
         compensation_w, compensation_h = TEST_W-actual_w, TEST_H-actual_h
-        browser.goto(url)
+        page.goto(url)
         if hideScrollbar:
-            run_hide_scrollbar(browser)
-        browser.evaluate(preRunJs)
-        time.sleep(waitJs)
+            run_hide_scrollbar(page)
+        page.evaluate(preRunJs)
+        wait_until_ready([page], sink, 'ready', waitJs)
         if checkReadyJs:
-            while (waitReady := browser.evaluate(checkReadyJs)) > 0:
+            started = time.time()
+            while (waitReady := page.evaluate(checkReadyJs)) > 0:
                 time.sleep(waitReady)
+            sink.waited('checkReady', time.time()-started)
         for resolution_name, (resw, resh) in resolutions_spec:
-            browser.set_viewport_size(
+            page.set_viewport_size(
                 dict(width=resw+compensation_w, height=resh+compensation_h))
             if scrolltoJs:
-                browser.evaluate(scrolltoJs)
+                page.evaluate(scrolltoJs)
+            else:
+                page.evaluate(
+                    f'window.scrollTo({scrolltox}, {scrolltoy})')
+            if hideScrollbar:
+                run_hide_scrollbar(page)
+            scrsht = stable_screenshot(page, sink, wait)
+            sink.add(
+                f'{PLATFORM}.{HOSTNAME}.{browser_name}.{resolution_name}.partial.png',
+                scrsht, resw, resh)
+            del scrsht
+    finally:
+        context.close()
+
+
+def capture_viewports(browser_name: str,
+                      browser: Browser,
+                      sink: ResultSink,
+                      resolutions_spec: list[tuple[str, tuple[int, int]]],
+                      hideScrollbar: bool,
+                      wait: float,
+                      scrolltoJs: str,
+                      scrolltox: int,
+                      scrolltoy: int,
+                      preRunJs: str,
+                      waitJs: float,
+                      checkReadyJs: str,
+                      url: str):
+    # one context per resolution, laid out at its final size from the start;
+    # navigations only wait for the response so that all pages load at once
+    pages = [(resolution_name, (resw, resh), browser.new_context(
+        viewport=dict(width=resw, height=resh)).new_page())
+        for resolution_name, (resw, resh) in resolutions_spec]
+    try:
+        for _, _, page in pages:
+            page.goto(url, wait_until='commit')
+        for _, _, page in pages:
+            page.wait_for_load_state('load')
+            if hideScrollbar:
+                run_hide_scrollbar(page)
+            page.evaluate(preRunJs)
+        wait_until_ready([page for _, _, page in pages], sink, 'ready', waitJs)
+        if checkReadyJs:
+            started = time.time()
+            for _, _, page in pages:
+                while (waitReady := page.evaluate(checkReadyJs)) > 0:
+                    time.sleep(waitReady)
+            sink.waited('checkReady', time.time()-started)
+        for _, _, page in pages:
+            if scrolltoJs:
+                page.evaluate(scrolltoJs)
             else:
-                browser.evaluate(
+                page.evaluate(
                     f'window.scrollTo({scrolltox}, {scrolltoy})')
             if hideScrollbar:
-                run_hide_scrollbar(browser)
-            time.sleep(wait)
-            # if hasattr(browser, 'get_full_page_screenshot_as_png'):
-            #     zf.writestr(
-            #         f'{PLATFORM}.{HOSTNAME}.{browser_name}.{resolution_name}.full.png',
-            #         browser.screenshot()
-            #     )
-            scrsht = browser.screenshot()
-            im = PIL.Image.open(BytesIO(scrsht))
-            if im.size == (resw, resh):
-                zf.writestr(
-                    f'{PLATFORM}.{HOSTNAME}.{browser_name}.{resolution_name}.partial.png',
-                    scrsht
-                )
-            del im
+                run_hide_scrollbar(page)
+        deadline = time.time()+wait
+        wait_until_ready([page for _, _, page in pages], sink, 'settle', wait)
+        for resolution_name, (resw, resh), page in pages:
+            scrsht = stable_screenshot(
+                page, sink, max(0., deadline-time.time()), settled=True)
+            sink.add(
+                f'{PLATFORM}.{HOSTNAME}.{browser_name}.{resolution_name}.partial.png',
+                scrsht, resw, resh)
             del scrsht
-        browser.goto('about:blank')
-    zf.close()
-    b = bio.getvalue()
-    m = hashlib.sha256()
-    m.update(b)
-    h = m.hexdigest()
-    requests.post(
-        f'{BASEAPI}/job?key={APIKEY}&worker={HOSTNAME}&jobId={jobId}&sha256={h}',
-        headers={'content-type': 'application/zip',
-                 'content-length': str(len(b))},
-        data=b).raise_for_status()
-    # Path(f'{PLATFORM}.{jobId:012d}.zip').write_bytes(bio.getvalue())
-    print(f'[INFO] Uploaded results for job {jobId} successfully')
-    del zf
-    del bio
-    del b
+    finally:
+        for _, _, page in pages:
+            page.context.close()
+
+
+def run_job(browsers: list[BrowserThread],
+            resolutions_spec: list[tuple[str, tuple[int, int]]],
+            jobId: int,
+            hideScrollbar: bool,
+            wait: float,
+            scrolltoJs: str,
+            scrolltox: int,
+            scrolltoy: int,
+            preRunJs: str,
+            waitJs: float,
+            checkReadyJs: str,
+            url: str):
+    # every browser captures on its own thread; one that fails costs its
+    # own screenshots only, the job fails when none of them got through
+    started = time.time()
+    sink = ResultSink(jobId)
+    slots = threading.BoundedSemaphore(capture_concurrency(len(browsers)))
+
+    def capture(browser_name: str, browser: Browser):
+        with slots:
+            capture_browser(
+                browser_name, browser, sink, resolutions_spec, hideScrollbar, wait,
+                scrolltoJs, scrolltox, scrolltoy, preRunJs, waitJs, checkReadyJs, url)
+    futures = [(browser.browser_name, browser.submit(functools.partial(capture, browser.browser_name)))
+               for browser in browsers]
+    for browser_name, future in futures:
+        if (e := future.exception()) is not None:
+            print(f'[ERROR] {browser_name} failed on job {jobId}:')
+            print(''.join(traceback.format_exception(e)))
+            sink.fail(browser_name, e)
+    try:
+        sink.close()
+        if not sink.count and sink.errors:
+            raise next(iter(sink.errors.values()))
+        print('[INFO] Waited ' + ', '.join(
+            f'{sec:.1f}s for {phase}' for phase, sec in sink.waits.items()))
+        sink.upload(time.time()-started)
+    finally:
+        sink.discard()
+
+
+def read_resolutions_spec() -> list[tuple[str, tuple[int, int]]]:
+    return [
+        (str(n), (int(v.split('x')[0]), int(v.split('x')[1])))
+        for n, v in json.loads(Path('resolutions.json').read_text(
+            encoding='utf-8'))['resolutions']]
+
+
+def launch_browsers() -> list[BrowserThread]:
+    browsers: list[BrowserThread] = list()
+    try:
+        for browser_name, launch in [
+                ('chrome', lambda p: p.chromium.launch()),
+                ('firefox', lambda p: p.firefox.launch()),
+                ('webkit', lambda p: p.webkit.launch())]:
+            browsers.append(BrowserThread(browser_name, launch))
+    except BaseException:
+        close_browsers(browsers)
+        raise
+    return browsers
+
+
+def close_browsers(browsers: list[BrowserThread]):
+    for browser in browsers:
+        try:
+            browser.close()
+        except Exception:
+            print(traceback.format_exc())
+
+
+class BrowserPool:
+    def __init__(self) -> None:
+        self.browsers: list[BrowserThread] = list()
+        self.jobs = 0
+        self.version = VERSION
+        atexit.register(self.close)
+
+    def healthy(self) -> bool:
+        try:
+            return bool(self.browsers) and all(
+                browser.submit(lambda b: b.is_connected()).result(30)
+                for browser in self.browsers)
+        except Exception:
+            return False
+
+    def acquire(self) -> list[BrowserThread]:
+        if self.jobs >= BROWSER_RECYCLE_JOBS or not self.healthy():
+            self.close()
+            print('[INFO] Launching browsers')
+            self.browsers = launch_browsers()
+        self.jobs += 1
+        return self.browsers
+
+    def close(self):
+        close_browsers(self.browsers)
+        self.browsers = list()
+        self.jobs = 0
+
+
+# kept across the reloads done by self_update
+POOL: BrowserPool | None = globals().get('POOL')
+
+
+def pooled_run_job(
+    jobId: int,
+    hideScrollbar: bool,
+    wait: float,
+    scrolltoJs: str,
+    scrolltox: int,
+    scrolltoy: int,
+    preRunJs: str,
+    waitJs: float,
+    checkReadyJs: str,
+    url: str,
+):
+    global POOL
+    if POOL is not None and POOL.version != VERSION:
+        # launched by the code before the last self update
+        POOL.close()
+        POOL = None
+    if POOL is None:
+        POOL = BrowserPool()
+    args = (jobId, hideScrollbar, wait, scrolltoJs, scrolltox, scrolltoy,
+            preRunJs, waitJs, checkReadyJs, url)
+    try:
+        run_job(POOL.acquire(), read_resolutions_spec(), *args)
+    except PlaywrightError:
+        print(traceback.format_exc())
+        print('[WARN] Browser failed, relaunching the pool and running the job in a subprocess')
+        POOL.close()
+        subprocess_run_job(*args)
 
 
 def initialize_and_run_job(
@@ -143,17 +668,12 @@ def initialize_and_run_job(
     checkReadyJs: str,
     url: str,
 ):
-    resolutions_spec = [
-        (str(n), (int(v.split('x')[0]), int(v.split('x')[1])))
-        for n, v in json.loads(Path('resolutions.json').read_text(
-            encoding='utf-8'))['resolutions']]
-    with sync_playwright() as p:
-        browsers: list[tuple[str, Browser]] = [(browser_name, browser_type.launch()) for browser_name, browser_type in [
-            ('chrome', p.chromium), ('firefox', p.firefox), ('webkit', p.webkit)]]
-        tabs = [(name, browser.new_page()) for name, browser in browsers]
+    browsers: list[BrowserThread] = list()
+    try:
+        browsers = launch_browsers()
         run_job(
-            tabs,
-            resolutions_spec,
+            browsers,
+            read_resolutions_spec(),
             jobId,
             hideScrollbar,
             wait,
@@ -165,6 +685,8 @@ def initialize_and_run_job(
             checkReadyJs,
             url,
         )
+    finally:
+        close_browsers(browsers)
 
 
 def self_update():
@@ -218,19 +740,23 @@ def subprocess_run_job(
 
 
 def gather_next_job():
+    started = time.time()
     try:
         resp = requests.get(
-            f'{BASEAPI}/job/next?key={APIKEY}&worker={HOSTNAME}')
-    except requests.exceptions.ConnectionError:
+            f'{BASEAPI}/job/next?key={APIKEY}&worker={HOSTNAME}&version={VERSION}&longpoll={LONG_POLL_SEC}',
+            timeout=(10, LONG_POLL_SEC+30))
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
         time.sleep(10)
         return
     if resp.status_code == 404:
         print('[INFO] No new job')
-        time.sleep(60)
+        # the server already held the request while there was nothing to do;
+        # only servers that answer right away make this sleep for long
+        time.sleep(max(0., LONG_POLL_SEC-(time.time()-started)))
     elif resp.status_code == 200:
         job = resp.json()
         print(f'[INFO] Running job {job["jobId"]}')
-        subprocess_run_job(
+        (pooled_run_job if BROWSER_POOL else subprocess_run_job)(
             job['jobId'],
             bool(job['hideScrollbar']),
             job['wait'],
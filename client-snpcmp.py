@@ -9,14 +9,16 @@ import sys
 import pandas
 import importlib
 import socket
+import threading
 import time
 import traceback
+import uuid
 import zipfile
 from collections import defaultdict
 from dataclasses import dataclass
 from io import BytesIO, StringIO
 from pathlib import Path
-from typing import Iterable, Literal, TypeVar
+from typing import BinaryIO, Iterable, Literal, TypeVar
 
 import numpy
 import PIL.Image
@@ -26,6 +28,13 @@ BASEAPI = Path('baseapi.txt').read_text(encoding='utf-8').strip()
 APIKEY = Path('apikey.txt').read_text(encoding='utf-8').strip()
 UPDURL = Path('updurl.txt').read_text(encoding='utf-8').strip()
 
+LONG_POLL_SEC = 50
+# large bodies go up in chunks of this size and survive dropped connections
+UPLOAD_CHUNK_BYTES = 8*2**20
+UPLOAD_RETRIES = 5
+# clients update themselves file by file, so the file hash is the version
+VERSION = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:12]
+
 HOSTNAME = socket.gethostname()
 if Path('hostname_override.txt').is_file():
     HOSTNAME = Path('hostname_override.txt').read_text(
@@ -64,6 +73,41 @@ def get_git_asset(fl: str) -> bytes:
     return get_content_checking(get_git_asset_url(fl))
 
 
+def resumable_upload(fp: BinaryIO, size: int) -> str | None:
+    # sends fp to /upload in chunks and, when the connection drops, resumes
+    # from what reached the server; None when the server has no /upload
+    uploadId = uuid.uuid4().hex
+    url = f'{BASEAPI}/upload/{uploadId}?key={APIKEY}'
+    for attempt in range(UPLOAD_RETRIES):
+        try:
+            offset = 0
+            if attempt:
+                resp = requests.get(url)
+                resp.raise_for_status()
+                offset = resp.json()['offset']
+            while True:
+                fp.seek(offset)
+                resp = requests.put(
+                    f'{url}&offset={offset}', data=fp.read(UPLOAD_CHUNK_BYTES),
+                    headers={'content-type': 'application/octet-stream'})
+                if resp.status_code == 404:
+                    return None
+                if resp.status_code == 409:
+                    # a previous attempt is still being written, or the
+                    # server has a different idea of where it stopped
+                    time.sleep(1)
+                else:
+                    resp.raise_for_status()
+                offset = resp.json()['offset']
+                if offset >= size:
+                    return uploadId
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            print(f'[WARN] Upload {uploadId} interrupted: {e}')
+            time.sleep(2**attempt)
+    raise requests.exceptions.ConnectionError(
+        f'Upload {uploadId} did not get through after {UPLOAD_RETRIES} attempts')
+
+
 def zip_in_memory_extract_all(zf: zipfile.ZipFile) -> dict[str, bytes]:
     return dict((zil.filename, zf.read(zil)) for zil in zf.infolist())
 
@@ -291,11 +335,17 @@ def run_job(
         h = m.hexdigest()
         print(
             f'[DEBUG] About to upload {len(b)/(2**20):.2f} MB for job {jobId}')
-        requests.post(
-            f'{BASEAPI}/analysis?key={APIKEY}&worker={HOSTNAME}&jobId={jobId}&completeness={completeness}&sha256={h}',
-            headers={'content-type': 'application/zip',
-                     'content-length': str(len(b))},
-            data=b).raise_for_status()
+        query = (f'key={APIKEY}&worker={HOSTNAME}&version={VERSION}&jobId={jobId}'
+                 f'&completeness={completeness}&sha256={h}')
+        if (uploadId := resumable_upload(BytesIO(b), len(b))) is not None:
+            requests.post(
+                f'{BASEAPI}/analysis?{query}&uploadId={uploadId}').raise_for_status()
+        else:
+            requests.post(
+                f'{BASEAPI}/analysis?{query}',
+                headers={'content-type': 'application/zip',
+                         'content-length': str(len(b))},
+                data=b).raise_for_status()
         print(f'[INFO] Uploaded analysis for job {jobId} successfully')
 
 
@@ -325,24 +375,52 @@ def subprocess_run_job(
     )
 
 
+def keep_lease(jobId: int, completeness: int, interval: float, stop: threading.Event):
+    while not stop.wait(interval):
+        try:
+            resp = requests.post(
+                f'{BASEAPI}/analysis/lease?key={APIKEY}&worker={HOSTNAME}&version={VERSION}&jobId={jobId}&completeness={completeness}')
+            if resp.status_code == 409:
+                print(f'[WARN] Lost lease for analysis {jobId}')
+                return
+            resp.raise_for_status()
+        except Exception:
+            print(f'[WARN] Could not extend lease for analysis {jobId}')
+            print(traceback.format_exc())
+
+
 def gather_next_job():
+    started = time.time()
     try:
         resp = requests.get(
-            f'{BASEAPI}/analysis/next?key={APIKEY}&worker={HOSTNAME}')
-    except requests.exceptions.ConnectionError:
+            f'{BASEAPI}/analysis/next?key={APIKEY}&worker={HOSTNAME}&version={VERSION}&longpoll={LONG_POLL_SEC}',
+            timeout=(10, LONG_POLL_SEC+30))
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
         time.sleep(10)
         return
     if resp.status_code == 404:
         print('[INFO] No new analysis')
-        time.sleep(60)
+        # the server already held the request while there was nothing to do;
+        # only servers that answer right away make this sleep for long
+        time.sleep(max(0., LONG_POLL_SEC-(time.time()-started)))
     elif resp.status_code == 200:
         job = resp.json()
         print(f'[INFO] Running analysis {job["jobId"]}')
-        subprocess_run_job(
+        stop_lease = threading.Event()
+        threading.Thread(target=keep_lease, daemon=True, args=(
             job['jobId'],
             job['completeness'],
-            job['workers'],
-        )
+            job.get('leaseSec', 300)/3,
+            stop_lease,
+        )).start()
+        try:
+            subprocess_run_job(
+                job['jobId'],
+                job['completeness'],
+                job['workers'],
+            )
+        finally:
+            stop_lease.set()
         time.sleep(2)
     else:
         try:
@@ -1,18 +1,24 @@
 #!/usr/bin/env python3
 # -*- encoding: utf-8 -*-
 
+import atexit
 import hashlib
 import importlib
-from io import BytesIO
 import json
 import os
 from pathlib import Path
+import queue
 import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import traceback
-from typing import Union
-import PIL.Image
+import uuid
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Union
 import requests
 from selenium import webdriver
 import time
@@ -42,6 +48,61 @@ BASEAPI = Path('baseapi.txt').read_text(encoding='utf-8').strip()
 APIKEY = Path('apikey.txt').read_text(encoding='utf-8').strip()
 UPDURL = Path('updurl.txt').read_text(encoding='utf-8').strip()
 
+LONG_POLL_SEC = 50
+# large bodies go up in chunks of this size and survive dropped connections
+UPLOAD_CHUNK_BYTES = 8*2**20
+UPLOAD_RETRIES = 5
+# jobs run in browsers kept open between jobs, relaunched after this many
+# jobs or when one stops answering, and after every job when they are not
+# Chromium and cannot clear their site data; BROWSER_POOL=0 launches them per
+# job in a subprocess instead, as does a pooled job whose browser crashed
+BROWSER_POOL = os.environ.get('BROWSER_POOL', '1') != '0'
+BROWSER_RECYCLE_JOBS = int(os.environ.get('BROWSER_RECYCLE_JOBS', '50'))
+# browsers capture a job at the same time, as many as there are cores and
+# BROWSER_CAPTURE_BYTES of available memory for; CAPTURE_CONCURRENCY overrides
+CAPTURE_CONCURRENCY = int(os.environ.get('CAPTURE_CONCURRENCY', '0'))
+BROWSER_CAPTURE_BYTES = 2**30
+# waitJs and wait are upper bounds: pages are captured as soon as they are
+# ready and their pixels stop changing; FIXED_WAITS=1 sleeps them in full
+FIXED_WAITS = os.environ.get('FIXED_WAITS', '') == '1'
+# no new resource for this long counts as network idle
+NETWORK_QUIET_SEC = .5
+# consecutive screenshots this far apart must match to count as stable
+STABLE_FRAME_SEC = .1
+# screenshots waiting to be spooled and sent before the browsers block, and
+# how much of the spooled zip stays in memory before it moves to disk
+PIPELINE_DEPTH = 8
+SPOOL_MEMORY_BYTES = 64*2**20
+
+# resolves true once fonts are loaded, images decoded, no resource was
+# fetched for quietMs and two animation frames went by, or false on timeout
+PAGE_READY_JS = '''
+async (timeoutMs, quietMs) => {
+    const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+    const frame = () => new Promise((resolve) => requestAnimationFrame(() => resolve()));
+    const settle = async () => {
+        performance.setResourceTimingBufferSize(100000);
+        if (document.fonts) {
+            await document.fonts.ready;
+        }
+        await Promise.all(Array.from(document.images)
+            .filter((im) => im.complete || im.loading !== 'lazy')
+            .map((im) => im.decode().catch(() => null)));
+        let seen = -1;
+        while (seen !== performance.getEntriesByType('resource').length) {
+            seen = performance.getEntriesByType('resource').length;
+            await sleep(quietMs);
+        }
+        await frame();
+        await frame();
+        return true;
+    };
+    return Promise.race([settle(), sleep(timeoutMs).then(() => false)]);
+}
+'''.strip()
+# clients update themselves file by file, so the file hash is the version
+VERSION = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:12]
+
 HOSTNAME = socket.gethostname()
 PLATFORM = sys.platform
 # PLATFORM = 'docker'
@@ -78,6 +139,313 @@ def run_hide_scrollbar(browser: WDTP):
     )
 
 
+def site_origins(*urls: str) -> list[str]:
+    origins: list[str] = list()
+    for url in urls:
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            continue
+        origin = f'{parts.scheme}://{parts.hostname}'
+        if parts.port is not None:
+            origin += f':{parts.port}'
+        if origin not in origins:
+            origins.append(origin)
+    return origins
+
+
+def can_clear_site_data(browser: WDTP) -> bool:
+    # only Chromium browsers reach cache, IndexedDB and service workers,
+    # over CDP; the others keep them until their profile is thrown away
+    return hasattr(browser, 'execute_cdp_cmd')
+
+
+def clear_site_data(browser: WDTP, url: str):
+    # what the page left behind must not leak into the next job; CDP takes
+    # no wildcard origin, so storage is cleared for the job's url and for
+    # wherever it redirected to, cookies and cache for every site
+    origins = site_origins(url, browser.current_url)
+    browser.execute_script(
+        'try { localStorage.clear(); sessionStorage.clear(); } catch (e) {}')
+    browser.delete_all_cookies()
+    browser.execute_cdp_cmd('Network.clearBrowserCache', dict())
+    browser.execute_cdp_cmd('Network.clearBrowserCookies', dict())
+    for origin in origins:
+        browser.execute_cdp_cmd('Storage.clearDataForOrigin', dict(
+            origin=origin, storageTypes='all'))
+
+
+def resumable_upload(fp: BinaryIO, size: int) -> str | None:
+    # sends fp to /upload in chunks and, when the connection drops, resumes
+    # from what reached the server; None when the server has no /upload
+    uploadId = uuid.uuid4().hex
+    url = f'{BASEAPI}/upload/{uploadId}?key={APIKEY}'
+    for attempt in range(UPLOAD_RETRIES):
+        try:
+            offset = 0
+            if attempt:
+                resp = requests.get(url)
+                resp.raise_for_status()
+                offset = resp.json()['offset']
+            while True:
+                fp.seek(offset)
+                resp = requests.put(
+                    f'{url}&offset={offset}', data=fp.read(UPLOAD_CHUNK_BYTES),
+                    headers={'content-type': 'application/octet-stream'})
+                if resp.status_code == 404:
+                    return None
+                if resp.status_code == 409:
+                    # a previous attempt is still being written, or the
+                    # server has a different idea of where it stopped
+                    time.sleep(1)
+                else:
+                    resp.raise_for_status()
+                offset = resp.json()['offset']
+                if offset >= size:
+                    return uploadId
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            print(f'[WARN] Upload {uploadId} interrupted: {e}')
+            time.sleep(2**attempt)
+    raise requests.exceptions.ConnectionError(
+        f'Upload {uploadId} did not get through after {UPLOAD_RETRIES} attempts')
+
+
+def png_size(b: bytes) -> tuple[int, int]:
+    # width and height from the IHDR chunk, without decoding the pixels
+    if b[:8] != b'\x89PNG\r\n\x1a\n' or b[12:16] != b'IHDR':
+        return (0, 0)
+    return struct.unpack('>II', b[16:24])
+
+
+class ResultSink:
+    # screenshots and failures of the browsers capturing one job at once;
+    # screenshots are checked, hashed and spooled by a thread of their own
+    # while the browsers go on capturing; once the last of them finishes,
+    # one manifest tells which of them the server lacks, only those are
+    # sent and the manifest is committed
+    def __init__(self, jobId: int) -> None:
+        self.jobId = jobId
+        self.errors: dict[str, BaseException] = dict()
+        # seconds spent waiting, per phase, summed over browsers
+        self.waits: dict[str, float] = dict()
+        self.lock = threading.Lock()
+        self.query = f'key={APIKEY}&worker={HOSTNAME}&version={VERSION}&jobId={jobId}'
+        self.manifest: dict[str, str] = dict()
+        self.uploaded = 0
+        self.failure: BaseException | None = None
+        # PNGs do not deflate any further, entries are stored as they are
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+        self.zf = zipfile.ZipFile(
+            self.spool, mode='w', compression=zipfile.ZIP_STORED)
+        self.queue: queue.Queue[tuple[str, bytes, int, int] | None] = queue.Queue(
+            maxsize=PIPELINE_DEPTH)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def add(self, name: str, scrsht: bytes, width: int, height: int = 0):
+        # blocks while the stage is PIPELINE_DEPTH screenshots behind
+        self.queue.put((name, scrsht, width, height))
+
+    def fail(self, browser_name: str, e: BaseException):
+        with self.lock:
+            self.errors[browser_name] = e
+
+    def waited(self, phase: str, sec: float):
+        with self.lock:
+            self.waits[phase] = self.waits.get(phase, 0.)+sec
+
+    def serve(self):
+        while (item := self.queue.get()) is not None:
+            if self.failure is not None:
+                # keep draining, the browsers must not block on a dead stage
+                continue
+            try:
+                self.store(*item)
+            except Exception as e:
+                self.failure = e
+
+    def store(self, name: str, scrsht: bytes, width: int, height: int):
+        actual_w, actual_h = png_size(scrsht)
+        if actual_w != width or (height and actual_h != height):
+            return
+        self.zf.writestr(name, scrsht)
+        self.manifest[name] = hashlib.sha256(scrsht).hexdigest()
+
+    def put_blobs(self, hashes: list[str]):
+        names = {h: name for name, h in self.manifest.items()}
+        with zipfile.ZipFile(self.spool) as zf:
+            for h in hashes:
+                requests.put(f'{BASEAPI}/blob/{h}?key={APIKEY}', data=zf.read(names[h]),
+                             headers={'content-type': 'application/octet-stream'}
+                             ).raise_for_status()
+                self.uploaded += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.zf.close()
+
+    def discard(self):
+        self.spool.close()
+
+    @property
+    def count(self) -> int:
+        return len(self.manifest)
+
+    def upload(self, captureSec: float):
+        timing = (f'captureSec={captureSec:.3f}&waitSec='
+                  + urllib.parse.quote(json.dumps({k: round(v, 3) for k, v in self.waits.items()})))
+        if self.failure is not None:
+            raise self.failure
+        resp = requests.post(f'{BASEAPI}/job/manifest?{self.query}', json=self.manifest)
+        if resp.status_code == 404:
+            # a server without a blob store takes the whole zip
+            self.upload_zip(timing)
+            return
+        resp.raise_for_status()
+        missing = resp.json()['missing']
+        for _ in range(3):
+            self.put_blobs(missing)
+            resp = requests.post(
+                f'{BASEAPI}/job/commit?{self.query}&{timing}', json=self.manifest)
+            if resp.status_code != 409:
+                break
+            # collected on the server in the meantime, send them again
+            missing = resp.json()['missing']
+        resp.raise_for_status()
+        print(f'[INFO] Uploaded {self.uploaded} of {self.count} screenshots '
+              f'for job {self.jobId}')
+
+    def upload_zip(self, timing: str):
+        # streamed from the spool
+        m = hashlib.sha256()
+        self.spool.seek(0)
+        while chunk := self.spool.read(2**20):
+            m.update(chunk)
+        size = self.spool.tell()
+        self.spool.seek(0)
+        h = m.hexdigest()
+        if (uploadId := resumable_upload(self.spool, size)) is not None:
+            resp = requests.post(
+                f'{BASEAPI}/job?{self.query}&sha256={h}&{timing}&uploadId={uploadId}')
+        else:
+            self.spool.seek(0)
+            resp = requests.post(
+                f'{BASEAPI}/job?{self.query}&sha256={h}&{timing}',
+                headers={'content-type': 'application/zip',
+                         'content-length': str(size)},
+                data=self.spool)
+        if resp.status_code != 200:
+            print(
+                f'[FATAL] Could not upload, got {resp.status_code}:\n{resp.text}')
+        resp.raise_for_status()
+        print(f'[INFO] Uploaded results for job {self.jobId} successfully')
+
+
+def wait_until_ready(browser: WDTP, sink: ResultSink, phase: str, timeout: float):
+    started = time.time()
+    if FIXED_WAITS:
+        time.sleep(timeout)
+    elif timeout > 0:
+        browser.set_script_timeout(timeout+10)
+        try:
+            browser.execute_async_script(
+                f'const done = arguments[arguments.length-1]; '
+                f'({PAGE_READY_JS})(arguments[0], arguments[1]).then(done, () => done(false));',
+                int(timeout*1000), int(NETWORK_QUIET_SEC*1000))
+        except WebDriverException as e:
+            print(f'[WARN] Could not wait for the page to be ready: {e}')
+    sink.waited(phase, time.time()-started)
+
+
+def stable_screenshot(browser: WDTP, sink: ResultSink, timeout: float) -> bytes:
+    # the page settles within timeout, then the last of two identical
+    # consecutive screenshots is the capture
+    deadline = time.time()+timeout
+    wait_until_ready(browser, sink, 'settle', timeout)
+    started = time.time()
+    scrsht = browser.get_screenshot_as_png()
+    while not FIXED_WAITS and time.time()+STABLE_FRAME_SEC < deadline:
+        time.sleep(STABLE_FRAME_SEC)
+        previous, scrsht = scrsht, browser.get_screenshot_as_png()
+        if scrsht == previous:
+            break
+    sink.waited('stable', time.time()-started)
+    return scrsht
+
+
+def available_memory() -> int | None:
+    try:
+        for line in Path('/proc/meminfo').read_text().splitlines():
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1])*1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def capture_concurrency(count: int) -> int:
+    if CAPTURE_CONCURRENCY > 0:
+        return max(1, min(count, CAPTURE_CONCURRENCY))
+    limit = os.cpu_count() or 1
+    memory = available_memory()
+    if memory is not None:
+        limit = min(limit, memory//BROWSER_CAPTURE_BYTES)
+    return max(1, min(count, limit))
+
+
+def capture_browser(browser: WDTP,
+                    sink: ResultSink,
+                    resolutions_spec: list[tuple[str, tuple[int, int]]],
+                    hideScrollbar: bool,
+                    wait: float,
+                    scrolltoJs: str,
+                    scrolltox: int,
+                    scrolltoy: int,
+                    preRunJs: str,
+                    waitJs: float,
+                    checkReadyJs: str,
+                    url: str):
+    browser.get('about:blank')
+    browser.set_window_size(TEST_W, TEST_H)
+    actual_w, actual_h = png_size(browser.get_screenshot_as_png())
+    compensation_w, compensation_h = TEST_W-actual_w, TEST_H-actual_h
+    browser.get(url)
+    if hideScrollbar:
+        run_hide_scrollbar(browser)
+    browser.execute_script(preRunJs)
+    wait_until_ready(browser, sink, 'ready', waitJs)
+    if checkReadyJs:
+        started = time.time()
+        while (waitReady := browser.execute_script(checkReadyJs)) > 0:
+            time.sleep(waitReady)
+        sink.waited('checkReady', time.time()-started)
+    for resolution_name, (resw, resh) in resolutions_spec:
+        browser.set_window_size(resw+compensation_w, resh+compensation_h)
+        if scrolltoJs:
+            browser.execute_script(scrolltoJs)
+        else:
+            browser.execute_script(
+                f'window.scrollTo({scrolltox}, {scrolltoy})')
+        if hideScrollbar:
+            run_hide_scrollbar(browser)
+        partial = stable_screenshot(browser, sink, wait)
+        if hasattr(browser, 'get_full_page_screenshot_as_png'):
+            try:
+                scrsht = browser.get_full_page_screenshot_as_png()
+                sink.add(
+                    f'{PLATFORM}.{HOSTNAME}.{browser.name}.{resolution_name}.full.png',
+                    scrsht, resw)
+            except WebDriverException as e:
+                print(f'[WARN] Ignoring full screenshot: {e}')
+        sink.add(
+            f'{PLATFORM}.{HOSTNAME}.{browser.name}.{resolution_name}.partial.png',
+            partial, resw, resh)
+        del partial
+
+
 def run_job(browsers: list[WDTP],
             resolutions_spec: list[tuple[str, tuple[int, int]]],
             jobId: int,
@@ -90,73 +458,179 @@ def run_job(browsers: list[WDTP],
             waitJs: float,
             checkReadyJs: str,
             url: str):
-    bio = BytesIO()
-    zf = zipfile.ZipFile(
-        bio, mode='w', compression=zipfile.ZIP_DEFLATED, compresslevel=9)
-    for browser in browsers:
-        browser.get('about:blank')
-        browser.set_window_size(TEST_W, TEST_H)
-        actual_w, actual_h = PIL.Image.open(
-            BytesIO(browser.get_screenshot_as_png())).size
-        compensation_w, compensation_h = TEST_W-actual_w, TEST_H-actual_h
-        browser.get(url)
-        if hideScrollbar:
-            run_hide_scrollbar(browser)
-        browser.execute_script(preRunJs)
-        time.sleep(waitJs)
-        if checkReadyJs:
-            while (waitReady := browser.execute_script(checkReadyJs)) > 0:
-                time.sleep(waitReady)
-        for resolution_name, (resw, resh) in resolutions_spec:
-            browser.set_window_size(resw+compensation_w, resh+compensation_h)
-            if scrolltoJs:
-                browser.execute_script(scrolltoJs)
-            else:
-                browser.execute_script(
-                    f'window.scrollTo({scrolltox}, {scrolltoy})')
-            if hideScrollbar:
-                run_hide_scrollbar(browser)
-            time.sleep(wait)
-            if hasattr(browser, 'get_full_page_screenshot_as_png'):
-                try:
-                    scrsht = browser.get_full_page_screenshot_as_png()
-                    im = PIL.Image.open(BytesIO(scrsht))
-                    if im.size[0] == resw:
-                        zf.writestr(
-                            f'{PLATFORM}.{HOSTNAME}.{browser.name}.{resolution_name}.full.png',
-                            scrsht
-                        )
-                except WebDriverException as e:
-                    print(f'[WARN] Ignoring full screenshot: {e}')
-            scrsht = browser.get_screenshot_as_png()
-            im = PIL.Image.open(BytesIO(scrsht))
-            if im.size == (resw, resh):
-                zf.writestr(
-                    f'{PLATFORM}.{HOSTNAME}.{browser.name}.{resolution_name}.partial.png',
-                    scrsht
-                )
-            del im
-            del scrsht
-        browser.get('about:blank')
-    zf.close()
-    b = bio.getvalue()
-    m = hashlib.sha256()
-    m.update(b)
-    h = m.hexdigest()
-    resp = requests.post(
-        f'{BASEAPI}/job?key={APIKEY}&worker={HOSTNAME}&jobId={jobId}&sha256={h}',
-        headers={'content-type': 'application/zip',
-                 'content-length': str(len(b))},
-        data=b)
-    if resp.status_code != 200:
+    # every browser captures on its own thread; one that fails costs its
+    # own screenshots only, the job fails when none of them got through
+    started = time.time()
+    sink = ResultSink(jobId)
+    with ThreadPoolExecutor(capture_concurrency(len(browsers))) as pool:
+        futures = [(browser, pool.submit(
+            capture_browser, browser, sink, resolutions_spec, hideScrollbar, wait,
+            scrolltoJs, scrolltox, scrolltoy, preRunJs, waitJs, checkReadyJs, url))
+            for browser in browsers]
+    for browser, future in futures:
+        if (e := future.exception()) is not None:
+            print(f'[ERROR] {browser.name} failed on job {jobId}:')
+            print(''.join(traceback.format_exception(e)))
+            sink.fail(browser.name, e)
+    try:
+        sink.close()
+        if not sink.count and sink.errors:
+            raise next(iter(sink.errors.values()))
+        print('[INFO] Waited ' + ', '.join(
+            f'{sec:.1f}s for {phase}' for phase, sec in sink.waits.items()))
+        sink.upload(time.time()-started)
+    finally:
+        sink.discard()
+
+
+def read_resolutions_spec() -> list[tuple[str, tuple[int, int]]]:
+    return [
+        (str(n), (int(v.split('x')[0]), int(v.split('x')[1])))
+        for n, v in json.loads(Path('resolutions.json').read_text(
+            encoding='utf-8'))['resolutions']]
+
+
+def read_browsers_spec() -> list[dict]:
+    return json.loads(Path(f'browsers.{sys.platform}.json').read_text(
+        encoding='utf-8'))['browsers']
+
+
+def launch_browser(browser_spec: dict) -> WDTP | None:
+    opt = CLS_OPTIONS[browser_spec['type']]()
+    if os.environ.get('SKIP_ARGS', '') == '':
+        for arg in browser_spec['arguments']:
+            opt.add_argument(arg)
+    else:
+        opt.headless = False  # type: ignore
+    try:
+        browser = CLS_WEBDRIVER[browser_spec['type']](opt)
+    except Exception:
         print(
-            f'[FATAL] Could not upload, got {resp.status_code}:\n{resp.text}')
-    resp.raise_for_status()
-    # Path(f'{PLATFORM}.{jobId:012d}.zip').write_bytes(bio.getvalue())
-    print(f'[INFO] Uploaded results for job {jobId} successfully')
-    del zf
-    del bio
-    del b
+            f'[ERROR] Could not initialize browser {browser_spec["type"]}')
+        print(traceback.format_exc())
+        return None
+    browser.get('about:blank')
+    return browser
+
+
+def launch_browsers() -> list[WDTP]:
+    return [browser for browser in map(launch_browser, read_browsers_spec())
+            if browser is not None]
+
+
+class BrowserPool:
+    def __init__(self) -> None:
+        self.browsers: list[WDTP] = list()
+        # the spec each browser was launched from, to relaunch it alone
+        self.specs: list[dict] = list()
+        self.jobs = 0
+        self.version = VERSION
+        atexit.register(self.close)
+
+    def healthy(self) -> bool:
+        if not self.browsers:
+            return False
+        try:
+            for browser in self.browsers:
+                # only the first window survives a job, see reset
+                if len(browser.window_handles) != 1:
+                    return False
+                browser.current_url
+        except WebDriverException:
+            return False
+        return True
+
+    def acquire(self) -> list[WDTP]:
+        if self.jobs >= BROWSER_RECYCLE_JOBS or not self.healthy():
+            self.close()
+            print('[INFO] Launching browsers')
+            for browser_spec in read_browsers_spec():
+                if (browser := launch_browser(browser_spec)) is not None:
+                    self.browsers.append(browser)
+                    self.specs.append(browser_spec)
+        self.jobs += 1
+        return self.browsers
+
+    def reset(self, url: str):
+        # the one place site data is dropped between jobs: Chromium browsers
+        # are cleared and kept, the others get a new profile by relaunching
+        for i, browser in enumerate(self.browsers):
+            if not can_clear_site_data(browser):
+                self.relaunch(i)
+                continue
+            try:
+                for handle in browser.window_handles[1:]:
+                    browser.switch_to.window(handle)
+                    browser.close()
+                browser.switch_to.window(browser.window_handles[0])
+                clear_site_data(browser, url)
+                browser.get('about:blank')
+            except WebDriverException as e:
+                print(f'[WARN] Could not clear site data: {e}')
+                self.relaunch(i)
+
+    def relaunch(self, i: int):
+        try:
+            self.browsers[i].quit()
+        except Exception:
+            print(traceback.format_exc())
+        browser = launch_browser(self.specs[i])
+        if browser is None:
+            # the whole pool is relaunched on the next acquire
+            self.jobs = BROWSER_RECYCLE_JOBS
+            return
+        self.browsers[i] = browser
+
+    def close(self):
+        for browser in self.browsers:
+            try:
+                browser.quit()
+            except Exception:
+                print(traceback.format_exc())
+        self.browsers = list()
+        self.specs = list()
+        self.jobs = 0
+
+
+# kept across the reloads done by self_update
+POOL: BrowserPool | None = globals().get('POOL')
+
+
+def pooled_run_job(
+    jobId: int,
+    hideScrollbar: bool,
+    wait: float,
+    scrolltoJs: str,
+    scrolltox: int,
+    scrolltoy: int,
+    preRunJs: str,
+    waitJs: float,
+    checkReadyJs: str,
+    url: str,
+):
+    global POOL
+    if POOL is not None and POOL.version != VERSION:
+        # launched by the code before the last self update
+        POOL.close()
+        POOL = None
+    if POOL is None:
+        POOL = BrowserPool()
+    args = (jobId, hideScrollbar, wait, scrolltoJs, scrolltox, scrolltoy,
+            preRunJs, waitJs, checkReadyJs, url)
+    browsers = POOL.acquire()
+    if not browsers:
+        print('[WARN] No browser in the pool, running the job in a subprocess')
+        subprocess_run_job(*args)
+        return
+    try:
+        run_job(browsers, read_resolutions_spec(), *args)
+    except WebDriverException:
+        print(traceback.format_exc())
+        print('[WARN] Browser failed, relaunching the pool and running the job in a subprocess')
+        POOL.close()
+        subprocess_run_job(*args)
+        return
+    POOL.reset(url)
 
 
 def initialize_and_run_job(
@@ -171,33 +645,12 @@ def initialize_and_run_job(
     checkReadyJs: str,
     url: str,
 ):
-    browsers_spec = json.loads(Path(f'browsers.{sys.platform}.json').read_text(
-        encoding='utf-8'))['browsers']
-    resolutions_spec = [
-        (str(n), (int(v.split('x')[0]), int(v.split('x')[1])))
-        for n, v in json.loads(Path('resolutions.json').read_text(
-            encoding='utf-8'))['resolutions']]
     browsers: list[WDTP] = list()
     try:
-        for browser_spec in browsers_spec:
-            opt = CLS_OPTIONS[browser_spec['type']]()
-            if os.environ.get('SKIP_ARGS', '') == '':
-                for arg in browser_spec['arguments']:
-                    opt.add_argument(arg)
-            else:
-                opt.headless = False  # type: ignore
-            try:
-                browser = CLS_WEBDRIVER[browser_spec['type']](opt)
-                browsers.append(browser)
-            except Exception:
-                print(
-                    f'[ERROR] Could not initialize browser {browser_spec["type"]}')
-                print(traceback.format_exc())
-        for browser in browsers:
-            browser.get('about:blank')
+        browsers = launch_browsers()
         run_job(
             browsers,
-            resolutions_spec,
+            read_resolutions_spec(),
             jobId,
             hideScrollbar,
             wait,
@@ -265,19 +718,23 @@ def subprocess_run_job(
 
 
 def gather_next_job():
+    started = time.time()
     try:
         resp = requests.get(
-            f'{BASEAPI}/job/next?key={APIKEY}&worker={HOSTNAME}')
-    except requests.exceptions.ConnectionError:
+            f'{BASEAPI}/job/next?key={APIKEY}&worker={HOSTNAME}&version={VERSION}&longpoll={LONG_POLL_SEC}',
+            timeout=(10, LONG_POLL_SEC+30))
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
         time.sleep(10)
         return
     if resp.status_code == 404:
         print('[INFO] No new job')
-        time.sleep(60)
+        # the server already held the request while there was nothing to do;
+        # only servers that answer right away make this sleep for long
+        time.sleep(max(0., LONG_POLL_SEC-(time.time()-started)))
     elif resp.status_code == 200:
         job = resp.json()
         print(f'[INFO] Running job {job["jobId"]}')
-        subprocess_run_job(
+        (pooled_run_job if BROWSER_POOL else subprocess_run_job)(
             job['jobId'],
             bool(job['hideScrollbar']),
             job['wait'],
@@ -0,0 +1,20 @@
+import axios, { AxiosResponse } from "axios";
+
+export const getAllPages = async <T>(url: string) => {
+  const data: T[] = [];
+  let revision: number | undefined = undefined;
+  let cursor: string | undefined = undefined;
+  do {
+    const resp: AxiosResponse<T[]> = await axios.get<T[]>(
+      cursor === undefined
+        ? url
+        : `${url}${url.includes("?") ? "&" : "?"}cursor=${cursor}`
+    );
+    data.push(...resp.data);
+    // the first page's revision is the oldest, later changes are refetched
+    revision ??= Number(resp.headers["x-revision"] ?? 0);
+    const nextCursor = resp.headers["x-next-cursor"];
+    cursor = nextCursor ? String(nextCursor) : undefined;
+  } while (cursor !== undefined);
+  return { data, revision: revision ?? 0 };
+};
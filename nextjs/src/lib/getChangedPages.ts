@@ -0,0 +1,39 @@
+import axios, { AxiosResponse } from "axios";
+import { getAllPages } from "./getAllPages";
+
+type Delta<T> = { revision: number; rows: T[]; deleted: number[] };
+
+// Brings a copy loaded by getAllPages up to date through the ?since= delta
+// feed, so a poll costs what changed rather than the whole history; a copy
+// older than the server keeps deletions for is loaded again
+export const getChangedPages = async <T extends { jobId: number }>(
+  url: string,
+  prev?: { data: T[]; revision: number }
+) => {
+  if (prev === undefined) return getAllPages<T>(url);
+  const rows = new Map(prev.data.map((x) => [x.jobId, x]));
+  const since = `${url}${url.includes("?") ? "&" : "?"}since=${prev.revision}`;
+  let revision: number | undefined = undefined;
+  let cursor: string | undefined = undefined;
+  do {
+    let resp: AxiosResponse<Delta<T>>;
+    try {
+      resp = await axios.get<Delta<T>>(
+        cursor === undefined ? since : `${since}&cursor=${cursor}`
+      );
+    } catch (e) {
+      if (axios.isAxiosError(e) && e.response?.status === 410)
+        return getAllPages<T>(url);
+      throw e;
+    }
+    for (const row of resp.data.rows) rows.set(row.jobId, row);
+    for (const jobId of resp.data.deleted) rows.delete(jobId);
+    revision ??= resp.data.revision;
+    const nextCursor = resp.headers["x-next-cursor"];
+    cursor = nextCursor ? String(nextCursor) : undefined;
+  } while (cursor !== undefined);
+  return {
+    data: [...rows.values()].sort((a, b) => a.jobId - b.jobId),
+    revision: revision ?? prev.revision,
+  };
+};
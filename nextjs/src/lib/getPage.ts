@@ -0,0 +1,14 @@
+import axios from "axios";
+
+export const getPage = async <T>(url: string, cursor?: string) => {
+  const resp = await axios.get<T[]>(
+    cursor === undefined
+      ? url
+      : `${url}${url.includes("?") ? "&" : "?"}cursor=${cursor}`
+  );
+  const nextCursor = resp.headers["x-next-cursor"];
+  return {
+    data: resp.data,
+    nextCursor: nextCursor ? String(nextCursor) : undefined,
+  };
+};
@@ -4,3 +4,6 @@ export * from "./matchesFirst";
 export * from "./countUntil";
 export * from "./useShortPolling";
 export * from "./avg";
+export * from "./getAllPages";
+export * from "./getChangedPages";
+export * from "./getPage";
@@ -10,6 +10,9 @@ import { useRouter } from "next/router";
 const inter = Inter({ subsets: ["latin"] });
 const scp = Source_Code_Pro({ subsets: ["latin"] });
 
+// a third of a 4k screen; the full capture is one click away
+const THUMB_WIDTH = 1280;
+
 export default function ComparePage() {
   const router = useRouter();
   const jobId = matchesFirst(router.query, "id");
@@ -106,25 +109,31 @@ export default function ComparePage() {
             </tr>
             <tr>
               <td>
-                <img
-                  src={`${BASEAPI}/unzip/jobs/${jobId}/${hostname1}.zip/${platform1}.${hostname1}.${browser1}.${resolution}.${printScope}.png`}
-                  alt={""}
-                  style={{ maxWidth: "calc(33.33333vw - 1rem)" }}
-                />
+                <a href={`${BASEAPI}/unzip/jobs/${jobId}/${hostname1}.zip/${platform1}.${hostname1}.${browser1}.${resolution}.${printScope}.png`}>
+                  <img
+                    src={`${BASEAPI}/thumb/jobs/${jobId}/${hostname1}.zip/${platform1}.${hostname1}.${browser1}.${resolution}.${printScope}.png?w=${THUMB_WIDTH}`}
+                    alt={""}
+                    style={{ maxWidth: "calc(33.33333vw - 1rem)" }}
+                  />
+                </a>
               </td>
               <td>
-                <img
-                  src={`${BASEAPI}/unzip/jobs/${jobId}/analysis.zip/${resolution}.${printScope}.${hostname1}.${hostname2}.${platform1}.${platform2}.${browser1}.${browser2}.png`}
-                  alt={""}
-                  style={{ maxWidth: "calc(33.33333vw - 1rem)" }}
-                />
+                <a href={`${BASEAPI}/unzip/jobs/${jobId}/analysis.zip/${resolution}.${printScope}.${hostname1}.${hostname2}.${platform1}.${platform2}.${browser1}.${browser2}.png`}>
+                  <img
+                    src={`${BASEAPI}/thumb/jobs/${jobId}/analysis.zip/${resolution}.${printScope}.${hostname1}.${hostname2}.${platform1}.${platform2}.${browser1}.${browser2}.png?w=${THUMB_WIDTH}`}
+                    alt={""}
+                    style={{ maxWidth: "calc(33.33333vw - 1rem)" }}
+                  />
+                </a>
               </td>
               <td>
-                <img
-                  src={`${BASEAPI}/unzip/jobs/${jobId}/${hostname2}.zip/${platform2}.${hostname2}.${browser2}.${resolution}.${printScope}.png`}
-                  alt={""}
-                  style={{ maxWidth: "calc(33.33333vw - 1rem)" }}
-                />
+                <a href={`${BASEAPI}/unzip/jobs/${jobId}/${hostname2}.zip/${platform2}.${hostname2}.${browser2}.${resolution}.${printScope}.png`}>
+                  <img
+                    src={`${BASEAPI}/thumb/jobs/${jobId}/${hostname2}.zip/${platform2}.${hostname2}.${browser2}.${resolution}.${printScope}.png?w=${THUMB_WIDTH}`}
+                    alt={""}
+                    style={{ maxWidth: "calc(33.33333vw - 1rem)" }}
+                  />
+                </a>
               </td>
             </tr>
           </tbody>
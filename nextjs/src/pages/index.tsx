@@ -1,8 +1,8 @@
 import Head from "next/head";
 import { Inter } from "next/font/google";
 import clsx from "clsx";
-import { useQuery } from "react-query";
-import { BASEAPI, SOURCECODE, sleep } from "../lib/index";
+import { useInfiniteQuery, useQuery } from "react-query";
+import { BASEAPI, SOURCECODE, getPage, sleep } from "../lib/index";
 import { Analysis, Job } from "../types/index";
 import axios from "axios";
 import Link from "next/link";
@@ -10,10 +10,13 @@ import Link from "next/link";
 const inter = Inter({ subsets: ["latin"] });
 
 export default function Home() {
-  const analysisQuery = useQuery(
-    "base-analysis",
-    async () => axios.get<Analysis[]>(`${BASEAPI}/analysis`),
+  // one page at first, older ones only when asked for
+  const analysisQuery = useInfiniteQuery(
+    "index-analysis",
+    async ({ pageParam }) =>
+      getPage<Analysis>(`${BASEAPI}/analysis`, pageParam),
     {
+      getNextPageParam: (lastPage) => lastPage.nextCursor,
       onError: async () => {
         await sleep(5000);
         analysisQuery.refetch();
@@ -33,9 +36,9 @@ export default function Home() {
   const jobs = Object.fromEntries(
     jobsQuery.data?.data.map((x) => [x.jobId, x]) || []
   );
-  const analyses = analysisQuery.data?.data.filter(
-    (x) => x.finished && x.analysisFile
-  );
+  const analyses = analysisQuery.data?.pages
+    .flatMap((page) => page.data)
+    .filter((x) => x.finished && x.analysisFile);
   return (
     <>
       <Head>
@@ -64,6 +67,14 @@ export default function Home() {
             ))}
           </ul>
         )}
+        {analysisQuery.hasNextPage && (
+          <button
+            disabled={analysisQuery.isFetchingNextPage}
+            onClick={() => analysisQuery.fetchNextPage()}
+          >
+            {analysisQuery.isFetchingNextPage ? "Loading" : "Load more"}
+          </button>
+        )}
         <p>Some pages have meaningful CSS... that breaks; this doesn&apos;t.</p>
         <p>
           <Link href="/status">Status</Link> -{" "}
@@ -1,18 +1,32 @@
-import { BASEAPI, countUntil, sleep, useShortPolling } from "../lib";
+import {
+  BASEAPI,
+  countUntil,
+  getChangedPages,
+  sleep,
+  useShortPolling,
+} from "../lib";
 import { Analysis, Job, Uptime } from "../types";
 import axios from "axios";
 import clsx from "clsx";
 import { Inter } from "next/font/google";
 import Head from "next/head";
 import { useEffect } from "react";
-import { useQuery } from "react-query";
+import { useQuery, useQueryClient } from "react-query";
 
 const inter = Inter({ subsets: ["latin"] });
 
 export default function StatusPage() {
+  const queryClient = useQueryClient();
+  // every page once, then each poll only fetches the analyses that changed
   const analysisQuery = useQuery(
-    "base-analysis",
-    async () => axios.get<Analysis[]>(`${BASEAPI}/analysis`),
+    "status-analysis",
+    async () =>
+      getChangedPages<Analysis>(
+        `${BASEAPI}/analysis`,
+        queryClient.getQueryData<{ data: Analysis[]; revision: number }>(
+          "status-analysis"
+        )
+      ),
     {
       onError: async () => {
         await sleep(5000);
@@ -2,57 +2,95 @@
 # -*- encoding: utf-8 -*-
 
 import hashlib
+import io
+import atexit
+import fcntl
 import json
+import math
 import mimetypes
+import os
 import shutil
+import sqlite3
+import struct
+import sys
+import threading
 import time
+import traceback
+import urllib.parse
 import zipfile
-from collections import defaultdict
+import zlib
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
 from io import BytesIO
 from pathlib import Path
-from typing import Any
+from typing import Any, BinaryIO, Callable, Iterator, TypeVar
 from uuid import uuid4
 
+import PIL.Image
 import werkzeug.exceptions
-from flask import (Flask, jsonify, make_response, redirect, request, send_file,
-                   send_from_directory)
+from flask import (Flask, Response, g, jsonify, make_response, redirect, request,
+                   send_file, send_from_directory)
+from werkzeug.wsgi import wrap_file
 from flask_cors import CORS
 
 APIKEY = Path('apikey.txt').read_text(encoding='utf-8').strip()
 
 app = Flask(__name__, instance_relative_config=True)
-CORS(app)
+CORS(app, expose_headers=['ETag', 'X-Next-Cursor', 'X-Revision'])
 
-UPTIME_DB = Path('uptime.json')
-if not UPTIME_DB.exists():
-    UPTIME_DB.write_bytes(b'{}')
+STATE_DB = Path('state.sqlite3')
 
-UPTIME2_DB = Path('uptime2.json')
-if not UPTIME2_DB.exists():
-    UPTIME2_DB.write_bytes(b'{}')
-
-ID_DB = Path('ids.json')
-if not ID_DB.exists():
-    ID_DB.write_bytes(b'{}')
-
-CRON_DB = Path('crons.json')
-if not CRON_DB.exists():
-    CRON_DB.write_bytes(b'[]')
-
-JOB_DB = Path('jobs.json')
-if not JOB_DB.exists():
-    JOB_DB.write_bytes(b'[]')
-
-ANAL_DB = Path('analysis.json')
-if not ANAL_DB.exists():
-    ANAL_DB.write_bytes(b'[]')
+LEGACY_UPTIME_DB = Path('uptime.json')
+LEGACY_UPTIME2_DB = Path('uptime2.json')
+LEGACY_ID_DB = Path('ids.json')
+LEGACY_CRON_DB = Path('crons.json')
+LEGACY_JOB_DB = Path('jobs.json')
+LEGACY_ANAL_DB = Path('analysis.json')
 
 JOBS_PATH = Path('jobs')
-
-for x in Path('.').glob('*.temp'):
-    x.unlink()
-    del x
-
+UPLOADS_PATH = Path('uploads')
+BLOBS_PATH = Path('blobs')
+
+UPLOAD_CHUNK_SIZE = 2**20
+UPLOAD_ID_CHARS = frozenset('0123456789abcdefghijklmnopqrstuvwxyz'
+                            'ABCDEFGHIJKLMNOPQRSTUVWXYZ-_')
+
+SCHEDULER_INTERVAL_SEC = float(os.environ.get('SCHEDULER_INTERVAL_SEC', '5'))
+ANALYSIS_LEASE_SEC = float(os.environ.get('ANALYSIS_LEASE_SEC', '300'))
+ANALYSIS_PAGE_SIZE = 500
+LONG_POLL_MAX_SEC = 50
+UNZIP_INDEX_CACHE_BYTES = 32*2**20
+UNZIP_CHUNK_SIZE = 2**16
+UNZIP_MAX_AGE_SEC = 3600
+LONG_POLL_INTERVAL_SEC = .2
+ANALYSIS_PAGE_SIZE_MAX = 5000
+TREND_DAY_SEC = 86400
+TREND_POINTS = 500
+TREND_POINTS_MAX = 5000
+# ranges this long are summed from the day rollups, in buckets of a day or more
+TREND_ROLLUP_MIN_SEC = 30*TREND_DAY_SEC
+
+DERIVATIVES_PATH = Path('derivatives')
+DERIVATIVES_CACHE_BYTES = int(os.environ.get('DERIVATIVES_CACHE_BYTES', 2**30))
+THUMB_MAX_SIDE = 4096
+TILE_SIZE = 256
+# enough of an image to find its dimensions in without decoding it
+IMAGE_HEAD_BYTES = 2**16
+
+GC_INTERVAL_SEC = float(os.environ.get('GC_INTERVAL_SEC', '600'))
+# leftovers younger than this may still belong to an upload in flight
+GC_GRACE_SEC = 3600
+UPLOAD_PART_MAX_AGE_SEC = 86400
+TOMBSTONE_KEEP_REVISIONS = 100000
+METRICS_FLUSH_SEC = float(os.environ.get('METRICS_FLUSH_SEC', '10'))
+# explode uploaded zips into content-addressed blobs, see explode_archive,
+# and take delta uploads of blobs through /job/manifest and /job/commit
+BLOB_STORE = os.environ.get('BLOB_STORE', '') == '1'
+# internal nginx location aliasing the state directory; when set, files on
+# disk are handed to nginx instead of being streamed from a worker thread,
+# see srvconfig/nginx.conf
+ACCEL_REDIRECT = os.environ.get('ACCEL_REDIRECT', '').rstrip('/')
 
 JOB_DEFAULTS = dict(
     hideScrollbar=1,
@@ -92,14 +130,758 @@ class TempFile:
             dest.parent.mkdir(parents=True, exist_ok=True)
             f.rename(dest)
 
+    @classmethod
+    def save_stream(cls, dest: Path, stream: BinaryIO, hashed: str) -> tuple[int, str]:
+        # copies in bounded chunks and hashes on the fly, so memory use does
+        # not depend on the upload size; dest only appears if the hash matches
+        with cls('.') as f:
+            m = hashlib.sha256()
+            size = 0
+            with f.open('wb') as fw:
+                while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+                    fw.write(chunk)
+                    m.update(chunk)
+                    size += len(chunk)
+            h = m.hexdigest()
+            if h != hashed:
+                raise ValueError('Sent data was not received right')
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            f.rename(dest)
+        return size, h
+
+
+# Each entry upgrades the schema by one version (tracked in PRAGMA user_version).
+# Never edit an entry that was already deployed, append a new one instead.
+SCHEMA_MIGRATIONS: list[str] = [
+    '''
+    CREATE TABLE ids (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+    CREATE TABLE crons (
+        cronId INTEGER PRIMARY KEY,
+        hours REAL NOT NULL,
+        historySize REAL NOT NULL,
+        lastScheduledSec REAL NOT NULL,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX crons_due ON crons (lastScheduledSec);
+    CREATE TABLE jobs (
+        jobId INTEGER PRIMARY KEY,
+        cronId INTEGER NOT NULL,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX jobs_cron ON jobs (cronId, jobId);
+    CREATE TABLE submissions (
+        jobId INTEGER NOT NULL,
+        worker TEXT NOT NULL,
+        path TEXT NOT NULL,
+        submittedSec REAL NOT NULL,
+        PRIMARY KEY (jobId, worker)
+    );
+    CREATE INDEX submissions_worker ON submissions (worker, jobId);
+    CREATE TABLE analyses (
+        jobId INTEGER PRIMARY KEY,
+        cronId INTEGER NOT NULL,
+        finished INTEGER NOT NULL,
+        assignee TEXT,
+        assigneeTime REAL NOT NULL,
+        completeness INTEGER NOT NULL,
+        workers TEXT NOT NULL,
+        analysisFile TEXT,
+        analysis TEXT
+    );
+    CREATE INDEX analyses_pending ON analyses (finished, jobId);
+    CREATE TABLE heartbeats (
+        kind TEXT NOT NULL,
+        worker TEXT NOT NULL,
+        lastSeenSec REAL NOT NULL,
+        PRIMARY KEY (kind, worker)
+    );
+    ''',
+    '''
+    ALTER TABLE jobs ADD COLUMN dueSec REAL;
+    ALTER TABLE jobs ADD COLUMN scheduledSec REAL;
+    ''',
+    '''
+    CREATE TABLE pending_jobs (
+        worker TEXT NOT NULL,
+        jobId INTEGER NOT NULL,
+        PRIMARY KEY (worker, jobId)
+    ) WITHOUT ROWID;
+    CREATE INDEX pending_jobs_job ON pending_jobs (jobId);
+    ''',
+    '''
+    ALTER TABLE submissions ADD COLUMN size INTEGER;
+    ALTER TABLE submissions ADD COLUMN sha256 TEXT;
+    ''',
+    '''
+    ALTER TABLE analyses ADD COLUMN leaseExpiresSec REAL;
+    UPDATE analyses SET leaseExpiresSec = assigneeTime + 300
+        WHERE assignee IS NOT NULL AND finished = 0;
+    CREATE INDEX analyses_queue ON analyses (completeness DESC, jobId)
+        WHERE finished = 0;
+    ''',
+    '''
+    ALTER TABLE analyses ADD COLUMN indicators TEXT;
+    UPDATE analyses SET indicators = json_extract(analysis, '$.indicators')
+        WHERE analysis IS NOT NULL;
+    UPDATE analyses SET analysis = NULL;
+    UPDATE jobs SET scheduledSec = json_extract(data, '$.lastScheduledSec')
+        WHERE scheduledSec IS NULL;
+    CREATE INDEX analyses_cron ON analyses (cronId, jobId);
+    CREATE INDEX jobs_scheduled ON jobs (scheduledSec);
+    ''',
+    '''
+    ALTER TABLE jobs ADD COLUMN revision INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE jobs ADD COLUMN submissionRevision INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE analyses ADD COLUMN revision INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE heartbeats ADD COLUMN revision INTEGER NOT NULL DEFAULT 0;
+    CREATE INDEX jobs_revision ON jobs (revision);
+    CREATE INDEX jobs_submission_revision ON jobs (submissionRevision);
+    CREATE INDEX analyses_revision ON analyses (revision);
+    CREATE INDEX heartbeats_revision ON heartbeats (kind, revision);
+    CREATE TABLE tombstones (
+        collection TEXT NOT NULL,
+        key TEXT NOT NULL,
+        revision INTEGER NOT NULL
+    );
+    CREATE INDEX tombstones_revision ON tombstones (collection, revision);
+    ''',
+    # 8: current job, client version and capture duration per heartbeat
+    '''
+    ALTER TABLE heartbeats ADD COLUMN info TEXT NOT NULL DEFAULT '{}';
+    ''',
+    # 9: counters and histogram buckets, summed over all server processes
+    '''
+    CREATE TABLE metrics (
+        name TEXT NOT NULL,
+        labels TEXT NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (name, labels)
+    ) WITHOUT ROWID;
+    ''',
+    # 10: zips exploded into content-addressed blobs
+    '''
+    CREATE TABLE blobs (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        refs INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    CREATE INDEX blobs_unreferenced ON blobs (refs) WHERE refs <= 0;
+    CREATE TABLE archives (
+        archive TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtimeNs INTEGER NOT NULL,
+        sha256 TEXT NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TABLE archive_members (
+        archive TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        sha256 TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        crc INTEGER NOT NULL,
+        PRIMARY KEY (archive, position)
+    ) WITHOUT ROWID;
+    CREATE INDEX archive_members_sha256 ON archive_members (sha256);
+    ''',
+    # 11: blobs uploaded on their own carry the crc their manifests need
+    '''
+    ALTER TABLE blobs ADD COLUMN crc INTEGER;
+    ''',
+    # 12: indicator time series per cron, kept past the cron's history size
+    '''
+    CREATE TABLE trends (
+        cronId INTEGER NOT NULL,
+        jobId INTEGER NOT NULL,
+        scheduledSec REAL NOT NULL,
+        dimension TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (cronId, jobId, dimension, key)
+    ) WITHOUT ROWID;
+    CREATE INDEX trends_time ON trends (cronId, scheduledSec);
+    CREATE TABLE trend_days (
+        cronId INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        dimension TEXT NOT NULL,
+        key TEXT NOT NULL,
+        total REAL NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (cronId, day, dimension, key)
+    ) WITHOUT ROWID;
+    INSERT INTO trends (cronId, jobId, scheduledSec, dimension, key, value)
+        SELECT analyses.cronId, analyses.jobId, jobs.scheduledSec, d.key, k.key, k.value
+        FROM analyses JOIN jobs USING (jobId), json_each(analyses.indicators) AS d,
+            json_each(d.value) AS k
+        WHERE analyses.finished = 1 AND jobs.scheduledSec IS NOT NULL
+            AND d.type = 'object' AND k.type IN ('real', 'integer');
+    INSERT INTO trend_days (cronId, day, dimension, key, total, count)
+        SELECT cronId, CAST(scheduledSec / 86400 AS INTEGER), dimension, key,
+            sum(value), count(*)
+        FROM trends GROUP BY 1, 2, 3, 4;
+    ''',
+    # 13: jobs imported from jobs.json after migration 6 had no scheduledSec
+    '''
+    UPDATE jobs SET scheduledSec = json_extract(data, '$.lastScheduledSec')
+        WHERE scheduledSec IS NULL;
+    ''',
+    # 14: trend points of the analyses of those jobs, missed by migration 12
+    '''
+    INSERT OR IGNORE INTO trends (cronId, jobId, scheduledSec, dimension, key, value)
+        SELECT analyses.cronId, analyses.jobId, jobs.scheduledSec, d.key, k.key, k.value
+        FROM analyses JOIN jobs USING (jobId), json_each(analyses.indicators) AS d,
+            json_each(d.value) AS k
+        WHERE analyses.finished = 1 AND jobs.scheduledSec IS NOT NULL
+            AND d.type = 'object' AND k.type IN ('real', 'integer');
+    DELETE FROM trend_days;
+    INSERT INTO trend_days (cronId, day, dimension, key, total, count)
+        SELECT cronId, CAST(scheduledSec / 86400 AS INTEGER), dimension, key,
+            sum(value), count(*)
+        FROM trends GROUP BY 1, 2, 3, 4;
+    ''',
+]
+
+HEARTBEAT_WORKER = 'worker'
+HEARTBEAT_ANALYZER = 'analyzer'
+
+# revisioned collections, as served by /job, /job/submission, /analysis,
+# /uptime and /uptime2
+REVISION_JOB = 'job'
+REVISION_SUBMISSION = 'submission'
+REVISION_ANALYSIS = 'analysis'
+REVISION_HEARTBEAT = {
+    HEARTBEAT_WORKER: 'uptime',
+    HEARTBEAT_ANALYZER: 'uptime2',
+}
+
+METRIC_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+# as measured by the snapshot clients' readiness checks
+CAPTURE_WAIT_PHASES = ('ready', 'checkReady', 'settle', 'stable')
+METRIC_FAMILIES = {
+    'snpshtr_http_requests_total':
+        ('counter', 'HTTP requests by route, method and status.'),
+    'snpshtr_http_request_duration_seconds':
+        ('histogram', 'HTTP request latency by route, long-polls included.'),
+    'snpshtr_operation_duration_seconds':
+        ('histogram', 'Time spent in database transactions, filesystem scans and zip reads.'),
+    'snpshtr_upload_bytes_total':
+        ('counter', 'Bytes received by upload route.'),
+    'snpshtr_capture_wait_seconds':
+        ('histogram', 'Time workers waited for pages to be ready, per job and phase.'),
+    'snpshtr_schedule_delay_seconds':
+        ('histogram', 'How late the scheduler created jobs after their cron was due.'),
+}
+
+
+def metric_labels(labels: dict[str, Any]) -> str:
+    return ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in sorted(labels.items(), key=lambda kv: (kv[0] == 'le', kv[0])))
+
+
+class Metrics:
+    # recording only adds to per-process deltas; flush() adds them to the
+    # metrics table, so a scrape sees every gunicorn worker's share
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.pending: dict[tuple[str, str], float] = dict()
+
+    def inc(self, name: str, labels: dict[str, Any], value: float = 1.):
+        key = (name, metric_labels(labels))
+        with self.lock:
+            self.pending[key] = self.pending.get(key, 0.)+value
+
+    def observe(self, name: str, labels: dict[str, Any], sec: float):
+        with self.lock:
+            for le in [*(b for b in METRIC_BUCKETS if sec <= b), '+Inf']:
+                key = (f'{name}_bucket', metric_labels({**labels, 'le': le}))
+                self.pending[key] = self.pending.get(key, 0.)+1
+            for suffix, value in (('_sum', sec), ('_count', 1.)):
+                key = (f'{name}{suffix}', metric_labels(labels))
+                self.pending[key] = self.pending.get(key, 0.)+value
+
+    @contextmanager
+    def timed(self, op: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('snpshtr_operation_duration_seconds', dict(op=op),
+                         time.perf_counter()-started)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+        if not pending:
+            return
+        with transaction() as conn:
+            conn.executemany(
+                'INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?) '
+                'ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value',
+                [(name, labels, value) for (name, labels), value in pending.items()])
+
+
+METRICS = Metrics()
+atexit.register(METRICS.flush)
+
+_db_local = threading.local()
+
+
+def db() -> sqlite3.Connection:
+    # one connection per thread and per process, as gunicorn forks after --preload
+    conn: sqlite3.Connection | None = getattr(_db_local, 'conn', None)
+    if conn is None or getattr(_db_local, 'pid', None) != os.getpid():
+        conn = sqlite3.connect(STATE_DB, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _db_local.conn = conn
+        _db_local.pid = os.getpid()
+    return conn
+
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    conn = db()
+    if conn.in_transaction:
+        # nested call, the outermost transaction commits
+        yield conn
+        return
+    with METRICS.timed('db_transaction'):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
 
 def next_id(name: str) -> int:
-    ids = json.loads(ID_DB.read_text(encoding='utf-8'))
-    if name not in ids:
-        ids[name] = 0
-    ids[name] += 1
-    TempFile.save_utf8(ID_DB, json.dumps(ids, indent=2))
-    return ids[name]
+    with transaction() as conn:
+        conn.execute(
+            'INSERT INTO ids (name, value) VALUES (?, 1) '
+            'ON CONFLICT (name) DO UPDATE SET value = value + 1',
+            (name,))
+        return conn.execute(
+            'SELECT value FROM ids WHERE name = ?', (name,)).fetchone()[0]
+
+
+def bump_revision(collection: str) -> int:
+    return next_id(f'revision.{collection}')
+
+
+def current_revision(collection: str) -> int:
+    row = db().execute('SELECT value FROM ids WHERE name = ?',
+                       (f'revision.{collection}',)).fetchone()
+    return 0 if row is None else row[0]
+
+
+def db_record_tombstone(conn: sqlite3.Connection, collection: str, key: str | int):
+    conn.execute(
+        'INSERT INTO tombstones (collection, key, revision) VALUES (?, ?, ?)',
+        (collection, str(key), bump_revision(collection)))
+
+
+def cron_from_row(row: sqlite3.Row) -> dict[str, Any]:
+    return {**json.loads(row['data']), 'lastScheduledSec': row['lastScheduledSec']}
+
+
+def job_from_row(row: sqlite3.Row) -> dict[str, Any]:
+    return json.loads(row['data'])
+
+
+def analysis_from_row(row: sqlite3.Row) -> dict[str, Any]:
+    return dict(
+        cronId=row['cronId'],
+        jobId=row['jobId'],
+        finished=bool(row['finished']),
+        assignee=row['assignee'],
+        assigneeTime=row['assigneeTime'],
+        completeness=row['completeness'],
+        workers=json.loads(row['workers']),
+        analysisFile=row['analysisFile'],
+        indicators=None if row['indicators'] is None else json.loads(
+            row['indicators']),
+    )
+
+
+def analysis_summary_from_row(row: sqlite3.Row) -> dict[str, Any]:
+    return dict(
+        cronId=row['cronId'],
+        jobId=row['jobId'],
+        finished=bool(row['finished']),
+        assignee=row['assignee'],
+        completeness=row['completeness'],
+        analysisFile=row['analysisFile'],
+        indicators=None if row['indicators'] is None else json.loads(
+            row['indicators']),
+    )
+
+
+def db_insert_cron(conn: sqlite3.Connection, cron: dict[str, Any]):
+    conn.execute(
+        'INSERT INTO crons (cronId, hours, historySize, lastScheduledSec, data) '
+        'VALUES (?, ?, ?, ?, ?)',
+        (cron['cronId'], cron['hours'], cron['historySize'],
+         cron['lastScheduledSec'], json.dumps(cron)))
+
+
+def db_insert_job(conn: sqlite3.Connection, job: dict[str, Any],
+                  dueSec: float | None = None, scheduledSec: float | None = None):
+    conn.execute(
+        'INSERT INTO jobs (jobId, cronId, data, dueSec, scheduledSec, '
+        'revision, submissionRevision) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (job['jobId'], job['cronId'], json.dumps(job), dueSec, scheduledSec,
+         bump_revision(REVISION_JOB), bump_revision(REVISION_SUBMISSION)))
+    conn.execute(
+        'INSERT OR IGNORE INTO pending_jobs (worker, jobId) '
+        'SELECT worker, ? FROM heartbeats WHERE kind = ?',
+        (job['jobId'], HEARTBEAT_WORKER))
+
+
+def db_upsert_analysis(conn: sqlite3.Connection, anal: dict[str, Any]):
+    indicators = anal.get('indicators')
+    if indicators is None and anal.get('analysis') is not None:
+        # legacy records embedded the whole report, only indicators are kept
+        indicators = anal['analysis']['indicators']
+    conn.execute(
+        'INSERT OR REPLACE INTO analyses (jobId, cronId, finished, assignee, '
+        'assigneeTime, completeness, workers, analysisFile, indicators, revision) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (anal['jobId'], anal['cronId'], int(anal['finished']), anal['assignee'],
+         anal['assigneeTime'] or .0, anal['completeness'],
+         json.dumps(anal['workers']), anal['analysisFile'],
+         None if indicators is None else json.dumps(indicators),
+         bump_revision(REVISION_ANALYSIS)))
+    if anal['finished'] and indicators is not None:
+        db_record_trend(conn, anal['jobId'], indicators)
+
+
+def db_record_trend(conn: sqlite3.Connection, jobId: int, indicators: dict[str, Any]):
+    # per job averages of each dimension, plus their sums per day; a job
+    # analysed again replaces its earlier points
+    row = conn.execute(
+        'SELECT cronId, scheduledSec FROM jobs WHERE jobId = ?', (jobId,)).fetchone()
+    if row is None or row['scheduledSec'] is None:
+        return
+    cronId, scheduledSec = row['cronId'], row['scheduledSec']
+    day = int(scheduledSec // TREND_DAY_SEC)
+    for old in conn.execute(
+            'SELECT dimension, key, value FROM trends WHERE cronId = ? AND jobId = ?',
+            (cronId, jobId)).fetchall():
+        conn.execute(
+            'UPDATE trend_days SET total = total - ?, count = count - 1 '
+            'WHERE cronId = ? AND day = ? AND dimension = ? AND key = ?',
+            (old['value'], cronId, day, old['dimension'], old['key']))
+    conn.execute('DELETE FROM trends WHERE cronId = ? AND jobId = ?', (cronId, jobId))
+    conn.execute('DELETE FROM trend_days WHERE cronId = ? AND day = ? AND count <= 0',
+                 (cronId, day))
+    for dimension, values in indicators.items():
+        if not isinstance(values, dict):
+            continue
+        for key, value in values.items():
+            if not isinstance(value, (int, float)):
+                continue
+            conn.execute(
+                'INSERT INTO trends (cronId, jobId, scheduledSec, dimension, key, value) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (cronId, jobId, scheduledSec, dimension, key, value))
+            conn.execute(
+                'INSERT INTO trend_days (cronId, day, dimension, key, total, count) '
+                'VALUES (?, ?, ?, ?, ?, 1) ON CONFLICT (cronId, day, dimension, key) '
+                'DO UPDATE SET total = total + excluded.total, count = count + 1',
+                (cronId, day, dimension, key, value))
+
+
+def db_record_heartbeat(kind: str, worker: str, tm: float,
+                        info: dict[str, Any] | None = None) -> bool:
+    with transaction() as conn:
+        row = conn.execute(
+            'SELECT lastSeenSec, info FROM heartbeats WHERE kind = ? AND worker = ?',
+            (kind, worker)).fetchone()
+        if row is not None:
+            tm = max(tm, row['lastSeenSec'])
+            info = {**json.loads(row['info']), **(info or {})}
+        conn.execute(
+            'INSERT INTO heartbeats (kind, worker, lastSeenSec, info, revision) '
+            'VALUES (?, ?, ?, ?, ?) ON CONFLICT (kind, worker) DO UPDATE SET '
+            'lastSeenSec = excluded.lastSeenSec, info = excluded.info, '
+            'revision = excluded.revision',
+            (kind, worker, tm, json.dumps(info or {}),
+             bump_revision(REVISION_HEARTBEAT[kind])))
+    return row is None
+
+
+def record_heartbeat(kind: str, worker: str, tm: float,
+                     on_new: Callable[[sqlite3.Connection], None] | None = None,
+                     **info) -> bool:
+    # one short write transaction per poll, so every gunicorn worker serves
+    # the same heartbeats under the same revision; a worker seen for the
+    # first time also changes the job queues, in the same transaction
+    with transaction() as conn:
+        isNew = db_record_heartbeat(kind, worker, tm, info)
+        if isNew and on_new is not None:
+            on_new(conn)
+    return isNew
+
+
+def db_enqueue_all_jobs(conn: sqlite3.Connection, worker: str):
+    conn.execute(
+        'INSERT OR IGNORE INTO pending_jobs (worker, jobId) '
+        'SELECT ?, jobId FROM jobs WHERE jobId NOT IN '
+        '(SELECT jobId FROM submissions WHERE worker = ?)',
+        (worker, worker))
+
+
+def rebuild_pending_jobs(conn: sqlite3.Connection):
+    conn.execute('DELETE FROM pending_jobs')
+    for (worker,) in conn.execute(
+            'SELECT worker FROM heartbeats WHERE kind = ?',
+            (HEARTBEAT_WORKER,)).fetchall():
+        db_enqueue_all_jobs(conn, worker)
+
+
+def db_get_heartbeat_details(kind: str, since: int = -1) -> dict[str, dict[str, Any]]:
+    return {
+        row['worker']: {**json.loads(row['info']), 'lastSeenSec': row['lastSeenSec']}
+        for row in db().execute(
+            'SELECT worker, lastSeenSec, info FROM heartbeats '
+            'WHERE kind = ? AND revision > ? ORDER BY rowid',
+            (kind, since))}
+
+
+def db_get_heartbeats(kind: str, since: int = -1) -> dict[str, float]:
+    return {worker: hb['lastSeenSec']
+            for worker, hb in db_get_heartbeat_details(kind, since).items()}
+
+
+def tombstone_floor(collection: str) -> int:
+    row = db().execute('SELECT value FROM ids WHERE name = ?',
+                       (f'tombstones.{collection}',)).fetchone()
+    return 0 if row is None else row[0]
+
+
+def db_get_tombstones(collection: str, since: int) -> list[str]:
+    return [row[0] for row in db().execute(
+        'SELECT key FROM tombstones WHERE collection = ? AND revision > ?',
+        (collection, since))]
+
+
+def migrate_legacy_json_databases(conn: sqlite3.Connection):
+    # one-shot import of the JSON files this server used before SQLite;
+    # imported files are renamed so that they are never imported again
+    legacy_files: list[Path] = []
+    if LEGACY_ID_DB.exists():
+        legacy_files.append(LEGACY_ID_DB)
+        for name, value in json.loads(LEGACY_ID_DB.read_text(encoding='utf-8')).items():
+            conn.execute(
+                'INSERT OR REPLACE INTO ids (name, value) VALUES (?, ?)', (name, value))
+    if LEGACY_CRON_DB.exists():
+        legacy_files.append(LEGACY_CRON_DB)
+        for cron in json.loads(LEGACY_CRON_DB.read_text(encoding='utf-8')):
+            db_insert_cron(conn, cron)
+    if LEGACY_JOB_DB.exists():
+        legacy_files.append(LEGACY_JOB_DB)
+        for job in json.loads(LEGACY_JOB_DB.read_text(encoding='utf-8')):
+            # a legacy job is a copy of its cron taken when it was scheduled
+            db_insert_job(conn, job, scheduledSec=job.get('lastScheduledSec'))
+    if LEGACY_ANAL_DB.exists():
+        legacy_files.append(LEGACY_ANAL_DB)
+        for anal in json.loads(LEGACY_ANAL_DB.read_text(encoding='utf-8')):
+            db_upsert_analysis(conn, anal)
+    for kind, legacy_db in ((HEARTBEAT_WORKER, LEGACY_UPTIME_DB),
+                            (HEARTBEAT_ANALYZER, LEGACY_UPTIME2_DB)):
+        if legacy_db.exists():
+            legacy_files.append(legacy_db)
+            for worker, tm in json.loads(legacy_db.read_text(encoding='utf-8')).items():
+                conn.execute(
+                    'INSERT OR REPLACE INTO heartbeats (kind, worker, lastSeenSec) '
+                    'VALUES (?, ?, ?)', (kind, worker, tm))
+    if len(legacy_files):
+        reconcile_submissions(conn)
+    return legacy_files
+
+
+def sha256_file(path: Path) -> str:
+    m = hashlib.sha256()
+    with path.open('rb') as f:
+        while chunk := f.read(2**20):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def db_record_submission(conn: sqlite3.Connection, jobId: int, worker: str,
+                         path: Path, size: int, sha256: str, tm: float):
+    conn.execute(
+        'INSERT OR REPLACE INTO submissions '
+        '(jobId, worker, path, submittedSec, size, sha256) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        (jobId, worker, str(path), tm, size, sha256))
+    conn.execute(
+        'UPDATE jobs SET submissionRevision = ? WHERE jobId = ?',
+        (bump_revision(REVISION_SUBMISSION), jobId))
+    conn.execute(
+        'DELETE FROM pending_jobs WHERE worker = ? AND jobId = ?',
+        (worker, jobId))
+
+
+def reconcile_submissions(conn: sqlite3.Connection) -> tuple[int, int]:
+    # rebuilds the submission index from what is actually under jobs/;
+    # files whose size and mtime match their row are not hashed again
+    known: dict[tuple[int, str], sqlite3.Row] = {
+        (row['jobId'], row['worker']): row
+        for row in conn.execute('SELECT * FROM submissions')}
+    seen: set[tuple[int, str]] = set()
+    updated = 0
+    with METRICS.timed('fs_scan'):
+        job_paths = [*JOBS_PATH.iterdir()] if JOBS_PATH.exists() else []
+    for job_path in job_paths:
+        if not job_path.is_dir() or not job_path.name.isdigit():
+            continue
+        for workerzip in job_path.glob('*.zip'):
+            if workerzip.name == 'analysis.zip':
+                continue
+            key = (int(job_path.name), workerzip.stem)
+            seen.add(key)
+            st = workerzip.stat()
+            row = known.get(key)
+            if (row is not None and row['size'] == st.st_size and
+                    row['submittedSec'] == st.st_mtime and row['sha256']):
+                continue
+            db_record_submission(conn, *key, workerzip, st.st_size,
+                                 sha256_file(workerzip), st.st_mtime)
+            updated += 1
+    for row in conn.execute('SELECT * FROM archives').fetchall():
+        archive = Path(row['archive'])
+        if (archive.parent.parent != JOBS_PATH or not archive.parent.name.isdigit() or
+                archive.name == 'analysis.zip' or archive.exists()):
+            continue
+        key = (int(archive.parent.name), archive.stem)
+        seen.add(key)
+        if key not in known:
+            db_record_submission(conn, *key, archive, row['size'], row['sha256'],
+                                 row['mtimeNs']/1e9)
+            updated += 1
+    removed = 0
+    for jobId, worker in known.keys() - seen:
+        conn.execute(
+            'DELETE FROM submissions WHERE jobId = ? AND worker = ?', (jobId, worker))
+        conn.execute(
+            'UPDATE jobs SET submissionRevision = ? WHERE jobId = ?',
+            (bump_revision(REVISION_SUBMISSION), jobId))
+        removed += 1
+    return updated, removed
+
+
+def refresh_analysis(conn: sqlite3.Connection, jobId: int):
+    # (re)plans the analysis of a job whenever its set of submissions changes
+    job = conn.execute(
+        'SELECT cronId FROM jobs WHERE jobId = ?', (jobId,)).fetchone()
+    if job is None:
+        return
+    submissions: dict[str, str] = {
+        row['worker']: row['path'] for row in conn.execute(
+            'SELECT worker, path FROM submissions WHERE jobId = ?', (jobId,))}
+    workers: dict[str, str | None] = {
+        worker: submissions.get(worker)
+        for (worker,) in conn.execute(
+            'SELECT worker FROM heartbeats WHERE kind = ? ORDER BY rowid',
+            (HEARTBEAT_WORKER,))}
+    completeness = len([*filter(lambda f: f is not None, workers.values())])
+    anal = conn.execute(
+        'SELECT completeness FROM analyses WHERE jobId = ?', (jobId,)).fetchone()
+    if anal is None or anal['completeness'] != completeness:
+        db_upsert_analysis(conn, dict(
+            cronId=job['cronId'],
+            jobId=jobId,
+            finished=False,
+            assignee=None,
+            assigneeTime=.0,
+            completeness=completeness,
+            workers=workers,
+            analysisFile=None,
+            indicators=None,
+        ))
+
+
+def refresh_all_analyses(conn: sqlite3.Connection):
+    for (jobId,) in conn.execute('SELECT jobId FROM jobs').fetchall():
+        refresh_analysis(conn, jobId)
+
+
+def init_db():
+    with transaction() as conn:
+        version: int = conn.execute('PRAGMA user_version').fetchone()[0]
+        for i, migration in enumerate(SCHEMA_MIGRATIONS[version:], version+1):
+            for statement in filter(str.strip, migration.split(';')):
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {i}')
+        legacy_files = migrate_legacy_json_databases(conn)
+        rebuild_pending_jobs(conn)
+        refresh_all_analyses(conn)
+    for legacy_file in legacy_files:
+        legacy_file.rename(legacy_file.with_suffix('.json.migrated'))
+
+
+init_db()
+
+
+_T = TypeVar('_T')
+
+
+def long_poll(task: Callable[[], _T | None], timeout: float) -> _T | None:
+    # reruns task only after some other connection committed a change, which
+    # PRAGMA data_version tells for the price of reading a counter
+    deadline = time.time() + min(timeout, LONG_POLL_MAX_SEC)
+    conn = db()
+    while True:
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        result = task()
+        if result is not None:
+            return result
+        while conn.execute('PRAGMA data_version').fetchone()[0] == version:
+            if time.time() >= deadline:
+                return None
+            time.sleep(LONG_POLL_INTERVAL_SEC)
+
+
+def request_longpoll_sec() -> float:
+    # how long the caller is willing to wait, long_poll caps it
+    try:
+        return max(0., float(request.args.get('longpoll', '0')))
+    except ValueError:
+        raise werkzeug.exceptions.BadRequest('longpoll must be a number of seconds')
+
+
+def revisioned_response(collection: str,
+                        full: Callable[[], Any],
+                        delta: Callable[[int], tuple[Any, list[Any]]]):
+    # the revision is read before the rows, so a concurrent write can only
+    # make the ETag older than the body, never newer: clients refetch it
+    revision = current_revision(collection)
+    etag = f'{collection}-{revision}'
+    if request.if_none_match.contains(etag):
+        resp = make_response('')
+        resp.status_code = 304
+    elif 'since' in request.args:
+        try:
+            since = int(request.args['since'])
+        except ValueError:
+            raise werkzeug.exceptions.BadRequest('since must be a revision number')
+        if since < tombstone_floor(collection):
+            # deletions that old were collected, only a full reload is exact
+            raise werkzeug.exceptions.Gone('since is older than the retained tombstones')
+        rows, deleted = delta(since)
+        resp = jsonify(dict(revision=revision, rows=rows, deleted=deleted))
+    else:
+        resp = jsonify(full())
+    resp.set_etag(etag)
+    resp.headers['X-Revision'] = str(revision)
+    resp.cache_control.no_cache = True
+    return resp
 
 
 @app.route('/', methods=['HEAD', 'OPTIONS', 'GET'])
@@ -107,129 +889,387 @@ def index():
     return 'Nothing to see here'
 
 
-def get_updated_job_list() -> list[dict[str, Any]]:
-    tm = time.time()
-    anals: list[dict[str, Any]] = json.loads(
-        ANAL_DB.read_text(encoding='utf-8'))
-    crons: list[dict[str, Any]] = json.loads(
-        CRON_DB.read_text(encoding='utf-8'))
-    jobs: list[dict[str, Any]] = json.loads(JOB_DB.read_text(encoding='utf-8'))
-    pendingCrons: list[dict[str, Any]] = (
-        [*filter(lambda c: (tm-c['hours']*3600) > c['lastScheduledSec'], crons)])
-    for pendingCron in pendingCrons:
-        pendingCron['lastScheduledSec'] = tm
-        jobs.append(dict(jobId=next_id('job'), **pendingCron))
-    if len(pendingCrons):
-        cronId2historySize: dict[int, int] = dict(
-            map(lambda c: (c['cronId'], c['historySize']), crons))
-        #
-        cronId2jobpos: dict[int, list[int]] = defaultdict(list)
-        for i, job in enumerate(jobs):
-            cronId2jobpos[job['cronId']].append(i)
-        toDiscardPos: list[int] = list()
-        for cronId, jobspos in cronId2jobpos.items():
-            toDiscardPos += jobspos[:-round(cronId2historySize[cronId])]
-        #
-        for pos in toDiscardPos:
-            anals = [*filter(
-                lambda a: a["jobId"] != jobs[pos]["jobId"],
-                anals)]
-        #
-        toDiscardPos.sort()
-        toDiscardPos.reverse()
-        for pos in toDiscardPos:
-            job = jobs.pop(pos)
-            job_path = JOBS_PATH.joinpath(f'{job["jobId"]:020d}')
-            shutil.rmtree(job_path, ignore_errors=True)
-        TempFile.save_utf8(ANAL_DB, json.dumps(anals, indent=2))
-        TempFile.save_utf8(CRON_DB, json.dumps(crons, indent=2))
-        TempFile.save_utf8(JOB_DB, json.dumps(jobs, indent=2))
-    return jobs
+def schedule_due_crons(tm: float) -> list[dict[str, Any]]:
+    with transaction() as conn:
+        pendingCrons: list[dict[str, Any]] = [
+            *map(cron_from_row, conn.execute(
+                'SELECT data, lastScheduledSec FROM crons '
+                'WHERE lastScheduledSec < ? - hours*3600 ORDER BY cronId',
+                (tm,)))]
+        newJobs: list[dict[str, Any]] = list()
+        for pendingCron in pendingCrons:
+            dueSec = pendingCron['lastScheduledSec'] + \
+                pendingCron['hours']*3600
+            pendingCron['lastScheduledSec'] = tm
+            conn.execute(
+                'UPDATE crons SET lastScheduledSec = ?, data = ? WHERE cronId = ?',
+                (tm, json.dumps(pendingCron), pendingCron['cronId']))
+            job = dict(jobId=next_id('job'), **pendingCron)
+            db_insert_job(conn, job, dueSec, tm)
+            METRICS.observe('snpshtr_schedule_delay_seconds', dict(), tm-dueSec)
+            refresh_analysis(conn, job['jobId'])
+            newJobs.append(job)
+    return newJobs
+
+
+def trim_job_history(conn: sqlite3.Connection) -> list[int]:
+    # jobs beyond their cron's historySize and jobs of deleted crons;
+    # their folders are left to collect_job_folders
+    discardedJobIds: list[int] = [row[0] for row in conn.execute(
+        'SELECT jobId FROM jobs WHERE cronId NOT IN (SELECT cronId FROM crons)')]
+    for cronId, historySize in conn.execute(
+            'SELECT cronId, historySize FROM crons').fetchall():
+        if round(historySize) <= 0:
+            continue
+        discardedJobIds += [row[0] for row in conn.execute(
+            'SELECT jobId FROM jobs WHERE cronId = ? '
+            'ORDER BY jobId DESC LIMIT -1 OFFSET ?',
+            (cronId, round(historySize)))]
+    for jobId in discardedJobIds:
+        conn.execute('DELETE FROM jobs WHERE jobId = ?', (jobId,))
+        conn.execute('DELETE FROM analyses WHERE jobId = ?', (jobId,))
+        conn.execute('DELETE FROM submissions WHERE jobId = ?', (jobId,))
+        conn.execute('DELETE FROM pending_jobs WHERE jobId = ?', (jobId,))
+        db_release_job_archives(conn, jobId)
+        for collection in (REVISION_JOB, REVISION_SUBMISSION, REVISION_ANALYSIS):
+            db_record_tombstone(conn, collection, jobId)
+    # an upload can land between its job check and the trim
+    for table in ('analyses', 'submissions', 'pending_jobs'):
+        conn.execute(f'DELETE FROM {table} WHERE jobId NOT IN (SELECT jobId FROM jobs)')
+    # trends outlive the jobs they were computed from, not their cron
+    for table in ('trends', 'trend_days'):
+        conn.execute(f'DELETE FROM {table} WHERE cronId NOT IN (SELECT cronId FROM crons)')
+    return discardedJobIds
+
+
+def prune_tombstones(conn: sqlite3.Connection) -> int:
+    pruned = 0
+    for (collection,) in conn.execute(
+            'SELECT DISTINCT collection FROM tombstones').fetchall():
+        floor = current_revision(collection) - TOMBSTONE_KEEP_REVISIONS
+        if floor <= tombstone_floor(collection):
+            continue
+        pruned += conn.execute(
+            'DELETE FROM tombstones WHERE collection = ? AND revision <= ?',
+            (collection, floor)).rowcount
+        conn.execute(
+            'INSERT INTO ids (name, value) VALUES (?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET value = excluded.value',
+            (f'tombstones.{collection}', floor))
+    return pruned
+
+
+def remove_path(path: Path) -> int:
+    # returns the bytes freed
+    try:
+        if path.is_dir():
+            with METRICS.timed('rmtree'):
+                size = sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+                shutil.rmtree(path, ignore_errors=True)
+        else:
+            size = path.stat().st_size
+            path.unlink()
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+def is_stale(path: Path, tm: float, age: float) -> bool:
+    try:
+        return path.stat().st_mtime < tm-age
+    except FileNotFoundError:
+        return False
+
+
+def collect_job_folders(tm: float) -> dict[str, int]:
+    reclaimed = dict(jobs=0, analyses=0)
+    if not JOBS_PATH.exists():
+        return reclaimed
+    # listed before the database is read: a folder is only created for a
+    # job that already has its row, so every folder listed here that has
+    # none was discarded, never one created in between
+    with METRICS.timed('fs_scan'):
+        job_paths = [*JOBS_PATH.iterdir()]
+    conn = db()
+    jobIds = {row[0] for row in conn.execute('SELECT jobId FROM jobs')}
+    analysisFiles = {row[0] for row in conn.execute(
+        'SELECT analysisFile FROM analyses WHERE analysisFile IS NOT NULL')}
+    for job_path in job_paths:
+        if not job_path.is_dir() or not job_path.name.isdigit():
+            continue
+        if int(job_path.name) not in jobIds:
+            with transaction() as conn:
+                db_release_job_archives(conn, int(job_path.name))
+            reclaimed['jobs'] += remove_path(job_path)
+            continue
+        analysisFile = job_path.joinpath('analysis.zip')
+        st = archive_stat(analysisFile)
+        if str(analysisFile) not in analysisFiles and st is not None and \
+                st[0]/1e9 < tm-GC_GRACE_SEC:
+            # a report for an earlier set of submissions
+            if analysisFile.exists():
+                reclaimed['analyses'] += remove_path(analysisFile)
+            else:
+                with transaction() as conn:
+                    db_release_archive(conn, str(analysisFile))
+        for received in job_path.glob('*.receiving'):
+            # left behind by a server that died mid-upload
+            if is_stale(received, tm, GC_GRACE_SEC):
+                reclaimed['analyses'] += remove_path(received)
+    return reclaimed
+
+
+def collect_blobs(tm: float) -> int:
+    # under the write lock, so no archive can take a reference to a blob
+    # whose file is being removed; blobs uploaded for a manifest that is
+    # not committed yet are young and kept
+    reclaimed = 0
+    with transaction() as conn:
+        for (h,) in conn.execute('SELECT sha256 FROM blobs WHERE refs <= 0').fetchall():
+            if blob_path(h).exists() and not is_stale(blob_path(h), tm, GC_GRACE_SEC):
+                continue
+            conn.execute('DELETE FROM blobs WHERE sha256 = ?', (h,))
+            reclaimed += remove_path(blob_path(h))
+    return reclaimed
+
+
+def collect_garbage(tm: float) -> dict[str, int]:
+    with transaction() as conn:
+        discardedJobIds = trim_job_history(conn)
+        tombstones = prune_tombstones(conn)
+    reclaimed = collect_job_folders(tm)
+    reclaimed['blobs'] = collect_blobs(tm)
+    # leftovers of crashed uploads; the server, gc, reconcile and dedupe
+    # may all be running at once, so a temp file is only taken once stale
+    reclaimed['temp'] = sum(
+        remove_path(f) for f in Path('.').glob('*.temp') if is_stale(f, tm, GC_GRACE_SEC))
+    reclaimed['uploads'] = sum(
+        remove_path(f) for f in UPLOADS_PATH.glob('*.part')
+        if is_stale(f, tm, UPLOAD_PART_MAX_AGE_SEC))
+    total = sum(reclaimed.values())
+    with transaction() as conn:
+        conn.execute(
+            'INSERT INTO ids (name, value) VALUES (?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+            ('gc.reclaimedBytes', total))
+    print(f'[INFO] GC reclaimed {total} bytes '
+          f'({", ".join(f"{k}: {v}" for k, v in reclaimed.items())}), '
+          f'discarded {len(discardedJobIds)} jobs, pruned {tombstones} tombstones')
+    return dict(reclaimed, total=total, jobs_discarded=len(discardedJobIds),
+                tombstones=tombstones)
+
+
+def gc_due(tm: float) -> bool:
+    # claims the next run, so one gunicorn worker collects per interval
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT value FROM ids WHERE name = 'gc.lastRunSec'").fetchone()
+        if row is not None and row[0] > tm-GC_INTERVAL_SEC:
+            return False
+        conn.execute(
+            "INSERT INTO ids (name, value) VALUES ('gc.lastRunSec', ?) "
+            'ON CONFLICT (name) DO UPDATE SET value = excluded.value',
+            (int(tm),))
+    return True
+
+
+def gc_loop():
+    while True:
+        try:
+            if gc_due(time.time()):
+                collect_garbage(time.time())
+        except Exception:
+            print(traceback.format_exc())
+        time.sleep(SCHEDULER_INTERVAL_SEC)
 
 
-def worker_lastseen_update(name: str):
+def flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_SEC)
+        try:
+            METRICS.flush()
+        except Exception:
+            print(traceback.format_exc())
+
+
+def scheduler_tick():
+    schedule_due_crons(time.time())
+
+
+def scheduler_loop():
+    while True:
+        try:
+            scheduler_tick()
+        except Exception:
+            print(traceback.format_exc())
+        time.sleep(SCHEDULER_INTERVAL_SEC)
+
+
+_scheduler_lock = threading.Lock()
+_scheduler_pid: int | None = None
+
+
+def start_background_threads():
+    # every serving process gets its own scheduler thread (threads do not
+    # survive the fork after --preload); ticks are transactional, so extra
+    # schedulers only cost a cheap indexed query
+    global _scheduler_pid
+    if _scheduler_pid == os.getpid():
+        return
+    with _scheduler_lock:
+        if _scheduler_pid == os.getpid():
+            return
+        _scheduler_pid = os.getpid()
+        threading.Thread(target=scheduler_loop, name='scheduler',
+                         daemon=True).start()
+        threading.Thread(target=gc_loop, name='gc', daemon=True).start()
+        threading.Thread(target=flush_loop, name='flush', daemon=True).start()
+
+
+# gunicorn --preload imports this module once and forks its workers from
+# it, they start their threads right away rather than on their first
+# request; a server that does not fork starts them on its first request
+os.register_at_fork(after_in_child=start_background_threads)
+app.before_request(start_background_threads)
+
+
+@app.before_request
+def start_request_timer():
+    g.requestStartedSec = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(resp: Response) -> Response:
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    METRICS.inc('snpshtr_http_requests_total', dict(
+        route=route, method=request.method, status=resp.status_code))
+    if 'requestStartedSec' in g:
+        METRICS.observe('snpshtr_http_request_duration_seconds', dict(route=route),
+                        time.perf_counter()-g.requestStartedSec)
+    return resp
+
+
+def get_job_list(since: int = -1) -> list[dict[str, Any]]:
+    return [*map(job_from_row, db().execute(
+        'SELECT data FROM jobs WHERE revision > ? ORDER BY jobId', (since,)))]
+
+
+def client_info(**info) -> dict[str, Any]:
+    if 'version' in request.args:
+        info['version'] = request.args['version']
+    return info
+
+
+def capture_seconds(value: Any) -> float | None:
+    # timings only feed /uptime/details and /metrics, so one that is not a
+    # duration is dropped rather than failing the upload it came with
+    try:
+        sec = float(value)
+    except (TypeError, ValueError):
+        return None
+    return sec if math.isfinite(sec) and sec >= 0 else None
+
+
+def capture_info() -> dict[str, Any]:
+    # how long the worker spent on the job it is uploading, and how much of
+    # that went to waiting for pages to be ready, per phase
+    info: dict[str, Any] = dict()
+    if (captureSec := capture_seconds(request.args.get('captureSec'))) is not None:
+        info['captureSec'] = captureSec
+    try:
+        waits = json.loads(request.args.get('waitSec', 'null'))
+    except ValueError:
+        waits = None
+    if isinstance(waits, dict):
+        info['waitSec'] = dict()
+        for phase, sec in waits.items():
+            if (sec := capture_seconds(sec)) is not None:
+                info['waitSec'][str(phase)] = sec
+        for phase, sec in info['waitSec'].items():
+            # the label is client input, only known phases become series
+            if phase in CAPTURE_WAIT_PHASES:
+                METRICS.observe('snpshtr_capture_wait_seconds', dict(phase=phase), sec)
+    return info
+
+
+def worker_first_seen(conn: sqlite3.Connection, worker: str):
+    # a worker seen for the first time owes every job in history
+    db_enqueue_all_jobs(conn, worker)
+    # and shows up as a new column in every /job/submission row
+    conn.execute('UPDATE jobs SET submissionRevision = ?',
+                 (bump_revision(REVISION_SUBMISSION),))
+
+
+def worker_lastseen_update(name: str, **info):
     namestrip = name.strip()
     if len(namestrip) > 0:
-        uptimes: dict[str, float] = json.loads(
-            UPTIME_DB.read_text(encoding='utf-8'))
-        uptimes[namestrip] = time.time()
-        TempFile.save_utf8(UPTIME_DB, json.dumps(uptimes, indent=2))
+        record_heartbeat(HEARTBEAT_WORKER, namestrip, time.time(),
+                         lambda conn: worker_first_seen(conn, namestrip),
+                         **client_info(**info))
 
 
-def analizer_lastseen_update(name: str):
+def analizer_lastseen_update(name: str, **info):
     namestrip = name.strip()
     if len(namestrip) > 0:
-        uptimes: dict[str, float] = json.loads(
-            UPTIME2_DB.read_text(encoding='utf-8'))
-        uptimes[namestrip] = time.time()
-        TempFile.save_utf8(UPTIME2_DB, json.dumps(uptimes, indent=2))
+        record_heartbeat(HEARTBEAT_ANALYZER, namestrip, time.time(),
+                         **client_info(**info))
 
 
 def worker_get_next_job(worker: str) -> dict | None:
-    for job in get_updated_job_list():
-        if not JOBS_PATH.joinpath(f'{job["jobId"]:020d}/{worker}.zip').exists():
-            return job
-    return None
+    row = db().execute(
+        'SELECT jobs.data FROM pending_jobs JOIN jobs USING (jobId) '
+        'WHERE pending_jobs.worker = ? ORDER BY pending_jobs.jobId LIMIT 1',
+        (worker,)).fetchone()
+    return None if row is None else job_from_row(row)
 
 
-def get_updated_analysis_list() -> list[dict[str, Any]]:
-    jobs = raw_job_submission_get()
-    anals: list[dict[str, Any]] = json.loads(
-        ANAL_DB.read_text(encoding='utf-8'))
-    upd: bool = False
-    for job in jobs:
-        cronId = job['cronId']
-        jobId = job['jobId']
-        anal = next(filter(lambda a: a['jobId'] == jobId, anals), None)
-        completeness = len([*filter(
-            lambda f: f is not None,
-            job['workers'].values()
-        )])
-        if anal is None or anal['completeness'] != completeness:
-            upd = True
-            anal2 = dict(
-                cronId=cronId,
-                jobId=jobId,
-                finished=False,
-                assignee=None,
-                assigneeTime=.0,
-                completeness=completeness,
-                workers=job['workers'],
-                analysisFile=None,
-                analysis=None,
-            )
-            if anal is None:
-                anals.append(anal2)
-            else:
-                anal.update(anal2)
-    if upd:
-        TempFile.save_utf8(ANAL_DB, json.dumps(anals, indent=2))
-    return anals
+def worker_has_pending_job(worker: str, jobId: int) -> bool:
+    return db().execute(
+        'SELECT 1 FROM pending_jobs WHERE worker = ? AND jobId = ?',
+        (worker, jobId)).fetchone() is not None
 
 
 def analyzer_get_next_job(worker: str) -> dict | None:
     tm = time.time()
-    anals = get_updated_analysis_list()
-    for anal in anals:
-        if not anal['finished'] and anal['completeness'] > 0:
-            if anal['assignee'] == worker and anal['assigneeTime']+300 < tm:
-                return anal
-            elif not anal['assignee'] or anal['assigneeTime']+300 >= tm:
-                anal['assignee'] = worker
-                anal['assigneeTime'] = tm
-                TempFile.save_utf8(ANAL_DB, json.dumps(anals, indent=2))
-                return anal
-            else:
-                # this
-                #     unfinished job
-                # is considered to be
-                #     assigned and
-                #     still running
-                # so
-                #     try next job
-                pass
-    # there is no analysis to be ran
-    return None
+    with transaction() as conn:
+        # an analyzer that asks again gets its own unfinished lease back,
+        # otherwise the most complete and then oldest unleased analysis
+        row = conn.execute(
+            'SELECT * FROM analyses WHERE finished = 0 AND completeness > 0 '
+            'AND assignee = ? ORDER BY jobId LIMIT 1',
+            (worker,)).fetchone()
+        if row is None:
+            row = conn.execute(
+                'SELECT * FROM analyses WHERE finished = 0 AND completeness > 0 '
+                'AND (leaseExpiresSec IS NULL OR leaseExpiresSec < ?) '
+                'ORDER BY completeness DESC, jobId LIMIT 1',
+                (tm,)).fetchone()
+        if row is None:
+            # there is no analysis to be ran
+            return None
+        conn.execute(
+            'UPDATE analyses SET assignee = ?, assigneeTime = ?, leaseExpiresSec = ?, '
+            'revision = ? WHERE jobId = ?',
+            (worker, tm, tm+ANALYSIS_LEASE_SEC, bump_revision(REVISION_ANALYSIS),
+             row['jobId']))
+    return {**analysis_from_row(row), 'assignee': worker, 'assigneeTime': tm}
+
+
+def analyzer_extend_lease(worker: str, jobId: int, completeness: int) -> float | None:
+    leaseExpiresSec = time.time()+ANALYSIS_LEASE_SEC
+    with transaction() as conn:
+        updated = conn.execute(
+            'UPDATE analyses SET leaseExpiresSec = ? WHERE jobId = ? '
+            'AND assignee = ? AND completeness = ? AND finished = 0',
+            (leaseExpiresSec, jobId, worker, completeness)).rowcount
+    return leaseExpiresSec if updated else None
+
+
+def analyzer_holds_lease(worker: str, jobId: int, completeness: int) -> bool:
+    return db().execute(
+        'SELECT 1 FROM analyses WHERE jobId = ? AND assignee = ? '
+        'AND completeness = ? AND finished = 0',
+        (jobId, worker, completeness)).fetchone() is not None
 
 
 @app.route('/job/next', methods=['HEAD', 'OPTIONS', 'GET'])
@@ -239,15 +1279,102 @@ def job_next_get():
         resp.status_code = 404
         return resp
     worker = request.args.get('worker', '')
+    longpoll = request_longpoll_sec()
     worker_lastseen_update(worker)
-    next_job = worker_get_next_job(worker)
+    next_job = long_poll(lambda: worker_get_next_job(worker), longpoll)
     if next_job is None:
         resp = make_response('no new job')
         resp.status_code = 404
         return resp
+    record_heartbeat(HEARTBEAT_WORKER, worker.strip(), time.time(), jobId=next_job['jobId'])
     return jsonify({**JOB_DEFAULTS, **next_job})
 
 
+def upload_part_path(uploadId: str) -> Path:
+    if not 0 < len(uploadId) <= 64 or not UPLOAD_ID_CHARS.issuperset(uploadId):
+        raise werkzeug.exceptions.BadRequest('invalid uploadId')
+    return UPLOADS_PATH.joinpath(f'{uploadId}.part')
+
+
+def receive_upload(dest: Path) -> tuple[int, str]:
+    hashed = request.args.get('sha256', '')
+    uploadId = request.args.get('uploadId', '')
+    if not uploadId:
+        size, h = TempFile.save_stream(dest, request.stream, hashed)
+        METRICS.inc('snpshtr_upload_bytes_total', dict(route=request.url_rule.rule), size)
+        return size, h
+    # the body was sent beforehand through PUT /upload/<uploadId>; it is
+    # hashed where it lies and moved in, not copied a second time
+    part = upload_part_path(uploadId)
+    try:
+        fr = part.open('rb')
+    except FileNotFoundError:
+        raise werkzeug.exceptions.NotFound()
+    with fr:
+        try:
+            # a PUT still appending, or another commit of the same upload
+            fcntl.flock(fr, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise werkzeug.exceptions.Conflict('upload is busy')
+        try:
+            if not os.path.samestat(os.fstat(fr.fileno()), part.stat()):
+                raise FileNotFoundError(part)
+        except FileNotFoundError:
+            # committed by the request that held the lock before us
+            raise werkzeug.exceptions.Conflict('upload was already committed')
+        m = hashlib.sha256()
+        size = 0
+        while chunk := fr.read(UPLOAD_CHUNK_SIZE):
+            m.update(chunk)
+            size += len(chunk)
+        h = m.hexdigest()
+        if h != hashed:
+            raise ValueError('Sent data was not received right')
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(part, dest)
+    return size, h
+
+
+@app.route('/upload/<uploadId>', methods=['HEAD', 'OPTIONS', 'GET'])
+def upload_get(uploadId):
+    if APIKEY != request.args.get('key', '').strip():
+        resp = make_response('wrong value for GET parameter: key')
+        resp.status_code = 404
+        return resp
+    part = upload_part_path(uploadId)
+    return jsonify(dict(offset=part.stat().st_size if part.exists() else 0))
+
+
+@app.route('/upload/<uploadId>', methods=['PUT'])
+def upload_put(uploadId):
+    if APIKEY != request.args.get('key', '').strip():
+        resp = make_response('wrong value for GET parameter: key')
+        resp.status_code = 404
+        return resp
+    part = upload_part_path(uploadId)
+    UPLOADS_PATH.mkdir(parents=True, exist_ok=True)
+    with part.open('ab') as fa:
+        try:
+            # a retry may arrive while the first attempt is still streaming
+            fcntl.flock(fa, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            resp = jsonify(dict(offset=part.stat().st_size))
+            resp.status_code = 409
+            return resp
+        offset = fa.tell()
+        if int(request.args.get('offset', '0')) != offset:
+            # the client must resume from what actually reached the disk
+            resp = jsonify(dict(offset=offset))
+            resp.status_code = 409
+            return resp
+        while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+            fa.write(chunk)
+        fa.flush()
+        METRICS.inc('snpshtr_upload_bytes_total', dict(route=request.url_rule.rule),
+                    fa.tell()-offset)
+        return jsonify(dict(offset=fa.tell()))
+
+
 @app.route('/job', methods=['POST'])
 def job_post():
     if APIKEY != request.args.get('key', '').strip():
@@ -255,48 +1382,216 @@ def job_post():
         resp.status_code = 404
         return resp
     worker = request.args.get('worker', '')
+    if worker.strip() == '':
+        raise Exception('Unknown worker')
+    worker_lastseen_update(worker, jobId=None, **capture_info())
+    jobId = int(request.args.get('jobId', '0'))
+    if not worker_has_pending_job(worker, jobId):
+        raise ValueError('Wrong job')
+    workerzip = JOBS_PATH.joinpath(f'{jobId:020d}/{worker}.zip')
+    size, h = receive_upload(workerzip)
+    with transaction() as conn:
+        # a zip on disk replaces whatever was exploded under its name
+        db_release_archive(conn, str(workerzip))
+        db_record_submission(conn, jobId, worker, workerzip, size, h,
+                             workerzip.stat().st_mtime)
+        refresh_analysis(conn, jobId)
+    if BLOB_STORE:
+        explode_archive(workerzip, h)
+    return jsonify('OK')
+
+
+def request_manifest() -> dict[str, str]:
+    manifest = request.get_json(force=True)
+    if not isinstance(manifest, dict) or not all(
+            isinstance(k, str) and isinstance(v, str) and is_sha256(v)
+            for k, v in manifest.items()):
+        raise werkzeug.exceptions.BadRequest('manifest must map names to sha256')
+    return manifest
+
+
+def is_sha256(h: str) -> bool:
+    return len(h) == 64 and all(c in '0123456789abcdef' for c in h)
+
+
+def require_blob_store():
+    # delta uploads only exist with a blob store; without one, clients are
+    # told so by a 404 and send their zip to POST /job instead
+    if not BLOB_STORE:
+        raise werkzeug.exceptions.NotFound('delta uploads need BLOB_STORE=1')
+
+
+@app.route('/job/manifest', methods=['POST'])
+def job_manifest_post():
+    # first step of a delta upload: which of these blobs must be sent
+    if APIKEY != request.args.get('key', '').strip():
+        resp = make_response('wrong value for GET parameter: key')
+        resp.status_code = 404
+        return resp
+    require_blob_store()
+    worker = request.args.get('worker', '')
     if worker.strip() == '':
         raise Exception('Unknown worker')
     worker_lastseen_update(worker)
-    next_job = worker_get_next_job(worker)
+    if not worker_has_pending_job(worker, int(request.args.get('jobId', '0'))):
+        raise ValueError('Wrong job')
+    return jsonify(dict(missing=missing_blobs([*request_manifest().values()])))
+
+
+@app.route('/blob/<sha256>', methods=['PUT'])
+def blob_put(sha256):
+    if APIKEY != request.args.get('key', '').strip():
+        resp = make_response('wrong value for GET parameter: key')
+        resp.status_code = 404
+        return resp
+    require_blob_store()
+    if not is_sha256(sha256):
+        raise werkzeug.exceptions.BadRequest('invalid sha256')
+    if not blob_path(sha256).exists():
+        size, _ = TempFile.save_stream(blob_path(sha256), request.stream, sha256)
+        METRICS.inc('snpshtr_upload_bytes_total', dict(route=request.url_rule.rule), size)
+        with transaction() as conn:
+            conn.execute(
+                'INSERT INTO blobs (sha256, size, refs, crc) VALUES (?, ?, 0, ?) '
+                'ON CONFLICT (sha256) DO UPDATE SET crc = excluded.crc',
+                (sha256, size, crc32_file(blob_path(sha256))))
+    return jsonify('OK')
+
+
+@app.route('/job/commit', methods=['POST'])
+def job_commit_post():
+    # last step of a delta upload: the manifest becomes the submission
+    if APIKEY != request.args.get('key', '').strip():
+        resp = make_response('wrong value for GET parameter: key')
+        resp.status_code = 404
+        return resp
+    require_blob_store()
+    worker = request.args.get('worker', '')
+    if worker.strip() == '':
+        raise Exception('Unknown worker')
+    worker_lastseen_update(worker, jobId=None, **capture_info())
     jobId = int(request.args.get('jobId', '0'))
-    if next_job['jobId'] != jobId:
+    if not worker_has_pending_job(worker, jobId):
         raise ValueError('Wrong job')
-    hashed = request.args.get('sha256', '')
-    zfb = request.data
-    m = hashlib.sha256()
-    m.update(zfb)
-    h = m.hexdigest()
-    if h != hashed:
-        raise ValueError('Sent data was not received right')
-    TempFile.save_bytes(JOBS_PATH.joinpath(f'{jobId:020d}/{worker}.zip'), zfb)
+    workerzip = JOBS_PATH.joinpath(f'{jobId:020d}/{worker}.zip')
+    with transaction() as conn:
+        missing = commit_manifest(workerzip, request_manifest())
+        if missing:
+            resp = jsonify(dict(missing=missing))
+            resp.status_code = 409
+            return resp
+        row = conn.execute('SELECT * FROM archives WHERE archive = ?',
+                           (str(workerzip),)).fetchone()
+        db_record_submission(conn, jobId, worker, workerzip, row['size'], row['sha256'],
+                             row['mtimeNs']/1e9)
+        refresh_analysis(conn, jobId)
+    # an earlier full upload under the same name would shadow the manifest
+    workerzip.unlink(missing_ok=True)
     return jsonify('OK')
 
 
 @app.route('/job', methods=['HEAD', 'OPTIONS', 'GET'])
 def job_get():
-    return send_file(JOB_DB)
-
-
-def raw_job_submission_get() -> list[dict[str, Any]]:
-    jobs = json.loads(JOB_DB.read_text(encoding='utf-8'))
-    uptimes = json.loads(UPTIME_DB.read_text(encoding='utf-8'))
+    return revisioned_response(
+        REVISION_JOB,
+        get_job_list,
+        lambda since: (get_job_list(since),
+                       [*map(int, db_get_tombstones(REVISION_JOB, since))]))
+
+
+def raw_job_submission_get(since: int = -1) -> list[dict[str, Any]]:
+    jobs = [*map(job_from_row, db().execute(
+        'SELECT data FROM jobs WHERE submissionRevision > ? ORDER BY jobId',
+        (since,)))]
+    uptimes = db_get_heartbeats(HEARTBEAT_WORKER)
+    submissions: dict[tuple[int, str], str] = {
+        (row['jobId'], row['worker']): row['path']
+        for row in db().execute(
+            'SELECT submissions.jobId, submissions.worker, submissions.path '
+            'FROM submissions JOIN jobs USING (jobId) '
+            'WHERE jobs.submissionRevision > ?', (since,))}
     for job in jobs:
-        job['workers'] = dict()
-        for worker in uptimes:
-            workerzip = JOBS_PATH.joinpath(f'{job["jobId"]:020d}/{worker}.zip')
-            job['workers'][worker] = None if not workerzip.exists() else str(workerzip)
+        job['workers'] = {
+            worker: submissions.get((job['jobId'], worker))
+            for worker in uptimes}
     return jobs
 
 
+@app.route('/job/schedule', methods=['HEAD', 'OPTIONS', 'GET'])
+def job_schedule_get():
+    delays = [
+        dict(jobId=row['jobId'], cronId=row['cronId'], dueSec=row['dueSec'],
+             scheduledSec=row['scheduledSec'],
+             delaySec=row['scheduledSec']-row['dueSec'])
+        for row in db().execute(
+            'SELECT jobId, cronId, dueSec, scheduledSec FROM jobs '
+            'WHERE dueSec IS NOT NULL ORDER BY jobId')]
+    return jsonify(dict(
+        intervalSec=SCHEDULER_INTERVAL_SEC,
+        maxDelaySec=max((d['delaySec'] for d in delays), default=.0),
+        avgDelaySec=sum(d['delaySec'] for d in delays)/max(len(delays), 1),
+        jobs=delays,
+    ))
+
+
 @app.route('/job/submission', methods=['HEAD', 'OPTIONS', 'GET'])
 def job_submission_get():
-    return jsonify(raw_job_submission_get())
+    return revisioned_response(
+        REVISION_SUBMISSION,
+        raw_job_submission_get,
+        lambda since: (raw_job_submission_get(since),
+                       [*map(int, db_get_tombstones(REVISION_SUBMISSION, since))]))
 
 
 @app.route('/analysis', methods=['HEAD', 'OPTIONS', 'GET'])
 def analysis_get():
-    return send_file(ANAL_DB)
+    try:
+        limit = max(1, min(int(request.args.get('limit', ANALYSIS_PAGE_SIZE)),
+                           ANALYSIS_PAGE_SIZE_MAX))
+        where = ['analyses.jobId > ?']
+        params: list[Any] = [int(request.args.get('cursor', '0'))]
+        if 'cronId' in request.args:
+            where.append('analyses.cronId = ?')
+            params.append(int(request.args['cronId']))
+        if 'from' in request.args:
+            where.append('jobs.scheduledSec >= ?')
+            params.append(float(request.args['from']))
+        if 'to' in request.args:
+            where.append('jobs.scheduledSec < ?')
+            params.append(float(request.args['to']))
+    except ValueError:
+        raise werkzeug.exceptions.BadRequest('limit, cursor, cronId, from and to must be numbers')
+    anals: list[dict[str, Any]] = list()
+
+    def page(since: int = -1) -> list[dict[str, Any]]:
+        anals.extend(map(analysis_summary_from_row, db().execute(
+            'SELECT analyses.* FROM analyses JOIN jobs USING (jobId) '
+            f'WHERE {" AND ".join(where)} AND analyses.revision > ? '
+            'ORDER BY analyses.jobId LIMIT ?',
+            (*params, since, limit))))
+        return anals
+    resp = revisioned_response(
+        REVISION_ANALYSIS,
+        page,
+        lambda since: (page(since),
+                       [*map(int, db_get_tombstones(REVISION_ANALYSIS, since))]))
+    if len(anals) == limit:
+        resp.headers['X-Next-Cursor'] = str(anals[-1]['jobId'])
+    return resp
+
+
+@app.route('/analysis/<int:jobId>', methods=['HEAD', 'OPTIONS', 'GET'])
+def analysis_job_get(jobId: int):
+    row = db().execute(
+        'SELECT * FROM analyses WHERE jobId = ?', (jobId,)).fetchone()
+    if row is None:
+        raise werkzeug.exceptions.NotFound()
+    anal = analysis_from_row(row)
+    anal['analysis'] = None
+    if anal['analysisFile'] is not None and archive_stat(Path(anal['analysisFile'])):
+        anal['analysis'] = json.loads(read_zip_member(
+            Path(anal['analysisFile']), 'analysis.json').decode(encoding='utf-8'))
+    return jsonify(anal)
 
 
 @app.route('/analysis/next', methods=['HEAD', 'OPTIONS', 'GET'])
@@ -308,13 +1603,36 @@ def analysis_next_get():
     worker = request.args.get('worker', '')
     if worker.strip() == '':
         raise Exception('Unknown worker')
+    longpoll = request_longpoll_sec()
     analizer_lastseen_update(worker)
-    next_job = analyzer_get_next_job(worker)
+    next_job = long_poll(lambda: analyzer_get_next_job(worker), longpoll)
     if next_job is None:
         resp = make_response('no new job')
         resp.status_code = 404
         return resp
-    return jsonify(next_job)
+    record_heartbeat(HEARTBEAT_ANALYZER, worker.strip(), time.time(), jobId=next_job['jobId'])
+    return jsonify({**next_job, 'leaseSec': ANALYSIS_LEASE_SEC})
+
+
+@app.route('/analysis/lease', methods=['POST'])
+def analysis_lease_post():
+    if APIKEY != request.args.get('key', '').strip():
+        resp = make_response('wrong value for GET parameter: key')
+        resp.status_code = 404
+        return resp
+    worker = request.args.get('worker', '')
+    if worker.strip() == '':
+        raise Exception('Unknown worker')
+    analizer_lastseen_update(worker)
+    leaseExpiresSec = analyzer_extend_lease(
+        worker,
+        int(request.args.get('jobId', '0')),
+        int(request.args.get('completeness', '0')))
+    if leaseExpiresSec is None:
+        resp = make_response('lease lost')
+        resp.status_code = 409
+        return resp
+    return jsonify(dict(leaseExpiresSec=leaseExpiresSec))
 
 
 @app.route('/analysis', methods=['POST'])
@@ -326,52 +1644,178 @@ def analysis_post():
     worker = request.args.get('worker', '')
     if worker.strip() == '':
         raise Exception('Unknown worker')
-    analizer_lastseen_update(worker)
-    next_anal = analyzer_get_next_job(worker)
+    analizer_lastseen_update(worker, jobId=None)
     jobId = int(request.args.get('jobId', '0'))
     completeness = int(request.args.get('completeness', '0'))
-    if next_anal['assignee'] != worker:
+    if not analyzer_holds_lease(worker, jobId, completeness):
         raise ValueError('Wrong job')
-    if next_anal['jobId'] != jobId:
-        raise ValueError('Wrong job')
-    if next_anal['completeness'] != completeness:
-        raise ValueError('Wrong job')
-    hashed = request.args.get('sha256', '')
-    zfb = request.data
-    m = hashlib.sha256()
-    m.update(zfb)
-    h = m.hexdigest()
-    if h != hashed:
-        raise ValueError('Sent data was not received right')
     analysisFile = JOBS_PATH.joinpath(f'{jobId:020d}/analysis.zip')
-    TempFile.save_bytes(analysisFile, zfb)
-    zf = zipfile.ZipFile(BytesIO(zfb))
-    anals: list[dict[str, Any]] = json.loads(
-        ANAL_DB.read_text(encoding='utf-8'))
-    for anal in anals:
-        if anal['jobId'] == next_anal['jobId']:
-            anal['finished'] = True
-            anal['analysisFile'] = str(analysisFile)
-            anal['analysis'] = json.loads(
-                zf.read('analysis.json').decode(encoding='utf-8'))
-            break
-    TempFile.save_utf8(ANAL_DB, json.dumps(anals, indent=2))
+    # received aside and only moved in while holding the write lock, so an
+    # upload whose lease was lost cannot overwrite the winner's report
+    received = analysisFile.with_name(f'analysis.zip.{uuid4().hex}.receiving')
+    try:
+        _, h = receive_upload(received)
+        with zipfile.ZipFile(received, mode='r') as zf:
+            indicators = json.dumps(json.loads(
+                zf.read('analysis.json').decode(encoding='utf-8'))['indicators'])
+        with transaction() as conn:
+            # the lease may have been lost while the upload was in flight
+            if not conn.execute(
+                    'UPDATE analyses SET finished = 1, analysisFile = ?, indicators = ?, '
+                    'leaseExpiresSec = NULL, revision = ? WHERE jobId = ? AND assignee = ? '
+                    'AND completeness = ? AND finished = 0',
+                    (str(analysisFile), indicators, bump_revision(REVISION_ANALYSIS),
+                     jobId, worker, completeness)).rowcount:
+                raise ValueError('Wrong job')
+            db_record_trend(conn, jobId, json.loads(indicators))
+            db_release_archive(conn, str(analysisFile))
+            received.replace(analysisFile)
+    finally:
+        received.unlink(missing_ok=True)
+    if BLOB_STORE:
+        explode_archive(analysisFile, h)
     return jsonify('OK')
 
 
 @app.route('/uptime', methods=['HEAD', 'OPTIONS', 'GET'])
 def uptime_get():
-    return send_file(UPTIME_DB)
+    return revisioned_response(
+        REVISION_HEARTBEAT[HEARTBEAT_WORKER],
+        lambda: db_get_heartbeats(HEARTBEAT_WORKER),
+        lambda since: (db_get_heartbeats(HEARTBEAT_WORKER, since), []))
 
 
 @app.route('/uptime2', methods=['HEAD', 'OPTIONS', 'GET'])
 def uptime2_get():
-    return send_file(UPTIME2_DB)
+    return revisioned_response(
+        REVISION_HEARTBEAT[HEARTBEAT_ANALYZER],
+        lambda: db_get_heartbeats(HEARTBEAT_ANALYZER),
+        lambda since: (db_get_heartbeats(HEARTBEAT_ANALYZER, since), []))
+
+
+@app.route('/uptime/details', methods=['HEAD', 'OPTIONS', 'GET'])
+def uptime_details_get():
+    return revisioned_response(
+        REVISION_HEARTBEAT[HEARTBEAT_WORKER],
+        lambda: db_get_heartbeat_details(HEARTBEAT_WORKER),
+        lambda since: (db_get_heartbeat_details(HEARTBEAT_WORKER, since), []))
+
+
+@app.route('/uptime2/details', methods=['HEAD', 'OPTIONS', 'GET'])
+def uptime2_details_get():
+    return revisioned_response(
+        REVISION_HEARTBEAT[HEARTBEAT_ANALYZER],
+        lambda: db_get_heartbeat_details(HEARTBEAT_ANALYZER),
+        lambda since: (db_get_heartbeat_details(HEARTBEAT_ANALYZER, since), []))
+
+
+def metric_line(name: str, labels: str, value: float) -> str:
+    return f'{name}{{{labels}}} {value:g}' if labels else f'{name} {value:g}'
+
+
+def metric_sort_key(row: sqlite3.Row) -> tuple[str, str, float]:
+    # buckets of one series sorted by their bound, +Inf last
+    labels, _, le = row['labels'].partition('le="')
+    return (labels, row['name'], float(le.split('"')[0].replace('+Inf', 'inf') or 0))
+
+
+@app.route('/metrics', methods=['HEAD', 'OPTIONS', 'GET'])
+def metrics_get():
+    METRICS.flush()
+    rows = sorted(db().execute('SELECT name, labels, value FROM metrics'),
+                  key=metric_sort_key)
+    lines: list[str] = list()
+    for family, (kind, help) in METRIC_FAMILIES.items():
+        lines += [f'# HELP {family} {help}', f'# TYPE {family} {kind}']
+        lines += [metric_line(row['name'], row['labels'], row['value']) for row in rows
+                  if row['name'] == family or (kind == 'histogram' and row['name'] in (
+                      f'{family}_bucket', f'{family}_sum', f'{family}_count'))]
+    conn = db()
+    live: list[tuple[str, str, str, list[tuple[dict[str, Any], float]]]] = [
+        ('snpshtr_pending_jobs', 'gauge', 'Jobs queued per screenshot worker.', [
+            (dict(worker=worker), count) for worker, count in conn.execute(
+                'SELECT worker, count(*) FROM pending_jobs GROUP BY worker')]),
+        ('snpshtr_unanalyzed_jobs', 'gauge', 'Analyses with submissions that are not finished.', [
+            (dict(), conn.execute(
+                'SELECT count(*) FROM analyses WHERE finished = 0 AND completeness > 0'
+            ).fetchone()[0])]),
+        ('snpshtr_leased_analyses', 'gauge', 'Analyses currently leased to an analyzer.', [
+            (dict(), conn.execute(
+                'SELECT count(*) FROM analyses WHERE finished = 0 AND leaseExpiresSec > ?',
+                (time.time(),)).fetchone()[0])]),
+        ('snpshtr_gc_reclaimed_bytes_total', 'counter', 'Bytes freed by garbage collection so far.', [
+            (dict(), (conn.execute(
+                "SELECT value FROM ids WHERE name = 'gc.reclaimedBytes'"
+            ).fetchone() or [0])[0])]),
+    ]
+    for name, kind, help, samples in live:
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+        lines += [metric_line(name, metric_labels(labels), value) for labels, value in samples]
+    resp = make_response('\n'.join(lines)+'\n')
+    resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return resp
 
 
 @app.route('/cron', methods=['HEAD', 'OPTIONS', 'GET'])
 def cron():
-    return send_file(CRON_DB)
+    return jsonify([*map(cron_from_row, db().execute(
+        'SELECT data, lastScheduledSec FROM crons ORDER BY cronId'))])
+
+
+@app.route('/cron/<int:cronId>/trend', methods=['HEAD', 'OPTIONS', 'GET'])
+def cron_trend_get(cronId: int):
+    # indicator averages over time, one point per bucket of bucketSec;
+    # long ranges are summed from trend_days, so the cost does not grow
+    # with the number of jobs
+    revision = current_revision(REVISION_ANALYSIS)
+    etag = f'{REVISION_ANALYSIS}-{revision}'
+    if request.if_none_match.contains(etag):
+        resp = make_response('')
+        resp.status_code = 304
+        resp.set_etag(etag)
+        return resp
+    conn = db()
+    if conn.execute('SELECT 1 FROM crons WHERE cronId = ?', (cronId,)).fetchone() is None:
+        raise werkzeug.exceptions.NotFound()
+    first, last = conn.execute(
+        'SELECT min(scheduledSec), max(scheduledSec) FROM trends WHERE cronId = ?',
+        (cronId,)).fetchone()
+    try:
+        fromSec = float(request.args.get('from', first or 0))
+        toSec = float(request.args.get('to', last or 0))
+        points = max(1, min(int(request.args.get('points', TREND_POINTS)), TREND_POINTS_MAX))
+    except ValueError:
+        raise werkzeug.exceptions.BadRequest('from, to and points must be numbers')
+    if not (math.isfinite(fromSec) and math.isfinite(toSec)):
+        raise werkzeug.exceptions.BadRequest('from and to must be finite')
+    bucketSec = max((toSec-fromSec)/points, 1e-3)
+    if toSec-fromSec >= TREND_ROLLUP_MIN_SEC:
+        bucketSec = max(bucketSec, TREND_DAY_SEC)
+        rows = conn.execute(
+            'SELECT dimension, key, '
+            'sum((day + .5) * ? * count) / sum(count) AS sec, '
+            'sum(total) / sum(count) AS value, sum(count) AS jobs '
+            'FROM trend_days WHERE cronId = ? AND day BETWEEN ? AND ? '
+            'GROUP BY dimension, key, CAST(((day + .5) * ? - ?) / ? AS INTEGER) '
+            'ORDER BY sec',
+            (TREND_DAY_SEC, cronId, int(fromSec // TREND_DAY_SEC),
+             int(toSec // TREND_DAY_SEC), TREND_DAY_SEC, fromSec, bucketSec))
+    else:
+        rows = conn.execute(
+            'SELECT dimension, key, avg(scheduledSec) AS sec, '
+            'avg(value) AS value, count(*) AS jobs '
+            'FROM trends WHERE cronId = ? AND scheduledSec BETWEEN ? AND ? '
+            'GROUP BY dimension, key, CAST((scheduledSec - ?) / ? AS INTEGER) '
+            'ORDER BY sec',
+            (cronId, fromSec, toSec, fromSec, bucketSec))
+    series: dict[str, dict[str, list[list[float]]]] = defaultdict(lambda: defaultdict(list))
+    for row in rows:
+        series[row['dimension']][row['key']].append([row['sec'], row['value'], row['jobs']])
+    resp = jsonify(dict(cronId=cronId, fromSec=fromSec, toSec=toSec,
+                        bucketSec=bucketSec, series=series))
+    resp.set_etag(etag)
+    resp.cache_control.no_cache = True
+    return resp
 
 
 @app.route('/cron/form', methods=['HEAD', 'OPTIONS', 'GET'])
@@ -405,23 +1849,570 @@ def cron_form_post():
                 waitJs=float(request.form['waitJs'].strip()),
             )
         }
-        crons = json.loads(CRON_DB.read_text(encoding='utf-8'))
-        crons.append(cron)
-        TempFile.save_utf8(CRON_DB, json.dumps(crons, indent=2))
+        with transaction() as conn:
+            db_insert_cron(conn, cron)
         return redirect('/cron/form?message=added%20successfully&apikey=' + request.form['apikey'])
     elif request.form['action'] == 'delete':
         cronId = int(request.form['cronId'].strip())
-        crons = json.loads(CRON_DB.read_text(encoding='utf-8'))
-        crons = [*filter(lambda c: c['cronId'] != cronId, crons)]
-        TempFile.save_utf8(CRON_DB, json.dumps(crons, indent=2))
+        with transaction() as conn:
+            conn.execute('DELETE FROM crons WHERE cronId = ?', (cronId,))
         return redirect('/cron/form?message=deleted%20successfully&apikey=' + request.form['apikey'])
 
 
+def accel_redirect(path: Path, mimetype: str | None, max_age: int | None = None) -> Response:
+    # path is relative to the state directory, nginx sends the file itself
+    resp = Response(mimetype=mimetype or 'application/octet-stream')
+    resp.headers['X-Accel-Redirect'] = \
+        f'{ACCEL_REDIRECT}/{urllib.parse.quote(path.as_posix())}'
+    if max_age is not None:
+        resp.cache_control.public = True
+        resp.cache_control.max_age = max_age
+    return resp
+
+
 @app.route('/jobs/<path:path>', methods=['HEAD', 'OPTIONS', 'GET'])
 def jobs_static(path):
+    target_zip = JOBS_PATH.joinpath(path)
+    if (not target_zip.exists() and
+            str(target_zip.resolve()).startswith(str(JOBS_PATH.resolve())) and
+            archive_stat(target_zip) is not None):
+        return Response(iter_archive_zip(target_zip), mimetype='application/zip')
+    if ACCEL_REDIRECT and request.method != 'OPTIONS':
+        if (not str(target_zip.resolve()).startswith(str(JOBS_PATH.resolve())) or
+                not target_zip.is_file()):
+            raise werkzeug.exceptions.NotFound()
+        return accel_redirect(target_zip, mimetypes.guess_type(path)[0])
     return send_from_directory('jobs', path)
 
 
+@dataclass
+class ZipMember:
+    name: str
+    compress_type: int
+    header_offset: int
+    compress_size: int
+    file_size: int
+    crc: int
+    data_offset: int | None = None
+    # set when the member lives in a blob rather than in the archive
+    source: Path | None = None
+
+
+def blob_path(sha256: str) -> Path:
+    return BLOBS_PATH.joinpath(sha256[:2], sha256)
+
+
+def db_release_archive(conn: sqlite3.Connection, archive: str):
+    conn.execute(
+        'UPDATE blobs SET refs = refs - (SELECT count(*) FROM archive_members '
+        'WHERE archive = ? AND sha256 = blobs.sha256) '
+        'WHERE sha256 IN (SELECT sha256 FROM archive_members WHERE archive = ?)',
+        (archive, archive))
+    conn.execute('DELETE FROM archive_members WHERE archive = ?', (archive,))
+    conn.execute('DELETE FROM archives WHERE archive = ?', (archive,))
+
+
+def db_release_job_archives(conn: sqlite3.Connection, jobId: int):
+    prefix = f'{JOBS_PATH.joinpath(f"{jobId:020d}")}{os.sep}'
+    for (archive,) in conn.execute(
+            'SELECT archive FROM archives WHERE substr(archive, 1, ?) = ?',
+            (len(prefix), prefix)).fetchall():
+        db_release_archive(conn, archive)
+
+
+def crc32_file(path: Path) -> int:
+    crc = 0
+    with path.open('rb') as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def db_commit_archive(conn: sqlite3.Connection, archive: str,
+                      members: list[tuple[str, str, int, int]],
+                      size: int, mtimeNs: int, sha256: str):
+    # members are (name, sha256, size, crc), in archive order
+    db_release_archive(conn, archive)
+    conn.execute(
+        'INSERT INTO archives (archive, size, mtimeNs, sha256) VALUES (?, ?, ?, ?)',
+        (archive, size, mtimeNs, sha256))
+    for position, (name, h, file_size, crc) in enumerate(members):
+        conn.execute(
+            'INSERT INTO blobs (sha256, size, refs, crc) VALUES (?, ?, 1, ?) '
+            'ON CONFLICT (sha256) DO UPDATE SET refs = refs + 1, crc = excluded.crc',
+            (h, file_size, crc))
+        conn.execute(
+            'INSERT INTO archive_members (archive, position, name, sha256, size, crc) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (archive, position, name, h, file_size, crc))
+
+
+def explode_archive(path: Path, sha256: str | None = None):
+    # replaces a zip by one blob per distinct member and a manifest; new
+    # blobs are written before taking the write lock and checked again
+    # under it, in case a gc pass collected them in between
+    st = path.stat()
+    with zipfile.ZipFile(path, mode='r') as zf:
+        members: dict[str, tuple[zipfile.ZipInfo, str]] = dict()
+        for zi in zf.infolist():
+            if zi.is_dir():
+                continue
+            m = hashlib.sha256()
+            with zf.open(zi) as fr:
+                while chunk := fr.read(UPLOAD_CHUNK_SIZE):
+                    m.update(chunk)
+            members[zi.filename] = (zi, m.hexdigest())
+        for zi, h in members.values():
+            if not blob_path(h).exists():
+                with zf.open(zi) as fr:
+                    TempFile.save_stream(blob_path(h), fr, h)
+        with transaction() as conn:
+            db_commit_archive(
+                conn, str(path),
+                [(zi.filename, h, zi.file_size, zi.CRC) for zi, h in members.values()],
+                st.st_size, st.st_mtime_ns, sha256 or sha256_file(path))
+            for zi, h in members.values():
+                if not blob_path(h).exists():
+                    with zf.open(zi) as fr:
+                        TempFile.save_stream(blob_path(h), fr, h)
+    path.unlink()
+
+
+def missing_blobs(hashes: list[str]) -> list[str]:
+    return sorted({h for h in hashes if not blob_path(h).exists()})
+
+
+def commit_manifest(path: Path, manifest: dict[str, str]) -> list[str]:
+    # turns {name: sha256} of blobs already uploaded into an exploded
+    # archive at path; returns the blobs that went missing instead
+    with transaction() as conn:
+        missing = missing_blobs([*manifest.values()])
+        if missing:
+            return missing
+        members: list[tuple[str, str, int, int]] = list()
+        for name, h in manifest.items():
+            row = conn.execute('SELECT crc FROM blobs WHERE sha256 = ?', (h,)).fetchone()
+            crc = crc32_file(blob_path(h)) if row is None or row['crc'] is None else row['crc']
+            members.append((name, h, blob_path(h).stat().st_size, crc))
+        db_commit_archive(
+            conn, str(path), members, sum(m[2] for m in members), time.time_ns(),
+            hashlib.sha256(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest())
+    return []
+
+
+def archive_stat(path: Path) -> tuple[int, int] | None:
+    # (mtime_ns, size) of a zip on disk or of the one an archive replaced
+    try:
+        st = path.stat()
+        return st.st_mtime_ns, st.st_size
+    except FileNotFoundError:
+        row = db().execute('SELECT mtimeNs, size FROM archives WHERE archive = ?',
+                           (str(path),)).fetchone()
+        return None if row is None else (row['mtimeNs'], row['size'])
+
+
+def db_get_archive_members(path: Path) -> dict[str, ZipMember]:
+    return {
+        row['name']: ZipMember(row['name'], zipfile.ZIP_STORED, 0, row['size'],
+                               row['size'], row['crc'], 0, blob_path(row['sha256']))
+        for row in db().execute(
+            'SELECT name, sha256, size, crc FROM archive_members '
+            'WHERE archive = ? ORDER BY position', (str(path),))}
+
+
+def list_job_dir(path: Path) -> list[str]:
+    prefix = f'{path}{os.sep}'
+    names = [a.name for a in path.iterdir()] if path.is_dir() else []
+    names += [row[0][len(prefix):] for row in db().execute(
+        'SELECT archive FROM archives WHERE substr(archive, 1, ?) = ?',
+        (len(prefix), prefix))]
+    return sorted(set(names))
+
+
+class ChunkSink(io.RawIOBase):
+    # collects what zipfile writes, so the archive can be yielded as it grows
+    def __init__(self) -> None:
+        self.chunks: list[bytes] = list()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data, self.chunks = b''.join(self.chunks), list()
+        return data
+
+
+def iter_archive_zip(path: Path) -> Iterator[bytes]:
+    # rebuilds an exploded zip from its blobs, stored, without a temp file;
+    # it goes through the app as it is nowhere on disk, and its bytes are not
+    # those uploaded: the archive's sha256 names the submission, either the
+    # uploaded zip's or, for a delta upload, that of its manifest
+    date_time = time.localtime(archive_stat(path)[0]/1e9)[:6]  # type: ignore
+    sink = ChunkSink()
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED) as zf:
+        for member in ZIP_INDEXES.get(path).values():
+            with zf.open(zipfile.ZipInfo(member.name, date_time), mode='w') as fw, \
+                    (member.source or path).open('rb') as fr:
+                while chunk := fr.read(UNZIP_CHUNK_SIZE):
+                    fw.write(chunk)
+                    yield sink.drain()
+    yield sink.drain()
+
+
+class ZipIndexCache:
+    # parsed central directories, keyed by (path, mtime, size) so that a
+    # replaced archive is never served from a stale index
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries: OrderedDict[tuple[str, int, int],
+                                  tuple[dict[str, ZipMember], int]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path: Path) -> dict[str, ZipMember]:
+        st = archive_stat(path)
+        if st is None:
+            raise werkzeug.exceptions.NotFound()
+        key = (str(path.resolve()), *st, path.exists())
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+        try:
+            with METRICS.timed('zip_index'), zipfile.ZipFile(path, mode='r') as zf:
+                members = {
+                    zi.filename: ZipMember(zi.filename, zi.compress_type,
+                                           zi.header_offset, zi.compress_size,
+                                           zi.file_size, zi.CRC)
+                    for zi in zf.infolist()}
+        except FileNotFoundError:
+            members = db_get_archive_members(path)
+        cost = sum(len(name)+160 for name in members)
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (members, cost)
+                self.used_bytes += cost
+            while self.used_bytes > self.max_bytes and len(self.entries) > 1:
+                self.used_bytes -= self.entries.popitem(last=False)[1][1]
+        return members
+
+
+ZIP_INDEXES = ZipIndexCache(UNZIP_INDEX_CACHE_BYTES)
+
+
+class FileSlice(io.RawIOBase):
+    # a read-only view of [offset, offset+size) of a file; fileno() and the
+    # initial file position let gunicorn sendfile() it straight from disk
+    def __init__(self, path: Path, offset: int, size: int) -> None:
+        self.f = path.open('rb')
+        self.f.seek(offset)
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def fileno(self) -> int:
+        return self.f.fileno()
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: self.size}[whence]
+        self.pos = max(0, min(self.size, base+pos))
+        return self.pos
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self.size-self.pos)
+        if n <= 0:
+            return 0
+        self.f.seek(self.offset+self.pos)
+        data = self.f.read(n)
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def close(self) -> None:
+        self.f.close()
+        super().close()
+
+
+def zip_member_data_offset(path: Path, member: ZipMember) -> int:
+    if member.data_offset is None:
+        with path.open('rb') as f:
+            f.seek(member.header_offset)
+            header = f.read(30)
+        signature, *_, fname_len, extra_len = struct.unpack('<4s5H3I2H', header)
+        if signature != b'PK\x03\x04':
+            raise werkzeug.exceptions.InternalServerError('bad zip member header')
+        member.data_offset = member.header_offset+30+fname_len+extra_len
+    return member.data_offset
+
+
+def iter_deflated(path: Path, offset: int, compress_size: int) -> Iterator[bytes]:
+    d = zlib.decompressobj(-zlib.MAX_WBITS)
+    with path.open('rb') as f:
+        f.seek(offset)
+        remaining = compress_size
+        while remaining > 0:
+            chunk = f.read(min(UNZIP_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            if out := d.decompress(chunk):
+                yield out
+    if out := d.flush():
+        yield out
+
+
+def send_zip_member(target_zip: Path, zippath: str):
+    member = ZIP_INDEXES.get(target_zip).get(zippath)
+    if member is None:
+        raise werkzeug.exceptions.NotFound()
+    if ACCEL_REDIRECT and member.source is not None:
+        # members already extracted into the blob store go out as files
+        return accel_redirect(member.source, mimetypes.guess_type(zippath)[0],
+                              UNZIP_MAX_AGE_SEC)
+    if member.compress_type == zipfile.ZIP_STORED:
+        body = wrap_file(request.environ, FileSlice(
+            member.source or target_zip, zip_member_data_offset(target_zip, member),
+            member.file_size))
+    elif member.compress_type == zipfile.ZIP_DEFLATED:
+        body = iter_deflated(
+            target_zip, zip_member_data_offset(target_zip, member), member.compress_size)
+    else:
+        with zipfile.ZipFile(target_zip, mode='r') as zf:
+            body = [zf.read(zippath)]
+    resp = Response(body, mimetype=mimetypes.guess_type(zippath)[0],
+                    direct_passthrough=True)
+    resp.content_length = member.file_size
+    resp.last_modified = archive_stat(target_zip)[0]/1e9  # type: ignore
+    resp.set_etag(f'{member.crc:08x}-{member.file_size}')
+    resp.cache_control.public = True
+    resp.cache_control.max_age = UNZIP_MAX_AGE_SEC
+    return resp.make_conditional(request.environ, accept_ranges=True,
+                                 complete_length=member.file_size)
+
+
+def read_zip_member(target_zip: Path, zippath: str) -> bytes:
+    with METRICS.timed('zip_member_read'):
+        return raw_read_zip_member(target_zip, zippath)
+
+
+def raw_read_zip_member(target_zip: Path, zippath: str) -> bytes:
+    member = ZIP_INDEXES.get(target_zip).get(zippath)
+    if member is None:
+        raise werkzeug.exceptions.NotFound()
+    if member.compress_type == zipfile.ZIP_STORED:
+        with FileSlice(member.source or target_zip,
+                       zip_member_data_offset(target_zip, member), member.file_size) as fs:
+            return fs.read()
+    elif member.compress_type == zipfile.ZIP_DEFLATED:
+        return b''.join(iter_deflated(
+            target_zip, zip_member_data_offset(target_zip, member), member.compress_size))
+    with zipfile.ZipFile(target_zip, mode='r') as zf:
+        return zf.read(zippath)
+
+
+class DerivativeCache:
+    # thumbnails and tiles on disk, keyed by archive, member, archive mtime and
+    # variant; least recently used files go first once max_bytes is exceeded
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.used_bytes: int | None = None
+        self.lock = threading.Lock()
+
+    def path_for(self, target_zip: Path, zippath: str, variant: str) -> Path:
+        key = '\0'.join((str(target_zip.resolve()), zippath,
+                         str(archive_stat(target_zip)[0]), variant))  # type: ignore
+        h = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return self.root.joinpath(h[:2], f'{h}.jpg')
+
+    def hit(self, path: Path) -> bool:
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    @contextmanager
+    def generating(self, path: Path) -> Iterator[None]:
+        # one request renders what path stands for, the ones that came in
+        # meanwhile wait and then find it in the cache
+        lock = path.with_suffix('.lock')
+        lock.parent.mkdir(parents=True, exist_ok=True)
+        with lock.open('a') as fa:
+            fcntl.flock(fa, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                lock.unlink(missing_ok=True)
+
+    def put(self, path: Path, data: bytes):
+        TempFile.save_bytes(path, data)
+        with self.lock:
+            if self.used_bytes is None:
+                self.used_bytes = sum(f.stat().st_size for f in self.root.rglob('*.jpg'))
+            else:
+                self.used_bytes += len(data)
+            if self.used_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        files = sorted((st.st_mtime, st.st_size, f)
+                       for f in self.root.rglob('*.jpg') for st in [f.stat()])
+        self.used_bytes = sum(size for _, size, _ in files)
+        for _, size, f in files:
+            if self.used_bytes <= self.max_bytes*.9:
+                break
+            f.unlink(missing_ok=True)
+            self.used_bytes -= size
+
+
+DERIVATIVES = DerivativeCache(DERIVATIVES_PATH, DERIVATIVES_CACHE_BYTES)
+
+
+def resolve_job_zip(path: str) -> Path:
+    target_zip = Path('jobs').joinpath(path+'.zip')
+    if not str(target_zip.resolve()).startswith(str(Path('jobs').resolve())):
+        raise werkzeug.exceptions.NotAcceptable()
+    if archive_stat(target_zip) is None:
+        raise werkzeug.exceptions.NotFound()
+    return target_zip
+
+
+def read_zip_member_head(target_zip: Path, zippath: str, size: int) -> bytes:
+    member = ZIP_INDEXES.get(target_zip).get(zippath)
+    if member is None:
+        raise werkzeug.exceptions.NotFound()
+    if member.compress_type == zipfile.ZIP_STORED:
+        with FileSlice(member.source or target_zip, zip_member_data_offset(target_zip, member),
+                       min(size, member.file_size)) as fs:
+            return fs.read()
+    elif member.compress_type == zipfile.ZIP_DEFLATED:
+        head = b''
+        for chunk in iter_deflated(
+                target_zip, zip_member_data_offset(target_zip, member), member.compress_size):
+            head += chunk
+            if len(head) >= size:
+                break
+        return head
+    with zipfile.ZipFile(target_zip, mode='r') as zf, zf.open(zippath) as fr:
+        return fr.read(size)
+
+
+def open_image(data: bytes) -> PIL.Image.Image:
+    # opening only reads the header; images past Pillow's pixel limit would
+    # take gigabytes to decode, so they are refused before that happens
+    try:
+        im = PIL.Image.open(BytesIO(data))
+    except PIL.UnidentifiedImageError:
+        raise werkzeug.exceptions.UnsupportedMediaType('not an image')
+    except PIL.Image.DecompressionBombError:
+        raise werkzeug.exceptions.UnprocessableEntity('image is too large to render')
+    if PIL.Image.MAX_IMAGE_PIXELS and im.size[0]*im.size[1] > PIL.Image.MAX_IMAGE_PIXELS:
+        raise werkzeug.exceptions.UnprocessableEntity('image is too large to render')
+    return im
+
+
+def image_size(target_zip: Path, zippath: str) -> tuple[int, int]:
+    # from the header alone, so that asking about an image decodes nothing
+    try:
+        return open_image(read_zip_member_head(target_zip, zippath, IMAGE_HEAD_BYTES)).size
+    except werkzeug.exceptions.UnsupportedMediaType:
+        return open_image(read_zip_member(target_zip, zippath)).size
+
+
+def image_to_jpeg(im: PIL.Image.Image) -> bytes:
+    bio = BytesIO()
+    im.convert('RGB').save(bio, format='JPEG', quality=85)
+    return bio.getvalue()
+
+
+def tile_levels(size: tuple[int, int]) -> int:
+    # level 0 fits the whole image in one tile, the last level is full size
+    levels = 1
+    while max(size) > TILE_SIZE*2**(levels-1):
+        levels += 1
+    return levels
+
+
+def send_derivative(target_zip: Path, path: Path):
+    if ACCEL_REDIRECT:
+        return accel_redirect(path, 'image/jpeg', UNZIP_MAX_AGE_SEC)
+    # the cache touches mtime on every hit, so it must not leak into
+    # validators; flask would resolve a relative path against the source dir
+    return send_file(path.resolve(), mimetype='image/jpeg', max_age=UNZIP_MAX_AGE_SEC,
+                     etag=path.stem, last_modified=archive_stat(target_zip)[0]/1e9)  # type: ignore
+
+
+@app.route('/thumb/jobs/<path:path>.zip/<path:zippath>', methods=['HEAD', 'OPTIONS', 'GET'])
+def thumb_jobs_path_inner(path, zippath):
+    target_zip = resolve_job_zip(path)
+    try:
+        w = max(16, min(THUMB_MAX_SIDE, int(request.args.get('w', '320'))))
+        h = max(16, min(THUMB_MAX_SIDE*16, int(request.args.get('h', str(w*16)))))
+    except ValueError:
+        raise werkzeug.exceptions.BadRequest('w and h must be integers')
+    thumb = DERIVATIVES.path_for(target_zip, zippath, f'thumb.{w}x{h}')
+    if not DERIVATIVES.hit(thumb):
+        image_size(target_zip, zippath)
+        with DERIVATIVES.generating(thumb):
+            if not DERIVATIVES.hit(thumb):
+                im = open_image(read_zip_member(target_zip, zippath))
+                im.thumbnail((w, h), reducing_gap=3.)
+                DERIVATIVES.put(thumb, image_to_jpeg(im))
+    return send_derivative(target_zip, thumb)
+
+
+@app.route('/tiles/jobs/<path:path>.zip/<path:zippath>', methods=['HEAD', 'OPTIONS', 'GET'])
+def tiles_jobs_path_inner(path, zippath):
+    target_zip = resolve_job_zip(path)
+    if 'z' not in request.args:
+        size = image_size(target_zip, zippath)
+        return jsonify(dict(width=size[0], height=size[1],
+                            tileSize=TILE_SIZE, levels=tile_levels(size)))
+    try:
+        z, x, y = (int(request.args[k]) for k in ('z', 'x', 'y'))
+    except (KeyError, ValueError):
+        raise werkzeug.exceptions.BadRequest('z, x and y must be integers')
+    tile = DERIVATIVES.path_for(target_zip, zippath, f'tile.{z}.{x}.{y}')
+    if not DERIVATIVES.hit(tile):
+        size = image_size(target_zip, zippath)
+        levels = tile_levels(size)
+        if not 0 <= z < levels:
+            raise werkzeug.exceptions.NotFound()
+        scale = 2**(z-levels+1)
+        level_size = (max(1, round(size[0]*scale)), max(1, round(size[1]*scale)))
+        if not (0 <= x < -(-level_size[0]//TILE_SIZE) and
+                0 <= y < -(-level_size[1]//TILE_SIZE)):
+            raise werkzeug.exceptions.NotFound()
+        with DERIVATIVES.generating(DERIVATIVES.path_for(target_zip, zippath, f'tile.{z}')):
+            if not DERIVATIVES.hit(tile):
+                # the source is decoded once per level, so every tile of it is cut now
+                im = open_image(read_zip_member(target_zip, zippath))
+                level = im.resize(level_size, reducing_gap=3.)
+                for tx in range(0, level.size[0], TILE_SIZE):
+                    for ty in range(0, level.size[1], TILE_SIZE):
+                        DERIVATIVES.put(
+                            DERIVATIVES.path_for(
+                                target_zip, zippath,
+                                f'tile.{z}.{tx//TILE_SIZE}.{ty//TILE_SIZE}'),
+                            image_to_jpeg(level.crop((tx, ty, min(tx+TILE_SIZE, level.size[0]),
+                                                      min(ty+TILE_SIZE, level.size[1])))))
+    return send_derivative(target_zip, tile)
+
+
 @app.route('/unzip/jobs', methods=['HEAD', 'OPTIONS', 'GET'])
 def unzip_jobs():
     return jsonify([*map(lambda a: a.name, Path('jobs').iterdir())])
@@ -432,35 +2423,46 @@ def unzip_jobs_path(path):
     target_zip = Path('jobs').joinpath(path)
     if not str(target_zip.resolve()).startswith(str(Path('jobs').resolve())):
         raise werkzeug.exceptions.NotAcceptable()
-    if not target_zip.exists():
-        raise werkzeug.exceptions.NotFound()
     if target_zip.is_dir():
-        return jsonify([*map(lambda a: a.name, target_zip.iterdir())])
-    with zipfile.ZipFile(target_zip, mode='r') as zf:
-        return send_file(
-            BytesIO(json.dumps(
-                [i.filename for i in zf.infolist()], indent=2).encode('utf-8')),
-            last_modified=target_zip.stat().st_mtime,
-            mimetype='application/json'
-        )
+        return jsonify(list_job_dir(target_zip))
+    if archive_stat(target_zip) is None:
+        raise werkzeug.exceptions.NotFound()
+    return send_file(
+        BytesIO(json.dumps(
+            [*ZIP_INDEXES.get(target_zip).keys()], indent=2).encode('utf-8')),
+        last_modified=archive_stat(target_zip)[0]/1e9,  # type: ignore
+        mimetype='application/json'
+    )
 
 
 @app.route('/unzip/jobs/<path:path>.zip/<path:zippath>', methods=['HEAD', 'OPTIONS', 'GET'])
 def unzip_jobs_path_inner(path, zippath):
-    target_zip = Path('jobs').joinpath(path+'.zip')
-    if not str(target_zip.resolve()).startswith(str(Path('jobs').resolve())):
-        raise werkzeug.exceptions.NotAcceptable()
-    if not target_zip.exists():
-        raise werkzeug.exceptions.NotFound()
+    target_zip = resolve_job_zip(path)
     if zippath in ('', '/'):
         return unzip_jobs_path(path)
-    with zipfile.ZipFile(target_zip, mode='r') as zf:
-        try:
-            zd = zf.read(zippath)
-        except KeyError:
-            raise werkzeug.exceptions.NotFound()
-        return send_file(
-            BytesIO(zd),
-            last_modified=target_zip.stat().st_mtime,
-            mimetype=mimetypes.guess_type(zippath)[0]
-        )
+    return send_zip_member(target_zip, zippath)
+
+
+def main():
+    if sys.argv[1:] == ['reconcile']:
+        with transaction() as conn:
+            updated, removed = reconcile_submissions(conn)
+            rebuild_pending_jobs(conn)
+            refresh_all_analyses(conn)
+        print(f'[INFO] Reconciled submissions: {updated} updated, {removed} removed')
+    elif sys.argv[1:] == ['gc']:
+        collect_garbage(time.time())
+    elif sys.argv[1:] == ['dedupe']:
+        zips = [*JOBS_PATH.glob('*/*.zip')]
+        before = sum(z.stat().st_size for z in zips)
+        for z in zips:
+            explode_archive(z)
+        after = sum(f.stat().st_size for f in BLOBS_PATH.rglob('*') if f.is_file())
+        print(f'[INFO] Exploded {len(zips)} archives, {before} bytes of zips now '
+              f'held in {after} bytes of blobs')
+    else:
+        raise ValueError(f'Unknown arguments: {sys.argv[1:]}')
+
+
+if __name__ == '__main__':
+    main()
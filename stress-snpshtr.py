@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+# Runs server-snpshtr.py under gunicorn with several processes against a
+# throwaway state directory, then races crons, job claims, submissions,
+# analysis claims and analysis uploads from many threads and checks that no
+# id was handed out twice and no accepted write was lost.
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+import requests
+
+APIKEY = 'stress'
+
+
+def make_zip(name: str, content: dict) -> bytes:
+    bio = BytesIO()
+    with zipfile.ZipFile(bio, mode='w') as zf:
+        zf.writestr(name, json.dumps(content))
+        zf.writestr('noise.bin', os.urandom(4096))
+    return bio.getvalue()
+
+
+def wait_for_server(baseapi: str, timeout: float):
+    deadline = time.time()+timeout
+    while time.time() < deadline:
+        try:
+            requests.get(f'{baseapi}/', timeout=1).raise_for_status()
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(.2)
+    raise TimeoutError('server did not come up')
+
+
+def add_crons(baseapi: str, count: int, threads: int) -> list[int]:
+    def add(i: int):
+        requests.post(f'{baseapi}/cron/form', allow_redirects=False, data=dict(
+            apikey=APIKEY, action='add', url=f'http://stress.invalid/{i}',
+            hours='24', historySize='0', preRunJs='', wait='0', scrolltoJs='',
+            scrolltox='0', scrolltoy='0', checkReadyJs='', waitJs='0',
+        )).raise_for_status()
+    with ThreadPoolExecutor(threads) as pool:
+        [*pool.map(add, range(count))]
+    return [cron['cronId'] for cron in requests.get(f'{baseapi}/cron').json()]
+
+
+def run_worker(baseapi: str, worker: str, posted: dict, lock: threading.Lock):
+    while True:
+        resp = requests.get(f'{baseapi}/job/next?key={APIKEY}&worker={worker}')
+        if resp.status_code == 404:
+            return
+        resp.raise_for_status()
+        jobId = resp.json()['jobId']
+        b = make_zip('job.json', dict(jobId=jobId, worker=worker))
+        h = hashlib.sha256(b).hexdigest()
+        resp = requests.post(
+            f'{baseapi}/job?key={APIKEY}&worker={worker}&jobId={jobId}&sha256={h}',
+            headers={'content-type': 'application/zip'}, data=b)
+        if resp.status_code == 200:
+            with lock:
+                posted.setdefault((jobId, worker), set()).add(h)
+
+
+def run_analyzer(baseapi: str, analyzer: str, posted: dict, lock: threading.Lock):
+    while True:
+        resp = requests.get(f'{baseapi}/analysis/next?key={APIKEY}&worker={analyzer}')
+        if resp.status_code == 404:
+            return
+        resp.raise_for_status()
+        anal = resp.json()
+        b = make_zip('analysis.json', dict(
+            jobId=anal['jobId'], analyzer=analyzer, indicators=dict(rmse=0.)))
+        h = hashlib.sha256(b).hexdigest()
+        resp = requests.post(
+            f'{baseapi}/analysis?key={APIKEY}&worker={analyzer}&jobId={anal["jobId"]}'
+            f'&completeness={anal["completeness"]}&sha256={h}',
+            headers={'content-type': 'application/zip'}, data=b)
+        if resp.status_code == 200:
+            with lock:
+                posted.setdefault(anal['jobId'], list()).append((analyzer, h))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4,
+                        help='gunicorn processes')
+    parser.add_argument('--threads', type=int, default=16,
+                        help='gunicorn threads per process')
+    parser.add_argument('--crons', type=int, default=40)
+    parser.add_argument('--clients', type=int, default=8,
+                        help='distinct screenshot workers, each polled by two threads')
+    parser.add_argument('--analyzers', type=int, default=6)
+    parser.add_argument('--port', type=int, default=35796)
+    args = parser.parse_args()
+
+    server = Path(__file__).resolve().parent.joinpath('server-snpshtr.py')
+    baseapi = f'http://127.0.0.1:{args.port}'
+    failures: list[str] = list()
+    with tempfile.TemporaryDirectory() as state:
+        Path(state).joinpath('apikey.txt').write_text(APIKEY, encoding='utf-8')
+        proc = subprocess.Popen([
+            sys.executable, '-m', 'gunicorn',
+            '--bind', f'127.0.0.1:{args.port}',
+            '--pythonpath', str(server.parent), '--chdir', state,
+            '--preload', '--workers', str(args.workers), '--threads', str(args.threads),
+            f'{server.stem}:app',
+        ], env={**os.environ, 'SCHEDULER_INTERVAL_SEC': '.5', 'METRICS_FLUSH_SEC': '1'},
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_server(baseapi, 30)
+            started = time.time()
+
+            cronIds = add_crons(baseapi, args.crons, args.threads)
+            print(f'[INFO] {len(cronIds)} crons added')
+            if len(set(cronIds)) != len(cronIds) or len(cronIds) != args.crons:
+                failures.append(f'cron ids: {sorted(cronIds)}')
+
+            # workers announce themselves before the jobs exist, so every job
+            # is queued for every one of them
+            workers = [f'stress-w{i}' for i in range(args.clients)]
+            for worker in workers:
+                requests.get(f'{baseapi}/job/next?key={APIKEY}&worker={worker}')
+            while len(requests.get(f'{baseapi}/job').json()) < args.crons:
+                time.sleep(.2)
+            jobIds = [job['jobId'] for job in requests.get(f'{baseapi}/job').json()]
+            print(f'[INFO] {len(jobIds)} jobs scheduled')
+            if len(set(jobIds)) != len(jobIds):
+                failures.append(f'job ids: {sorted(jobIds)}')
+
+            lock = threading.Lock()
+            submitted: dict[tuple[int, str], set[str]] = dict()
+            with ThreadPoolExecutor(2*len(workers)) as pool:
+                for f in [pool.submit(run_worker, baseapi, worker, submitted, lock)
+                          for worker in workers*2]:
+                    f.result()
+            print(f'[INFO] {len(submitted)} submissions accepted')
+            for job in requests.get(f'{baseapi}/job/submission').json():
+                for worker in workers:
+                    path = job['workers'].get(worker)
+                    if path is None:
+                        failures.append(f'job {job["jobId"]}: no submission from {worker}')
+                        continue
+                    h = hashlib.sha256(
+                        Path(state).joinpath(path).read_bytes()).hexdigest()
+                    if h not in submitted.get((job['jobId'], worker), set()):
+                        failures.append(f'job {job["jobId"]}: {worker} stored {h}, not what it sent')
+
+            analysed: dict[int, list[tuple[str, str]]] = dict()
+            with ThreadPoolExecutor(args.analyzers) as pool:
+                for f in [pool.submit(run_analyzer, baseapi, f'stress-a{i}', analysed, lock)
+                          for i in range(args.analyzers)]:
+                    f.result()
+            print(f'[INFO] {sum(map(len, analysed.values()))} analyses accepted')
+            for anal in requests.get(f'{baseapi}/analysis?limit=5000').json():
+                accepted = analysed.get(anal['jobId'], [])
+                if not anal['finished'] or len(accepted) != 1:
+                    failures.append(f'analysis {anal["jobId"]}: finished={anal["finished"]}, '
+                                    f'accepted {len(accepted)} times')
+                    continue
+                h = hashlib.sha256(Path(state).joinpath(
+                    f'jobs/{anal["jobId"]:020d}/analysis.zip').read_bytes()).hexdigest()
+                if (anal['assignee'], h) != accepted[0]:
+                    failures.append(f'analysis {anal["jobId"]}: stored report of '
+                                    f'{anal["assignee"]} does not match the accepted one')
+
+            time.sleep(2)
+            uptime = requests.get(f'{baseapi}/uptime').json()
+            if set(workers) - uptime.keys():
+                failures.append(f'heartbeats lost: {sorted(set(workers)-uptime.keys())}')
+            print(f'[INFO] Finished in {time.time()-started:.1f}s')
+        finally:
+            proc.terminate()
+            proc.wait()
+    for failure in failures:
+        print(f'[FAIL] {failure}')
+    if failures:
+        sys.exit(1)
+    print('[INFO] No duplicated ids, no lost writes')
+
+
+if __name__ == '__main__':
+    main()